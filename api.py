@@ -0,0 +1,437 @@
+"""
+Headless chat API (ASGI, Starlette) next to the Streamlit UI.
+
+Same storage (firebase_db), retrieval and generation pipeline as app.py,
+without a script rerun per message: one process serves many concurrent
+chats, and other clients can talk to the bots.
+
+Run:
+    uvicorn api:app --host 0.0.0.0 --port 8000
+    python api.py --port 8000
+
+Endpoints (JSON; everything but login/health needs "Authorization: Bearer <token>"):
+    POST /api/login                       {"username", "password"} -> {"token", "username"}
+    GET  /api/bots                        -> {"bots": [{id, name, persona}, ...]}
+    GET  /api/bots/{bot_id}/history       ?limit=50&before=<cursor> -> {"turns", "before"}
+    POST /api/bots/{bot_id}/messages      {"text", "client_id"?} -> text/event-stream:
+                                            event: token  data: {"text": "<delta>"}
+                                            event: done   data: <turn>
+                                            event: error  data: {"error": "..."}
+                                          (?stream=0 for one JSON reply instead)
+    WS   /api/bots/{bot_id}/ws?token=...  send {"text", "client_id"?}; receive {"type": "token"|"done"|"error", ...}
+    GET  /healthz, GET /metrics (Prometheus text)
+
+`client_id` makes a send idempotent: retrying a message whose client_id
+matches the conversation's last turn answers (or returns) that turn
+instead of adding another one.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+
+import metrics
+from firebase_db import get_bot, get_user_bots, load_history_page, login_user, save_chat_history_cloud
+from pipeline import GenerationPipeline, TurnContext, new_turn
+from query_cache import LRUCache, QueryCache
+from retrieval import bot_index_hash, build_index, live_index_gauges
+from scheduler import BACKGROUND, FairScheduler, QuotaExceeded, estimate_tokens
+from session_history import HISTORY_WINDOW
+
+
+def _setting(name, default=None):
+    """Environment first, then .streamlit/secrets.toml (shared with the UI)."""
+    value = os.getenv(name)
+    if value:
+        return value
+    try:
+        import streamlit as st
+        return st.secrets.get(name, default) if st.secrets else default
+    except Exception:
+        return default
+
+
+# without a configured secret, tokens only survive until the process restarts
+API_SECRET = (_setting("CHATDOUBLE_API_SECRET") or secrets.token_hex(32)).encode()
+TOKEN_TTL = int(os.getenv("CHATDOUBLE_API_TOKEN_TTL", str(7 * 24 * 3600)))
+API_THREADS = int(os.getenv("CHATDOUBLE_API_THREADS", "64"))   # blocking storage / model calls
+MAX_MESSAGE_CHARS = 4000
+
+
+# =========================================================
+# 🔑 Tokens (stateless, HMAC-signed)
+# =========================================================
+def make_token(username: str, ttl: int = TOKEN_TTL) -> str:
+    payload = f"{username}:{int(time.time()) + ttl}"
+    sig = hmac.new(API_SECRET, payload.encode(), hashlib.sha256).hexdigest()
+    return base64.urlsafe_b64encode(f"{payload}:{sig}".encode()).decode().rstrip("=")
+
+
+def check_token(token: str):
+    """Username for a valid, unexpired token; None otherwise."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        username, expires, sig = raw.rsplit(":", 2)
+        expected = hmac.new(API_SECRET, f"{username}:{expires}".encode(), hashlib.sha256).hexdigest()
+        if hmac.compare_digest(sig, expected) and int(expires) > time.time():
+            return username
+    except (ValueError, UnicodeDecodeError):
+        pass
+    return None
+
+
+# =========================================================
+# 💬 Chat core (what app.py gets from st.cache_resource)
+# =========================================================
+class ChatCore:
+    """
+    One per process: index cache, query cache, scheduler and generation
+    pipeline, shared by every connection. Methods are blocking; the
+    handlers run them on the API thread pool.
+    """
+
+    def __init__(self, client_getter, shared=None, scheduler=None, index_cache_size: int = 32):
+        self.shared = shared
+        self.scheduler = scheduler
+        self._indexes = LRUCache(index_cache_size)
+        self._index_lock = threading.Lock()
+        self.query_cache = QueryCache(shared=shared)
+        self.pipeline = GenerationPipeline(
+            index_for=self.index_for,
+            query_cache=self.query_cache,
+            client_getter=client_getter,
+            persist=save_chat_history_cloud,
+            shared=shared,
+            scheduler=scheduler,
+        )
+
+    def index_for(self, bot_text: str, user: str = ""):
+        key = bot_index_hash(bot_text)
+        bot_index = self._indexes.get(key)
+        if bot_index is None:
+            admit = None
+            if self.scheduler is not None:
+                admit = lambda lines: self.scheduler.slot(user, BACKGROUND, tokens=estimate_tokens(lines))
+            # concurrent builds of one corpus are coalesced inside build_index
+            bot_index = build_index(bot_text, shared=self.shared, admit=admit)
+            with self._index_lock:
+                self._indexes.put(key, bot_index)
+        return bot_index
+
+    def send(self, user: str, bot: dict, text: str, on_text=None, client_id: str = None) -> dict:
+        """Append the user's message, run the pipeline, return the answered turn."""
+        bot_text = bot.get("file_text", "")
+        if not bot_text.strip():
+            raise ValueError("Bot has no data.")
+        self.index_for(bot_text, user)
+        # only the newest turns: the prompt uses no more, and saves start there
+        page = load_history_page(user, bot["id"], limit=HISTORY_WINDOW)
+        history, start = page["turns"], page["before"] or 0
+        retry = client_id and history and isinstance(history[-1], dict) and history[-1].get("client_id") == client_id
+        if not retry:
+            turn = new_turn(text)
+            if client_id:
+                turn["client_id"] = client_id
+            history.append(turn)
+            save_chat_history_cloud(user, bot["id"], history, start=start)
+        ctx = TurnContext(user, bot.get("name") or bot["id"], history, bot_text, bot.get("persona", ""),
+                          on_text=on_text, bot_id=bot["id"], history_start=start)
+        self.pipeline.run(ctx)
+        return ctx.turn
+
+
+_core = None
+_core_lock = threading.Lock()
+
+
+def get_core() -> ChatCore:
+    global _core
+    if _core is None:
+        with _core_lock:
+            if _core is None:
+                _core = _make_core()
+    return _core
+
+
+def set_core(core: ChatCore) -> None:
+    """Use `core` (e.g. one wired to fakes for a load test)."""
+    global _core
+    with _core_lock:
+        _core = core
+
+
+def _make_core() -> ChatCore:
+    from cache_tier import CacheTier, make_l2
+
+    api_key = _setting("GEMINI_API_KEY")
+    client = []
+
+    def client_getter():
+        if not api_key:
+            return None
+        if not client:
+            import google.genai as genai
+            client.append(genai.Client(api_key=api_key))
+        return client[0]
+
+    l2_url = _setting("CACHE_L2_URL")
+    shared = CacheTier(make_l2(l2_url), l1_size=int(os.getenv("CACHE_L1_SIZE", "512"))) if l2_url else None
+    scheduler = FairScheduler.from_env()
+    metrics.register_collector(scheduler.gauges)
+    metrics.register_collector(live_index_gauges)
+    return ChatCore(client_getter, shared=shared, scheduler=scheduler,
+                    index_cache_size=int(os.getenv("INDEX_CACHE_SIZE", "32")))
+
+
+# =========================================================
+# 🌐 Handlers
+# =========================================================
+_conversation_locks = weakref.WeakValueDictionary()   # (user, bot_id) -> asyncio.Lock
+
+
+def _conversation_lock(user, bot_id) -> asyncio.Lock:
+    # one message at a time per conversation (history is read-modify-write)
+    lock = _conversation_locks.get((user, bot_id))
+    if lock is None:
+        lock = _conversation_locks[(user, bot_id)] = asyncio.Lock()
+    return lock
+
+
+def _bearer(request) -> str:
+    auth = request.headers.get("authorization", "")
+    return auth[7:].strip() if auth.lower().startswith("bearer ") else ""
+
+
+def _require_user(request: Request) -> str:
+    user = check_token(_bearer(request))
+    if not user:
+        raise HTTPException(401, "Invalid or expired token.")
+    return user
+
+
+async def _json_body(request: Request) -> dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise HTTPException(400, "Body must be JSON.")
+    if not isinstance(body, dict):
+        raise HTTPException(400, "Body must be a JSON object.")
+    return body
+
+
+def _message(body: dict) -> tuple:
+    """(text, client_id) from a message body."""
+    text = str(body.get("text") or "").strip()
+    if not text:
+        raise HTTPException(400, "Empty message.")
+    if len(text) > MAX_MESSAGE_CHARS:
+        raise HTTPException(413, f"Message longer than {MAX_MESSAGE_CHARS} characters.")
+    client_id = body.get("client_id")
+    if client_id is not None and (not isinstance(client_id, str) or not 0 < len(client_id) <= 64):
+        raise HTTPException(400, "client_id must be a string of 1-64 characters.")
+    return text, client_id
+
+
+async def _load_bot(user, bot_id) -> dict:
+    bot = await asyncio.to_thread(get_bot, user, bot_id)
+    if not bot:
+        raise HTTPException(404, "Unknown bot.")
+    return bot
+
+
+async def _turn_events(user, bot, text, client_id=None):
+    """
+    ("token", delta) events while the reply streams, then ("done", turn) or
+    ("error", message). The pipeline runs on a worker thread; its on_text
+    callback hops back onto the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    sent = ""
+
+    def on_text(accumulated):
+        loop.call_soon_threadsafe(queue.put_nowait, ("text", accumulated))
+
+    async def work():
+        try:
+            turn = await asyncio.to_thread(get_core().send, user, bot, text, on_text, client_id)
+            queue.put_nowait(("done", turn))
+        except QuotaExceeded as e:
+            queue.put_nowait(("error", str(e)))
+        except Exception as e:
+            metrics.inc("api.errors")
+            queue.put_nowait(("error", f"{type(e).__name__}: {e}"))
+
+    async with _conversation_lock(user, bot["id"]):
+        task = asyncio.create_task(work())
+        try:
+            while True:
+                kind, value = await queue.get()
+                if kind == "text":
+                    # accumulated text -> delta (a shared reply arrives whole)
+                    delta = value[len(sent):] if value.startswith(sent) else value
+                    sent = value
+                    if delta:
+                        yield "token", delta
+                    continue
+                if kind == "done" and value.get("bot", "").startswith(sent) and value["bot"] != sent:
+                    yield "token", value["bot"][len(sent):]   # non-streaming client / cached reply
+                yield kind, value
+                return
+        finally:
+            # a disconnected client doesn't cancel the turn: it finishes and is saved
+            await asyncio.shield(task)
+
+
+def _sse(kind, value) -> str:
+    data = {"text": value} if kind == "token" else ({"error": value} if kind == "error" else value)
+    return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def login(request: Request):
+    body = await _json_body(request)
+    username = str(body.get("username") or "").strip()
+    password = str(body.get("password") or "")
+    if not username or not password:
+        raise HTTPException(400, "Enter both fields.")
+    if not await asyncio.to_thread(login_user, username, password):
+        metrics.inc("api.login_failed")
+        raise HTTPException(401, "Invalid credentials.")
+    return JSONResponse({"token": make_token(username), "username": username})
+
+
+async def list_bots(request: Request):
+    user = _require_user(request)
+    bots = await asyncio.to_thread(get_user_bots, user)
+    return JSONResponse({"bots": [{"id": b["id"], "name": b["name"], "persona": b.get("persona", "")}
+                                  for b in bots or []]})
+
+
+async def history(request: Request):
+    user = _require_user(request)
+    bot_id = request.path_params["bot_id"]
+    try:
+        limit = min(max(int(request.query_params.get("limit", 50)), 1), 500)
+        before = request.query_params.get("before")
+        before = int(before) if before not in (None, "") else None
+    except ValueError:
+        raise HTTPException(400, "limit and before must be integers.")
+    page = await asyncio.to_thread(load_history_page, user, bot_id, limit, before)
+    return JSONResponse(page)
+
+
+async def send_message(request: Request):
+    user = _require_user(request)
+    text, client_id = _message(await _json_body(request))
+    bot = await _load_bot(user, request.path_params["bot_id"])
+    metrics.inc("api.messages")
+
+    if request.query_params.get("stream") == "0":
+        result = {}
+        async for kind, value in _turn_events(user, bot, text, client_id):
+            result[kind] = value
+        if "error" in result:
+            return JSONResponse({"error": result["error"]}, status_code=503)
+        return JSONResponse(result["done"])
+
+    async def events():
+        async for kind, value in _turn_events(user, bot, text, client_id):
+            yield _sse(kind, value)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def chat_socket(websocket: WebSocket):
+    user = check_token(websocket.query_params.get("token") or _bearer(websocket))
+    if not user:
+        await websocket.close(code=4401)
+        return
+    bot = await asyncio.to_thread(get_bot, user, websocket.path_params["bot_id"])
+    if not bot:
+        await websocket.close(code=4404)
+        return
+    await websocket.accept()
+    try:
+        while True:
+            try:
+                body = await websocket.receive_json()
+                if not isinstance(body, dict):
+                    raise ValueError("not an object")
+                text, client_id = _message(body)
+            except (HTTPException, ValueError) as e:
+                await websocket.send_json({"type": "error", "error": getattr(e, "detail", "Bad message.")})
+                continue
+            metrics.inc("api.messages")
+            async for kind, value in _turn_events(user, bot, text, client_id):
+                if kind == "token":
+                    await websocket.send_json({"type": "token", "text": value})
+                elif kind == "error":
+                    await websocket.send_json({"type": "error", "error": value})
+                else:
+                    await websocket.send_json({"type": "done", "turn": value})
+    except WebSocketDisconnect:
+        pass
+
+
+async def healthz(request: Request):
+    return JSONResponse({"ok": True})
+
+
+async def prometheus(request: Request):
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
+async def http_error(request, exc):
+    return JSONResponse({"error": exc.detail}, status_code=exc.status_code)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # model / storage calls block a worker thread each; size the pool for
+    # concurrent chats rather than CPU count
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(API_THREADS, thread_name_prefix="chatdouble-api"))
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route("/api/login", login, methods=["POST"]),
+        Route("/api/bots", list_bots),
+        Route("/api/bots/{bot_id}/history", history),
+        Route("/api/bots/{bot_id}/messages", send_message, methods=["POST"]),
+        WebSocketRoute("/api/bots/{bot_id}/ws", chat_socket),
+        Route("/healthz", healthz),
+        Route("/metrics", prometheus),
+    ],
+    exception_handlers={HTTPException: http_error},
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import uvicorn
+
+    ap = argparse.ArgumentParser(description="ChatDouble chat API")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    args = ap.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port)
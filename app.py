@@ -1,37 +1,72 @@
 # app.py — complete copy-paste replacement
 import os
 import json
+import uuid
 import base64
-from datetime import datetime
 
 import streamlit as st
-from sentence_transformers import SentenceTransformer
-import faiss
-
-# Use the same import shape you used earlier:
-import google.genai as genai
 
+# NOTE: sentence_transformers / faiss / google.genai / firebase are heavy and
+# are imported lazily (retrieval.py, get_genai_client, firebase_config.get_db)
+# so the login page renders without loading them.
 
 # firebase_db functions you already have in project:
 from firebase_db import (
-    get_user_bots, add_bot, delete_bot, update_bot, update_bot_persona,
-    register_user, login_user, get_bot_file,
-    save_chat_history_cloud, load_chat_history_cloud
+    get_user_bots, delete_bot, update_bot, update_bot_persona,
+    register_user, login_user, get_bot, add_bot_limited, load_chat_view,
+    save_chat_history_cloud, load_history_page, clear_history, gc_sweep
 )
+import firebase_db
+from export import EXPORT_FORMATS, MIME_TYPES, export_bytes, export_history
+from cache_tier import CacheTier, make_l2
+from ingest import append_export, extract_bot_lines
+from query_cache import QueryCache
+from retrieval import build_index, get_embed_model, live_index_gauges
+from pipeline import GenerationPipeline, TurnContext, is_double_send, new_turn
+from prefetch import Prefetcher
+from session_history import HISTORY_WINDOW, SessionHistories
+from scheduler import BACKGROUND, FairScheduler, QuotaExceeded, estimate_tokens
+from warmup import start_warmup, warmup_report
+from cleanup import last_gc_report, start_gc_thread
+import metrics
 
 # ---------------------------
 # Page config + Gemini client
 # ---------------------------
 st.set_page_config(page_title="ChatDouble", page_icon="🤖", layout="wide")
 API_KEY = os.getenv("GEMINI_API_KEY") or (st.secrets.get("GEMINI_API_KEY") if st.secrets else None)
-if not API_KEY:
-    # app should still load if missing key — show warning later where generation happens
-    genai_client = None
-else:
-    genai_client = genai.Client(api_key=API_KEY)
+
+
+@st.cache_resource(show_spinner=False)
+def get_genai_client():
+    """
+    Create the Gemini client on first use (google.genai is slow to import).
+    Returns None if no key — app should still load, warning shown where generation happens.
+    """
+    if not API_KEY:
+        return None
+    import google.genai as genai
+    return genai.Client(api_key=API_KEY)
 
 os.makedirs("chats", exist_ok=True)
 
+# Prometheus scrape endpoint on its own port (Streamlit can't add routes)
+METRICS_PORT = os.getenv("METRICS_PORT") or (st.secrets.get("METRICS_PORT") if st.secrets else None)
+if METRICS_PORT:
+    try:
+        metrics.start_metrics_server(int(METRICS_PORT))
+    except OSError:
+        pass  # already bound by another process on this node
+# periodic orphan sweep (stored chats + persisted index files), off by default
+GC_INTERVAL = os.getenv("CHATDOUBLE_GC_INTERVAL")
+if GC_INTERVAL:
+    start_gc_thread(float(GC_INTERVAL), sweep=gc_sweep)
+ADMIN_USERS = {
+    u.strip().lower()
+    for u in (os.getenv("ADMIN_USERS") or (st.secrets.get("ADMIN_USERS", "") if st.secrets else "")).split(",")
+    if u.strip()
+}
+
 
 # ---------------------------
 # CSS: WhatsApp-like + remove streamlit header/footer
@@ -156,43 +191,16 @@ button.send-btn { background:#25D366; color:#000; border:none; padding:10px 14px
 
 
 # ---------------------------
-# Helpers: text extraction, persona, FAISS
+# Helpers: persona, FAISS
 # ---------------------------
-def extract_bot_lines(raw_text, bot_name):
-    """
-    Extract only that person's messages from WhatsApp-style chat exports.
-    Supports formats like:
-    12/04/2023, 5:22 pm - Raykay: message
-    """
-    bot_lines = []
-    name_lower = bot_name.strip().lower()
-
-    for line in raw_text.splitlines():
-        if "-" not in line or ":" not in line:
-            continue
-
-        try:
-            # Example: "12/04/2023, 5:22 pm - Raykay: Hello"
-            meta, msg = line.split("-", 1)
-            speaker, content = msg.split(":", 1)
-            speaker = speaker.strip().lower()
-            content = content.strip()
-        except:
-            continue
-
-        if speaker == name_lower and len(content.split()) > 1:
-            # remove emojis or keep? keep them.
-            bot_lines.append(content)
-
-    return "\n".join(bot_lines)
-
-
-def generate_persona(text_examples: str) -> str:
+def generate_persona(text_examples: str, user: str = "") -> str:
     """
     Ask Gemini for a short persona description.
     Keep temperature low for deterministic output.
-    Tolerant if no genai client is configured.
+    Tolerant if no genai client is configured; counts as background work
+    against `user`'s quota (QuotaExceeded is raised, not swallowed).
     """
+    genai_client = get_genai_client()
     if not text_examples or not genai_client:
         return ""
     prompt = f"""Take these example messages from a single person and write a 1-2 sentence persona description capturing their tone, slang, and typical phrases.
@@ -203,36 +211,141 @@ Examples:
 Return only the short persona description.
 """
     try:
-        resp = genai_client.models.generate_content(
-            model="gemini-2.0-flash-exp",
-            contents=prompt,
-            options={"temperature": 0.2, "max_output_tokens": 120}
-        )
+        with get_scheduler().slot(user, BACKGROUND, tokens=estimate_tokens(prompt)):
+            resp = genai_client.models.generate_content(
+                model="gemini-2.0-flash-exp",
+                contents=prompt,
+                options={"temperature": 0.2, "max_output_tokens": 120}
+            )
+        metrics.record_token_usage(resp, "gemini-2.0-flash-exp")
         # support dict-like and object-like responses
         if isinstance(resp, dict):
             text = resp.get("message", {}).get("content", "") or ""
         else:
             text = getattr(resp, "text", None) or str(resp)
         return text.strip().splitlines()[0][:240]
+    except QuotaExceeded:
+        raise
     except Exception:
         return ""
 
 
 @st.cache_resource(show_spinner=False)
-def build_faiss_for_bot(bot_text: str):
+def get_scheduler():
+    """
+    Process-wide fair scheduler for Gemini calls and encoder passes:
+    SCHED_SLOTS calls at once, per-user quotas from CHAT_RPM / CHAT_TPM
+    (chat) and INGEST_RPM (uploads, index builds).
+    """
+    sched = FairScheduler.from_env()
+    metrics.register_collector(sched.gauges)
+    return sched
+
+
+# shared cache tier across replicas: redis://host:6379/0 or a shared directory
+CACHE_L2_URL = os.getenv("CACHE_L2_URL") or (st.secrets.get("CACHE_L2_URL") if st.secrets else None)
+
+
+@st.cache_resource(show_spinner=False)
+def get_cache_tier():
+    """
+    Process-wide L1 + shared L2 for indexes, query embeddings and replies.
+    None when CACHE_L2_URL isn't set (single replica: the local caches suffice).
+    """
+    if not CACHE_L2_URL:
+        return None
+    tier = CacheTier(make_l2(CACHE_L2_URL), l1_size=int(os.getenv("CACHE_L1_SIZE", "512")))
+    metrics.register_collector(tier.gauges)
+    return tier
+
+
+@st.cache_resource(show_spinner=False, max_entries=int(os.getenv("INDEX_CACHE_SIZE", "32")))
+def build_faiss_for_bot(bot_text: str, _user: str = ""):
+    """
+    Returns the retrieval.BotIndex (FAISS + BM25 + lines).
+    Cached per content string, so every user's bot with the same corpus gets
+    the same object; persisted under indexes/ across restarts and shared
+    with the other replicas through the cache tier. An actual encoder pass
+    (only for lines no corpus had before) is background work on _user's
+    quota (not part of the cache key).
+    """
+    metrics.register_collector(live_index_gauges)
+    return build_index(bot_text, shared=get_cache_tier(),
+                       admit=lambda lines: get_scheduler().slot(_user, BACKGROUND, tokens=estimate_tokens(lines)))
+
+
+@st.cache_resource(show_spinner=False)
+def get_prefetcher():
+    """
+    Process-wide background warm-up of a user's bots (document, index) on
+    login and in the Chat tab, so the first send doesn't build the index. None with CHATDOUBLE_PREFETCH=0.
+    """
+    if os.getenv("CHATDOUBLE_PREFETCH", "1") == "0":
+        return None
+    tier, sched = get_cache_tier(), get_scheduler()
+    prefetcher = Prefetcher(
+        firebase_db,
+        index_for=lambda bot_text, admit: build_index(bot_text, shared=tier, admit=admit),
+        admit=lambda user, lines: sched.slot(user, BACKGROUND, tokens=estimate_tokens(lines)),
+        threads=int(os.getenv("PREFETCH_THREADS", "2")),
+        max_entries=int(os.getenv("INDEX_CACHE_SIZE", "32")),
+    )
+    metrics.register_collector(prefetcher.gauges)
+    return prefetcher
+
+
+def session_id() -> str:
+    """Stable id for this browser session (one prefetch job each)."""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    return st.session_state.session_id
+
+
+def session_histories(user: str) -> SessionHistories:
+    """This session's bounded chat histories (a fresh set when the user changes)."""
+    histories = st.session_state.get("histories")
+    if histories is None or histories.user != user:
+        histories = st.session_state.histories = SessionHistories(user)
+    return histories
+
+
+def prefetch_bots(user: str, bot_ids=None):
+    """Start (or keep) warming user's bots in the background; returns the prefetcher or None."""
+    prefetcher = get_prefetcher()
+    if prefetcher is not None:
+        prefetcher.start(session_id(), user, bot_ids)
+    return prefetcher
+
+
+@st.cache_resource(show_spinner=False)
+def get_query_cache():
+    """
+    Process-wide query cache (shared across sessions).
+    Sizes can be tuned with QUERY_CACHE_SIZE / QUERY_RESULT_CACHE_SIZE.
+    """
+    cache = QueryCache(
+        embed_size=int(os.getenv("QUERY_CACHE_SIZE", "2048")),
+        result_size=int(os.getenv("QUERY_RESULT_CACHE_SIZE", "4096")),
+        shared=get_cache_tier(),
+    )
+    metrics.register_collector(cache.gauges)
+    return cache
+
+
+@st.cache_resource(show_spinner=False)
+def get_pipeline():
     """
-    Returns (embed_model, faiss_index, bot_lines list)
-    Cached per content string.
+    One generation pipeline per process (shared so turn IDs are claimed once
+    across all sessions).
     """
-    bot_lines = [line.strip() for line in bot_text.splitlines() if line.strip()]
-    if not bot_lines:
-        # minimal fallback: single placeholder
-        bot_lines = ["hello"]
-    embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-    embeddings = embed_model.encode(bot_lines, convert_to_numpy=True)
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
-    return embed_model, index, bot_lines
+    return GenerationPipeline(
+        index_for=build_faiss_for_bot,
+        query_cache=get_query_cache(),
+        client_getter=get_genai_client,
+        persist=save_chat_history_cloud,
+        shared=get_cache_tier(),
+        scheduler=get_scheduler(),
+    )
 
 
 # ---------------------------
@@ -275,6 +388,7 @@ with st.sidebar:
                     if ok:
                         st.session_state.logged_in = True
                         st.session_state.username = username_input
+                        prefetch_bots(username_input)
                         st.success(f"Welcome, {username_input}!")
                         st.rerun()
                     else:
@@ -292,6 +406,8 @@ with st.sidebar:
     else:
         st.markdown(f"👋 Logged in as **{st.session_state.username}**")
         if st.button("Logout"):
+            if get_prefetcher() is not None:
+                get_prefetcher().cancel(session_id())
             st.session_state.logged_in = False
             st.session_state.username = ""
             st.rerun()
@@ -330,6 +446,7 @@ if not st.session_state.logged_in:
                 if login_user(h_user, h_pass):
                     st.session_state.logged_in = True
                     st.session_state.username = h_user
+                    prefetch_bots(h_user)
                     st.success("Logged in.")
                     st.rerun()
                 else:
@@ -346,11 +463,20 @@ if not st.session_state.logged_in:
 
 else:
     # Authenticated view: hide Home, show main app
-    tabs = st.tabs(["💬 Chat", "🧰 Manage Bots", "🍭 Buy Lollipop"])
+    is_admin = st.session_state.username.strip().lower() in ADMIN_USERS
+    tab_names = ["💬 Chat", "🧰 Manage Bots", "🍭 Buy Lollipop"]
+    if is_admin:
+        tab_names.append("📊 Metrics")
+    tabs = st.tabs(tab_names)
 # ----- Chat tab -----
     with tabs[0]:
         user = st.session_state.username
-        user_bots = get_user_bots(user)
+        histories = session_histories(user)
+        # bot list + selected bot + its newest turns in one concurrent round
+        # trip (no history read at all once this session holds them)
+        history_limit = 0 if histories.get(st.session_state.get("chat_selected_bot")) else HISTORY_WINDOW
+        view = load_chat_view(user, st.session_state.get("chat_selected_bot"), history_limit=history_limit)
+        user_bots = view["bots"]
 
         if not user_bots:
             st.info("No bots yet. Create one in Manage Bots tab.")
@@ -370,26 +496,47 @@ else:
 
             # Left side main chat
             with col_main:
-                selected_bot = st.selectbox("Select bot", [b["name"] for b in user_bots], key="chat_selected_bot")
+                # select by stable id (survives renames), show the display name
+                bot_names = {b["id"]: b["name"] for b in user_bots}
+                selected_id = st.selectbox(
+                    "Select bot", list(bot_names), key="chat_selected_bot",
+                    format_func=lambda bid: bot_names.get(bid, bid),
+                )
+                selected_bot = bot_names[selected_id]
 
-                # Load bot file
-                res = get_bot_file(user, selected_bot)
-                if isinstance(res, (list, tuple)):
-                    bot_text = res[0]
-                    persona = res[1] if len(res) > 1 else ""
-                else:
-                    bot_text = res
-                    persona = ""
+                # Load bot file (already fetched unless the selection just changed)
+                prefetched = view["bot"] is not None and view["bot"]["id"] == selected_id
+                bot = view["bot"] if prefetched else (get_bot(user, selected_id) or {})
+                bot_text = bot.get("file_text", "")
+                persona = bot.get("persona", "")
 
                 if not bot_text.strip():
                     st.warning("Bot has no data.")
                     st.stop()
 
-                embed_model, index, bot_lines = build_faiss_for_bot(bot_text)
+                # warm this bot's index (then the others) in the background so
+                # neither this render nor the first send waits on it
+                prefetcher = get_prefetcher()
+                warmed = prefetcher.entry(user, selected_id, bot_text) if prefetcher else None
+                try:
+                    if prefetcher is None:
+                        build_faiss_for_bot(bot_text, _user=user)
+                    elif warmed is not None and isinstance(warmed.error, QuotaExceeded):
+                        prefetcher.forget(user, selected_id)   # retried on the next rerun
+                        raise warmed.error
+                except QuotaExceeded as e:
+                    st.warning(f"Too many bots being indexed right now — try again in {e.retry_after:.0f}s.")
+                    st.stop()
+                prefetch_bots(user, [selected_id] + [b["id"] for b in user_bots if b["id"] != selected_id])
 
-                chat_key = f"chat_{selected_bot}_{user}"
-                if chat_key not in st.session_state:
-                    st.session_state[chat_key] = load_chat_history_cloud(user, selected_bot) or []
+                first_sent = st.session_state.setdefault("first_sent_bots", set())
+                window = histories.get(selected_id)
+                if window is None:
+                    if prefetched and history_limit:
+                        window = histories.open(selected_id, view["history"], view["history_start"])
+                    else:
+                        page = load_history_page(user, selected_id, limit=HISTORY_WINDOW)
+                        window = histories.open(selected_id, page["turns"], page["before"] or 0)
 
                 # Header
                 st.markdown(
@@ -401,7 +548,10 @@ else:
                 # CHAT CARD
                 from streamlit.components.v1 import html as components_html
 
-                messages = st.session_state[chat_key]
+                if window.has_older and st.button(f"⬆️ Load older messages ({window.start} more)",
+                                                  key=f"older_{selected_id}"):
+                    window.load_older(load_history_page, user)
+                messages = window.turns
 
                 # Convert to a simpler format for JS
                 clean_history = []
@@ -594,86 +744,20 @@ else:
 
 
                 if send and user_msg.strip():
-                    ts = datetime.now().strftime("%I:%M %p")
-                    st.session_state[chat_key].append({"user": user_msg, "bot": "", "ts": ts})
-                    save_chat_history_cloud(user, selected_bot, st.session_state[chat_key])
-
-                    # Retrieval
-                    vec = embed_model.encode([user_msg])
-                    _, idxs = index.search(vec, k=20)
-                    retrieved = "\n".join([bot_lines[i] for i in idxs[0] if i < len(bot_lines)])[:2000]
-                    
-                    # === Build recent history (all messages in this chat) ===
-                    history_lines = []
-                    for entry in st.session_state.get(chat_key, []):
-                        if "user" in entry:
-                            history_lines.append(f"User: {entry['user']}")
-                        if "bot" in entry:
-                            history_lines.append(f"{selected_bot}: {entry['bot']}")
-
-                    recent_history = "\n".join(history_lines)
-                    if len(recent_history) > 4000:
-                        recent_history = recent_history[-4000:]
-
-                    # Limit retrieved examples for safety
-                    retrieved_examples = retrieved or ""
-                    if len(retrieved_examples) > 3000:
-                        retrieved_examples = retrieved_examples[:3000]
-
-                    persona_block = f"Persona: {persona}\n\n" if persona else ""
-
-                    prompt = f"""{persona_block}
-You are a real person (not an AI) who previously chatted with the user.
-
-RULES:
-1) Use all facts found in the 'Recent conversation' below. Do NOT contradict them.
-2) Detect your real name from the examples (the text before ":" in the examples). 
-Do NOT invent names or placeholders like {{User's Name}}.
-3) If persona above is empty, infer a personality from the examples & stick to it.
-4) If you don't know a fact, ask — don't assume.
-STRICT RULES:
-- NEVER use placeholders like [User], [User's Name], {user}, <name>, or anything inside {{}}, [], <>.
-- NEVER guess names. ONLY use names that actually exist inside the real chat data.
-- If you do NOT know a name from the real examples, say “I don’t know, you never told me.”
-- NEVER invent formatting like **bold**, __underline__, *, ~, or any markdown.
-- NEVER use too many emojis in a reply, use them as same frequency in chat. Keep it natural, not exaggerated and hallucinated.
-- NEVER talk like an assistant or narrator. Just speak casually like in the chat data.
-
---- Recent conversation ---
-{recent_history}
-
---- Examples from real exported chat ---
-{retrieved_examples}
-
-Continue the conversation naturally, same tone and slang.
-
-User: {user_msg}
-{selected_bot}:
-"""
-
-
-
-                    reply = "..."
-
-                    try:
-                        resp = genai_client.models.generate_content(
-                            model="gemini-2.0-flash-exp",
-                            contents=prompt
-                        )
-                        reply = getattr(resp, "text", None) or (resp.get("message", {}).get("content", "") if isinstance(resp, dict) else "") or "⚠️Offline (Text after sometime)"
-                    except Exception:
-                        try:
-                            resp = genai_client.models.generate_content(
-                                model="gemini-2.0-flash",
-                                contents=prompt
-                            )
-                            reply = getattr(resp, "text", None) or (resp.get("message", {}).get("content", "") if isinstance(resp, dict) else "") or "⚠️Offline (Text after sometime)"
-                        except Exception as e:
-                            reply = f"⚠️Offline (Try after sometime): {e}"
+                    if selected_id not in first_sent:
+                        first_sent.add(selected_id)
+                        if prefetcher is not None:
+                            prefetcher.first_send(user, selected_id)   # records prefetch.time_saved
+                    if is_double_send(window.turns, user_msg):
+                        metrics.inc("chat.double_send")   # same turn again: join it below
+                    else:
+                        histories.add_turn(selected_id, new_turn(user_msg))
+                        window.save(save_chat_history_cloud, user)
 
-                    st.session_state[chat_key][-1]["bot"] = reply
-                    st.session_state[chat_key][-1]["ts"] = datetime.now().strftime("%I:%M %p")
-                    save_chat_history_cloud(user, selected_bot, st.session_state[chat_key])
+                    # retrieve -> rerank -> assemble -> generate -> persist (single-flight per turn id)
+                    get_pipeline().run(TurnContext(user, selected_bot, window.turns, bot_text, persona,
+                                                   bot_id=selected_id, history_start=window.start))
+                    histories.settle(selected_id)
 
                     # mark that input must be cleared on next rerun (safe)
                     st.session_state["pending_clear"] = True
@@ -702,18 +786,30 @@ User: {user_msg}
             elif (not up_file) or (not up_name.strip()):
                 st.error("Please provide both file and name.")
             else:
-                raw = up_file.read().decode("utf-8", "ignore")
-                bot_lines = extract_bot_lines(raw, up_name)
-                if not bot_lines.strip():
-                    # fallback to storing longer lines
-                    bot_lines = "\n".join([l for l in raw.splitlines() if len(l.split()) > 1])
-                persona = generate_persona("\n".join(bot_lines.splitlines()[:40]))
-                try:
-                    add_bot(user, up_name.capitalize(), bot_lines, persona=persona)
+                with metrics.trace("upload", bot=up_name):
+                    raw = up_file.read().decode("utf-8", "ignore")
+                    metrics.inc("upload.bytes", len(raw))
+                    with metrics.span("upload.extract"):
+                        bot_lines = extract_bot_lines(raw, up_name)
+                    if not bot_lines.strip():
+                        # fallback to storing longer lines
+                        bot_lines = "\n".join([l for l in raw.splitlines() if len(l.split()) > 1])
+                    try:
+                        with metrics.span("upload.persona"):
+                            persona = generate_persona("\n".join(bot_lines.splitlines()[:40]), user)
+                        # limit re-checked transactionally (two tabs uploading at once)
+                        added = add_bot_limited(user, up_name.capitalize(), bot_lines, persona=persona) is not None
+                        if not added:
+                            st.error("You already have 2 bots. Delete one first.")
+                    except QuotaExceeded as e:
+                        added = False
+                        st.error(f"Too many uploads — try again in {e.retry_after:.0f}s.")
+                    except Exception as e:
+                        added = False
+                        st.error(f"Upload error: {e}")
+                if added:
                     st.success(f"Added {up_name} — persona: {persona or '—'}")
                     st.rerun()
-                except Exception as e:
-                    st.error(f"Upload error: {e}")
     
         st.markdown("</div>", unsafe_allow_html=True)
     
@@ -730,11 +826,11 @@ User: {user_msg}
             st.markdown(f"**{b['name']}** : {b.get('persona','—')}")
             rn, dlt, clr = st.columns([1,1,1])
             with rn:
-                new_name = st.text_input(f"Rename {b['name']}", key=f"rename_{b['name']}")
-                if st.button("Rename", key=f"rename_btn_{b['name']}"):
+                new_name = st.text_input(f"Rename {b['name']}", key=f"rename_{b['id']}")
+                if st.button("Rename", key=f"rename_btn_{b['id']}"):
                     if new_name.strip():
                         try:
-                            update_bot(user, b['name'], new_name.strip())
+                            update_bot(user, b['id'], new_name.strip())
                             st.success("Renamed.")
                             st.rerun()
                         except Exception as e:
@@ -742,20 +838,67 @@ User: {user_msg}
                     else:
                         st.error("Enter a new name.")
             with dlt:
-                if st.button("Delete", key=f"del_{b['name']}"):
+                if st.button("Delete", key=f"del_{b['id']}"):
                     try:
-                        delete_bot(user, b['name'])
-                        st.warning("Deleted.")
+                        report = delete_bot(user, b['id'])
+                        session_histories(user).drop(b['id'])
+                        st.warning(f"Deleted ({report['bytes_reclaimed'] // 1024} KB freed).")
                         st.rerun()
                     except Exception as e:
                         st.error(f"Delete error: {e}")
             with clr:
-                if st.button("Clear history", key=f"clr_{b['name']}"):
+                if st.button("Clear history", key=f"clr_{b['id']}"):
                     try:
-                        save_chat_history_cloud(user, b['name'], [])
+                        clear_history(user, b['id'])
+                        session_histories(user).drop(b['id'])
                         st.success("History cleared.")
                     except Exception as e:
                         st.error(f"Clear error: {e}")
+            with st.expander(f"Add newer messages to {b['name']}"):
+                st.markdown("<div class='small-muted'>Upload a newer export of the same chat. "
+                            "Only messages the bot doesn't have yet are added.</div>", unsafe_allow_html=True)
+                add_file = st.file_uploader("Choose .txt file", type=["txt"], key=f"append_file_{b['id']}")
+                speaker = st.text_input("Their name in the export", value=b['name'], key=f"append_name_{b['id']}")
+                if st.button("Add messages", key=f"append_btn_{b['id']}"):
+                    if not add_file:
+                        st.error("Choose a file first.")
+                    else:
+                        try:
+                            with metrics.trace("append_export", bot=b['name']):
+                                raw = add_file.read().decode("utf-8", "ignore")
+                                metrics.inc("upload.bytes", len(raw))
+                                report = append_export(
+                                    user, b['id'], raw, speaker=speaker.strip() or b['name'],
+                                    shared=get_cache_tier(),
+                                    admit=lambda lines: get_scheduler().slot(
+                                        user, BACKGROUND, tokens=estimate_tokens(lines)))
+                            if report["new"]:
+                                st.success(f"Added {report['new']} new messages "
+                                           f"({report['skipped']} already there).")
+                            else:
+                                st.info(f"Nothing new — all {report['parsed']} messages are already there.")
+                        except QuotaExceeded as e:
+                            st.error(f"Too many uploads — try again in {e.retry_after:.0f}s.")
+                        except Exception as e:
+                            st.error(f"Append error: {e}")
+            with st.expander(f"Export {b['name']} history"):
+                fmt = st.radio("Format", EXPORT_FORMATS, horizontal=True, key=f"exp_fmt_{b['id']}")
+                c1, c2 = st.columns(2)
+                first = c1.number_input("From turn", min_value=1, value=1, key=f"exp_from_{b['id']}")
+                last = c2.number_input("To turn (0 = last)", min_value=0, value=0, key=f"exp_to_{b['id']}")
+                dates = st.date_input("Only these dates (optional)", value=(), key=f"exp_dates_{b['id']}")
+                filters = {"start": int(first) - 1, "end": int(last) or None}
+                if len(dates) == 2:
+                    filters.update(since=dates[0], until=dates[1])
+                # generated on click, page by page, off the script thread
+                st.download_button(
+                    f"Download .{fmt}",
+                    data=lambda bid=b['id'], name=b['name'], fmt=fmt, filters=filters: export_bytes(
+                        export_history(user, bid, fmt, bot_name=name, **filters)),
+                    file_name=f"{b['name']}_history.{fmt}",
+                    mime=MIME_TYPES[fmt],
+                    key=f"exp_btn_{b['id']}",
+                )
     
     
     # ----- Buy Lollipop tab -----
@@ -775,194 +918,107 @@ User: {user_msg}
         st.markdown(f"<h4>UPI ID: <code>{upi_id}</code></h4>", unsafe_allow_html=True)
 
         st.markdown("</div>", unsafe_allow_html=True)
+
+    # ----- Metrics tab (ADMIN_USERS only) -----
+    if is_admin:
+        with tabs[3]:
+            snap = metrics.snapshot()
+            st.markdown("<div class='card'><h4>Latency per stage</h4><div class='small-muted'>"
+                        "p50 / p95 / p99 over recent samples, in ms</div></div>", unsafe_allow_html=True)
+            st.dataframe(
+                [
+                    {"stage": name, "count": row["count"],
+                     "p50": round(row["p50"] * 1000, 1), "p95": round(row["p95"] * 1000, 1),
+                     "p99": round(row["p99"] * 1000, 1)}
+                    for name, row in snap["timings"].items()
+                ],
+                use_container_width=True,
+            )
+            mc1, mc2 = st.columns(2)
+            with mc1:
+                st.markdown("**Counters**")
+                st.json(snap["counters"])
+            with mc2:
+                st.markdown("**Caches**")
+                st.json(snap["gauges"])
+                st.markdown("**Warm-up (s)**")
+                st.json(warmup_report())
+            st.download_button("Download Prometheus metrics", metrics.render_prometheus(),
+                               file_name="chatdouble_metrics.prom", mime="text/plain")
+            if METRICS_PORT:
+                st.caption(f"Scrape endpoint: :{METRICS_PORT}/metrics (JSON: /metrics.json)")
+
+            st.markdown("<div class='card'><h4>Storage cleanup</h4><div class='small-muted'>"
+                        "Orphaned chat histories and unused index files</div></div>", unsafe_allow_html=True)
+            g1, g2 = st.columns(2)
+            with g1:
+                if st.button("Dry run", key="gc_dry_run"):
+                    st.json(gc_sweep(dry_run=True))
+            with g2:
+                if st.button("Run GC sweep", key="gc_run"):
+                    st.json(gc_sweep())
+            if last_gc_report():
+                st.caption("Last scheduled sweep:")
+                st.json(last_gc_report())
     
     
 # ---------------------------
 # Final: keep consistent behavior
 # ---------------------------
-# If user pressed Send inside Chat tab, we appended "...thinking" and re-ran.
-# Now, handle streaming generation (separate block that runs after rerun).
-# We detect any chat entries that have bot == "...thinking" and generate for them.
+# The Send button runs the pipeline inline. This picks up any turn that is still
+# pending (bot == "") after a rerun interrupted it, via the same idempotent pipeline.
 def process_pending_generation():
     # Only meaningful when logged in and chat selected
     if not st.session_state.logged_in:
         return
-    user = st.session_state.username
-    selected_key = None
-    # find any chat keys for this user that have a pending entry
-    for k in list(st.session_state.keys()):
-        if k.startswith("chat_") and k.endswith(f"_{user}"):
-            msgs = st.session_state[k]
-            if msgs and isinstance(msgs[-1], dict) and msgs[-1].get("bot") == "":
-                selected_key = k
-                break
-    if not selected_key:
-        return
-
-    # extract selected bot name
-    # format: chat_{bot}_{user}
-    try:
-        parts = selected_key.split("_")
-        # join middle parts as bot name might contain underscores
-        bot_name = "_".join(parts[1:-1])
-    except Exception:
+    histories = session_histories(st.session_state.username)
+    user = histories.user
+    # the pending index names the bots whose last turn awaits a reply, so no
+    # history is scanned or copied here
+    for bot_id in histories.pending_bots():
+        window = histories.get(bot_id)
+        pending = window.pending if window is not None else None
+        if pending is not None:
+            break
+        histories.settle(bot_id)
+    else:
         return
 
-    msgs = st.session_state[selected_key]
-    pending = msgs[-1]
     user_input = pending.get("user", "")
     if not user_input:
         # cleanup
-        msgs[-1]["bot"] = "⚠️ No user input found."
-        save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
+        pending["bot"] = "⚠️ No user input found."
+        pending["error"] = True
+        window.save(save_chat_history_cloud, user)
+        histories.settle(bot_id)
         return
 
     # prepare context using the bot file (if exists)
     try:
-        res = get_bot_file(user, bot_name)
-        if isinstance(res, (list, tuple)):
-            bot_text = res[0]
-            persona = res[1] if len(res) > 1 else ""
-        else:
-            bot_text = res or ""
-            persona = ""
+        bot = get_bot(user, bot_id) or {}
     except Exception:
-        bot_text = ""
-        persona = ""
+        bot = {}
+    bot_text = bot.get("file_text", "")
+    persona = bot.get("persona", "")
 
     if not bot_text:
         pending["bot"] = "⚠️ No bot source text available."
-        save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
+        pending["error"] = True
+        window.save(save_chat_history_cloud, user)
+        histories.settle(bot_id)
         return
 
-    # build FAISS (fast cached)
-    embed_model, index, bot_lines = build_faiss_for_bot(bot_text)
-    # retrieval for extra context
-    try:
-        qvec = embed_model.encode([user_input])
-        D, I = index.search(qvec, k=20)
-    except Exception:
-        I = [[]]
-    lines = []
-    if I is not None:
-        for idx in I[0]:
-            if idx < len(bot_lines):
-                candidate = bot_lines[idx].strip()
-                if len(candidate.split()) > 2:
-                    lines.append(candidate)
-    context = "\n".join(lines[:12])
-    if len(context) > 3000:
-        context = context[:3000]
-
-    persona_block = f"Persona: {persona}\n\n" if persona else ""
-    # === Build recent history ===
-    history_lines = []
-    for entry in msgs:
-        if "user" in entry:
-            history_lines.append(f"User: {entry['user']}")
-        if "bot" in entry:
-            history_lines.append(f"{bot_name}: {entry['bot']}")
-    
-    recent_history = "\n".join(history_lines)
-    if len(recent_history) > 4000:
-        recent_history = recent_history[-4000:]
-    
-    retrieved_examples = context or ""
-    if len(retrieved_examples) > 3000:
-        retrieved_examples = retrieved_examples[:3000]
-    
-    persona_block = f"Persona: {persona}\n\n" if persona else ""
-    
-    prompt = f"""{persona_block}
-You are a real human being who has chatted with this user before.
-
-RULES:
-1) The 'Recent conversation' below is absolute truth — do NOT contradict any facts.
-2) Determine your own real name from the examples (the text before ":"). 
-   The UI label '{bot_name}' is NOT your real name unless examples say so.
-3) If persona is empty, infer your personality from the examples and stick to it.
-4) NEVER produce placeholders like {{User's Name}}. Use only info you know.
-5) Your tone, slang, maturity, emotions must match the examples — not generic AI tone.
-STRICT RULES:
-- NEVER use placeholders like [User], [User's Name], {user}, <name>, or anything inside {{}}, [], <>.
-- NEVER guess names. ONLY use names that actually exist inside the real chat data.
-- If you do NOT know a name from the real examples, say “I don’t know, you never told me.”
-- NEVER invent formatting like **bold**, __underline__, *, ~, or any markdown.
-- NEVER use too many emojis in a reply, use them as same frequency in chat. Keep it natural, not exaggerated and hallucinated.
-- NEVER talk like an assistant or narrator. Just speak casually like in the chat data.
-
---- Recent conversation ---
-{recent_history}
-
---- Real chat examples from export ---
-{retrieved_examples}
-
-Continue naturally.
-
-User: {user_input}
-{bot_name}:
-"""
-
-
-    # generate (stream if possible)
-    if not genai_client:
-        pending["bot"] = "⚠️ Gemini API key not set. Add GEMINI_API_KEY to environment or Streamlit secrets."
-        save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-        return
-
-    # choose model conservatively
-    model_name = "gemini-2.0-flash-exp"  # general model; change if you prefer flash versions
-    try:
-        # use streaming if available in your genai client
-        resp_iter = genai_client.models.generate_content_stream(model=model_name, contents=prompt)
-    except Exception:
-        # fallback to single-shot
-        try:
-            resp = genai_client.models.generate_content(model=model_name, contents=prompt)
-            # extract text
-            if isinstance(resp, dict):
-                text = resp.get("message", {}).get("content", "") or ""
-            else:
-                text = getattr(resp, "text", None) or str(resp)
-            pending["bot"] = text.strip()
-            pending["ts"] = datetime.now().strftime("%I:%M %p")
-            save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-            return
-        except Exception as e:
-            pending["bot"] = f"⚠️Offline (Text after sometime)"
-            pending["ts"] = datetime.now().strftime("%I:%M %p")
-            save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-            return
-
-    # stream handling
-    accumulated = ""
-    try:
-        for chunk in resp_iter:
-            # chunk may be dict-like or obj-like
-            text = ""
-            if isinstance(chunk, dict):
-                text = chunk.get("message", {}).get("content", "") or chunk.get("text", "") or ""
-            else:
-                text = getattr(chunk, "text", "") or ""
-            if not text:
-                continue
-            accumulated += text
-            # update pending bot text in session
-            st.session_state[selected_key][-1]["bot"] = accumulated
-            st.session_state[selected_key][-1]["ts"] = datetime.now().strftime("%I:%M %p")
-            # persist partial (optionally)
-            save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-        # final
-        st.session_state[selected_key][-1]["bot"] = accumulated.strip()
-        st.session_state[selected_key][-1]["ts"] = datetime.now().strftime("%I:%M %p")
-        save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-    except Exception as e:
-        st.session_state[selected_key][-1]["bot"] = f"⚠️Offline (Text after sometime)"
-        st.session_state[selected_key][-1]["ts"] = datetime.now().strftime("%I:%M %p")
-        save_chat_history_cloud(user, bot_name, st.session_state[selected_key])
-        return
+    # same pipeline as the send button; a turn already handled there is skipped
+    get_pipeline().run(TurnContext(user, bot.get("name") or bot_id, window.turns, bot_text, persona,
+                                   bot_id=bot_id, history_start=window.start))
+    histories.settle(bot_id)
 
 
 # run generation post-render (non-blocking style — runs during this request)
 process_pending_generation()
+
+# after the first render, pre-load heavy deps + embedding model in the background
+# (disable with CHATDOUBLE_WARMUP=0)
+if os.getenv("CHATDOUBLE_WARMUP", "1") != "0":
+    start_warmup([("embed_model", get_embed_model)])
 # end of file
@@ -0,0 +1,105 @@
+"""
+Latency and recall of vector-only vs BM25-only vs hybrid retrieval.
+
+Queries mention a nickname / place / slang word from the synthetic corpus;
+a line is relevant if it contains that exact term. recall@k is measured
+against min(k, #relevant).
+
+Usage (from the repo root):
+    python benchmarks/bench_hybrid.py [--size medium] [--k 20] [--real-embeddings] [--json out.json]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import HashingEncoder  # noqa: E402
+from run import percentiles  # noqa: E402
+from synthetic import NICKNAMES, PLACES, SIZES, SLANG, generate_export, random_message  # noqa: E402
+
+
+def make_queries(n, seed=5):
+    rng = random.Random(seed)
+    out = []
+    for _ in range(n):
+        term = rng.choice(NICKNAMES + PLACES + SLANG)
+        if rng.random() < 0.5:
+            out.append((term, term))                                    # bare keyword
+        else:
+            out.append((f"{random_message(rng)} {term}", term))         # sentence + keyword
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--size", default="medium", choices=list(SIZES))
+    ap.add_argument("--k", type=int, default=20)
+    ap.add_argument("--queries", type=int, default=300)
+    ap.add_argument("--real-embeddings", action="store_true")
+    ap.add_argument("--json")
+    args = ap.parse_args()
+
+    import retrieval
+    from ingest import extract_bot_lines
+    from lexical_index import tokenize
+
+    retrieval.INDEX_DIR = tempfile.mkdtemp(prefix="chatdouble-bench-")
+    encoder = None
+    if not args.real_embeddings:
+        encoder = HashingEncoder()
+        retrieval.set_embed_model(encoder)
+
+    bot_text = extract_bot_lines(generate_export(SIZES[args.size], seed=13), "Raykay")
+    t0 = time.perf_counter()
+    bot_index = retrieval.build_index(bot_text)
+    build_s = time.perf_counter() - t0
+    lines = bot_index.lines
+    line_tokens = [set(tokenize(l)) for l in lines]
+
+    def vector(q):
+        vec = bot_index.embed_model.encode([q], convert_to_numpy=True)
+        _, idxs = bot_index.index.search(vec, args.k)
+        return [int(i) for i in idxs[0] if i >= 0]
+
+    def lexical(q):
+        return [d for d, _ in bot_index.lexical.search(q, args.k)]
+
+    def hybrid(q):
+        return retrieval.hybrid_search(bot_index, q, k=args.k)
+
+    queries = make_queries(args.queries)
+    results = {"size": args.size, "lines": len(lines), "k": args.k, "build_s": round(build_s, 3), "modes": {}}
+    for name, fn in (("vector", vector), ("bm25", lexical), ("hybrid", hybrid)):
+        lat, recalls = [], []
+        encoded_before = encoder.encoded if encoder else 0
+        for q, term in queries:
+            relevant = {i for i, toks in enumerate(line_tokens) if tokenize(term)[0] in toks}
+            t0 = time.perf_counter()
+            got = fn(q)
+            lat.append(time.perf_counter() - t0)
+            if relevant:
+                recalls.append(len(relevant.intersection(got)) / min(args.k, len(relevant)))
+        results["modes"][name] = {
+            "latency": percentiles(lat),
+            "recall_at_k": round(sum(recalls) / len(recalls), 4) if recalls else None,
+            "encoder_calls": (encoder.encoded - encoded_before) if encoder else None,
+        }
+        r = results["modes"][name]
+        print(f"{name:<7} recall@{args.k}={r['recall_at_k']}  p50={r['latency']['p50_ms']}ms  "
+              f"p95={r['latency']['p95_ms']}ms  encoder_calls={r['encoder_calls']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"saved {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+"""
+In-memory stand-ins for the external services the app talks to, so
+benchmarks run offline and deterministically:
+
+  FakeFirestore   - the subset of google.cloud.firestore used by firebase_db,
+                    with per-op latency and read/write/delete counters
+  FakeGenaiClient - google.genai Client with fixed latency + streaming
+  HashingEncoder  - sentence-transformer look-alike (hashed bag of words)
+"""
+import asyncio
+import contextlib
+import copy
+import hashlib
+import threading
+import time
+
+# =========================================================
+# 🔥 Firestore
+# =========================================================
+
+
+# same class names as google.api_core.exceptions, which is what callers check
+class NotFound(Exception):
+    pass
+
+
+class AlreadyExists(Exception):
+    pass
+
+
+class FakeSnapshot:
+    def __init__(self, ref, data):
+        self.reference = ref
+        self.id = ref.id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class FakeDocumentRef:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def collection(self, name):
+        return FakeCollectionRef(self._client, f"{self.path}/{name}")
+
+    def collections(self):
+        return [FakeCollectionRef(self._client, p) for p in self._client._children(self.path)]
+
+    def get(self, transaction=None):
+        return self._client._read(self)
+
+    def set(self, data, merge=False):
+        self._client._write(self.path, data, merge=merge)
+
+    def create(self, data):
+        with self._client._lock:
+            if self._client._peek(self.path) is not None:
+                raise AlreadyExists(f"Document already exists: {self.path}")
+            self._client._write(self.path, data)
+
+    def update(self, data):
+        with self._client._lock:
+            if self._client._peek(self.path) is None:
+                raise NotFound(f"No document to update: {self.path}")
+            self._client._write(self.path, data, merge=True)
+
+    def delete(self):
+        self._client._delete(self.path)
+
+
+class FakeCollectionRef:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            doc_id = hashlib.sha1(f"{self.path}{time.time_ns()}{id(self)}".encode()).hexdigest()[:20]
+        return FakeDocumentRef(self._client, f"{self.path}/{doc_id}")
+
+    def list_documents(self):
+        return [FakeDocumentRef(self._client, p) for p in self._client._children(self.path)]
+
+    # queries
+    def _query(self):
+        return FakeQuery(self._client, self.list_documents)
+
+    def select(self, field_paths):
+        return self._query().select(field_paths)
+
+    def where(self, field, op, value):
+        return self._query().where(field, op, value)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._query().order_by(field, direction)
+
+    def limit(self, n):
+        return self._query().limit(n)
+
+    def stream(self, transaction=None):
+        return self._query().stream()
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+_OPS = {
+    "==": lambda a, b: a == b, "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b, "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b, ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+}
+
+
+class FakeQuery:
+    """where / order_by / limit / select over a set of document refs."""
+
+    def __init__(self, client, refs_fn, filters=(), order=(), limit_n=None, fields=None):
+        self._client = client
+        self._refs_fn = refs_fn
+        self._filters = tuple(filters)
+        self._order = tuple(order)
+        self._limit = limit_n
+        self._fields = fields
+
+    def _copy(self, **kw):
+        args = dict(filters=self._filters, order=self._order, limit_n=self._limit, fields=self._fields)
+        args.update(kw)
+        return FakeQuery(self._client, self._refs_fn, **args)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, _OPS[op], value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(order=self._order + ((field, str(direction).upper().startswith("DESC")),))
+
+    def limit(self, n):
+        return self._copy(limit_n=n)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def stream(self, transaction=None):
+        self._client._sleep()
+        snaps = []
+        for ref in self._refs_fn():
+            snap = self._client._read(ref, sleep=False)
+            if not snap.exists:
+                continue
+            data = snap._data
+            if all(fn(data.get(f), v) for f, fn, v in self._filters):
+                snaps.append(snap)
+        for field, desc in reversed(self._order):
+            snaps.sort(key=lambda s: s._data.get(field), reverse=desc)
+        if self._limit is not None:
+            snaps = snaps[:self._limit]
+        for snap in snaps:
+            if self._fields is not None:
+                data = snap._data
+                snap = FakeSnapshot(snap.reference, {f: data[f] for f in self._fields if f in data})
+            yield snap
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._ops = []
+
+    # ops are applied on commit, in one round trip
+    def set(self, ref, data, merge=False):
+        self._ops.append(lambda: self._client._write(ref.path, data, merge=merge, sleep=False))
+
+    def create(self, ref, data):
+        self._ops.append(lambda: self._client._write(ref.path, data, sleep=False))
+
+    def update(self, ref, data):
+        self._ops.append(lambda: self._client._write(ref.path, data, merge=True, sleep=False))
+
+    def delete(self, ref):
+        self._ops.append(lambda: self._client._delete(ref.path, sleep=False))
+
+    def __len__(self):
+        return len(self._ops)
+
+    def commit(self):
+        if len(self._ops) > 500:
+            raise ValueError("a batch can contain at most 500 operations")
+        self._client.ops["batches"] += 1
+        self._client._sleep()
+        with self._client._batch_lock:
+            for op in self._ops:
+                op()
+        self._ops = []
+
+
+class FakeFirestore:
+    """
+    Documents are stored as {path: dict}. Each get/set/update/delete counts as
+    one op and sleeps `latency` seconds (a batch commit sleeps once).
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self._docs = {}
+        self._lock = threading.RLock()
+        self._batch_lock = threading.RLock()
+        self.ops = {"reads": 0, "writes": 0, "deletes": 0, "batches": 0}
+
+    # ---- public client API ----
+    def collection(self, name):
+        return FakeCollectionRef(self, name)
+
+    def document(self, path):
+        return FakeDocumentRef(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def async_client(self):
+        """AsyncClient-shaped view over the same documents."""
+        if getattr(self, "_async", None) is None:
+            self._async = FakeAsyncFirestore(self)
+        return self._async
+
+    def collection_group(self, name):
+        def refs():
+            with self._lock:
+                paths = [p for p in self._docs if p.rsplit("/", 2)[-2:-1] == [name]]
+            return [FakeDocumentRef(self, p) for p in sorted(paths)]
+        return FakeQuery(self, refs)
+
+    def get_all(self, refs, transaction=None):
+        refs = list(refs)
+        self._sleep()
+        for ref in refs:
+            yield self._read(ref, sleep=False)
+
+    # ---- helpers ----
+    def reset_ops(self):
+        for k in self.ops:
+            self.ops[k] = 0
+
+    def stored_bytes(self) -> int:
+        with self._lock:
+            return sum(len(repr(v)) for v in self._docs.values())
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _peek(self, path):
+        with self._lock:
+            return self._docs.get(path)
+
+    def _children(self, path):
+        # like Firestore, a parent shows up if anything exists beneath it
+        prefix = path + "/"
+        with self._lock:
+            return sorted({prefix + p[len(prefix):].split("/", 1)[0] for p in self._docs if p.startswith(prefix)})
+
+    def _read(self, ref, sleep=True):
+        if sleep:
+            self._sleep()
+        with self._lock:
+            self.ops["reads"] += 1
+            data = self._docs.get(ref.path)
+            return FakeSnapshot(ref, copy.deepcopy(data) if data is not None else None)
+
+    def _write(self, path, data, merge=False, sleep=True):
+        if sleep:
+            self._sleep()
+        with self._lock:
+            self.ops["writes"] += 1
+            if merge and path in self._docs:
+                merged = dict(self._docs[path])
+                merged.update(copy.deepcopy(data))
+                self._docs[path] = merged
+            else:
+                self._docs[path] = copy.deepcopy(data)
+
+    def _delete(self, path, sleep=True):
+        if sleep:
+            self._sleep()
+        with self._lock:
+            self.ops["deletes"] += 1
+            self._docs.pop(path, None)
+
+
+# ---- AsyncClient flavour (same storage, awaitable API) ----
+# Each await runs the sync fake on a worker thread, so `latency` overlaps
+# across concurrent coroutines the way real network round trips do.
+
+
+class FakeAsyncDocumentRef:
+    def __init__(self, ref):
+        self._ref = ref
+        self.path = ref.path
+        self.id = ref.id
+
+    def collection(self, name):
+        return FakeAsyncCollectionRef(self._ref.collection(name))
+
+    async def get(self, transaction=None):
+        return await asyncio.to_thread(self._ref.get)
+
+    async def set(self, data, merge=False):
+        await asyncio.to_thread(self._ref.set, data, merge)
+
+    async def create(self, data):
+        await asyncio.to_thread(self._ref.create, data)
+
+    async def update(self, data):
+        await asyncio.to_thread(self._ref.update, data)
+
+    async def delete(self):
+        await asyncio.to_thread(self._ref.delete)
+
+
+class FakeAsyncQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def where(self, *args):
+        return FakeAsyncQuery(self._query.where(*args))
+
+    def order_by(self, *args):
+        return FakeAsyncQuery(self._query.order_by(*args))
+
+    def limit(self, n):
+        return FakeAsyncQuery(self._query.limit(n))
+
+    def select(self, fields):
+        return FakeAsyncQuery(self._query.select(fields))
+
+    async def stream(self, transaction=None):
+        for snap in await asyncio.to_thread(self._query.get):
+            yield snap
+
+    async def get(self, transaction=None):
+        return await asyncio.to_thread(self._query.get)
+
+
+class FakeAsyncCollectionRef(FakeAsyncQuery):
+    def __init__(self, coll):
+        super().__init__(coll._query())
+        self._coll = coll
+        self.path = coll.path
+        self.id = coll.id
+
+    def document(self, doc_id=None):
+        return FakeAsyncDocumentRef(self._coll.document(doc_id))
+
+    async def list_documents(self):
+        for ref in await asyncio.to_thread(self._coll.list_documents):
+            yield FakeAsyncDocumentRef(ref)
+
+
+class FakeAsyncWriteBatch:
+    def __init__(self, client):
+        self._batch = FakeWriteBatch(client)
+
+    def set(self, ref, data, merge=False):
+        self._batch.set(ref._ref, data, merge=merge)
+
+    def create(self, ref, data):
+        self._batch.create(ref._ref, data)
+
+    def update(self, ref, data):
+        self._batch.update(ref._ref, data)
+
+    def delete(self, ref):
+        self._batch.delete(ref._ref)
+
+    async def commit(self):
+        await asyncio.to_thread(self._batch.commit)
+
+
+class FakeAsyncTransaction(FakeAsyncWriteBatch):
+    """Writes are buffered; reads go through ref.get(transaction=...)."""
+
+
+class FakeAsyncFirestore:
+    def __init__(self, sync_client):
+        self._sync = sync_client
+        self._tx_lock = None
+
+    def collection(self, name):
+        return FakeAsyncCollectionRef(self._sync.collection(name))
+
+    def collection_group(self, name):
+        return FakeAsyncQuery(self._sync.collection_group(name))
+
+    def batch(self):
+        return FakeAsyncWriteBatch(self._sync)
+
+    async def get_all(self, refs, transaction=None):
+        snaps = await asyncio.to_thread(lambda: list(self._sync.get_all([r._ref for r in refs])))
+        for snap in snaps:
+            yield snap
+
+    async def run_transaction(self, fn):
+        """
+        Stand-in for google.cloud.firestore.async_transactional: transactions
+        are serialized, so fn sees a consistent view and commits atomically.
+        """
+        if self._tx_lock is None:
+            self._tx_lock = asyncio.Lock()
+        async with self._tx_lock:
+            tx = FakeAsyncTransaction(self._sync)
+            result = await fn(tx)
+            await tx.commit()
+            return result
+
+
+# =========================================================
+# ✨ Gemini
+# =========================================================
+
+
+class _Usage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _Response:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class _FakeModels:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def generate_content(self, model, contents, **kwargs):
+        o = self._owner
+        o._count()
+        with o.capacity:
+            time.sleep(o.latency)
+        reply = o.reply_for(contents)
+        return _Response(reply, _Usage(len(contents) // 4, len(reply) // 4))
+
+    def generate_content_stream(self, model, contents, **kwargs):
+        o = self._owner
+        o._count()
+        with o.capacity:
+            time.sleep(o.latency)
+            reply = o.reply_for(contents)
+            words = reply.split(" ")
+            step = max(1, len(words) // o.chunks)
+            for i in range(0, len(words), step):
+                time.sleep(o.chunk_latency)
+                last = i + step >= len(words)
+                text = " ".join(words[i:i + step]) + ("" if last else " ")
+                yield _Response(text, _Usage(len(contents) // 4, len(reply) // 4) if last else None)
+
+
+class FakeGenaiClient:
+    """
+    `latency` is time to first token; streaming adds `chunk_latency` per chunk.
+    `capacity` caps concurrent calls (the pod's share of the API); extra
+    callers block, like requests queued behind a saturated upstream.
+    """
+
+    def __init__(self, latency: float = 0.05, chunk_latency: float = 0.005, chunks: int = 5,
+                 reply: str = "haha yeah same here bro, tell me more", capacity: int = None):
+        self.latency = latency
+        self.capacity = threading.BoundedSemaphore(capacity) if capacity else contextlib.nullcontext()
+        self.chunk_latency = chunk_latency
+        self.chunks = chunks
+        self.reply = reply
+        self.calls = 0
+        self._lock = threading.Lock()
+        self.models = _FakeModels(self)
+
+    def _count(self):
+        with self._lock:
+            self.calls += 1
+
+    def reply_for(self, prompt: str) -> str:
+        return self.reply
+
+
+# =========================================================
+# 🧮 Embeddings
+# =========================================================
+
+
+class HashingEncoder:
+    """
+    Deterministic, dependency-light encoder with the MiniLM output shape.
+    Texts sharing words get similar vectors, which is enough to exercise
+    FAISS and the caches realistically.
+    """
+
+    def __init__(self, dim: int = 384, cost_per_text: float = 0.0):
+        self.dim = dim
+        self.cost_per_text = cost_per_text
+        self.encoded = 0
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        import numpy as np
+
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            for tok in text.lower().split():
+                h = int.from_bytes(hashlib.blake2b(tok.encode(), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 32) & 1 else -1.0
+            norm = float(np.linalg.norm(out[row]))
+            if norm:
+                out[row] /= norm
+        self.encoded += len(texts)
+        if self.cost_per_text:
+            time.sleep(self.cost_per_text * len(texts))
+        return out
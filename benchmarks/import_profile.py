@@ -0,0 +1,132 @@
+"""
+Import-time profile and time-to-first-paint for the login page.
+
+Usage (from the repo root):
+    python benchmarks/import_profile.py                 # human-readable report
+    python benchmarks/import_profile.py --json out.json # also save results
+
+Every measurement runs in a fresh interpreter so nothing is cached between them:
+  - `python -X importtime -c "import <module>"` for app.py and its heavy deps
+  - a bare render of app.py (unauthenticated Home view) via streamlit's AppTest
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What app.py pulls in, cheapest first. The last group must NOT be imported
+# by the login page any more — if it shows up under "app" the lazy loading broke.
+MODULES = [
+    "streamlit",
+    "firebase_db",
+    "google.genai",
+    "firebase_admin",
+    "faiss",
+    "sentence_transformers",
+]
+LAZY_MODULES = ("google.genai", "firebase_admin", "faiss", "sentence_transformers", "torch")
+
+FIRST_PAINT_SNIPPET = """
+import time
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("app.py", default_timeout=120)
+at.run()
+elapsed = time.perf_counter() - t0
+import sys
+heavy = sorted(m for m in {lazy!r} if m in sys.modules)
+print(repr((elapsed, heavy, [e.value for e in at.exception])))
+"""
+
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Parse `-X importtime` output into [(module, self_us, cumulative_us), ...].
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        try:
+            _, rest = line.split(":", 1)
+            self_us, cum_us, name = rest.split("|", 2)
+            rows.append((name.strip(), int(self_us), int(cum_us)))
+        except ValueError:
+            continue
+    return rows
+
+
+def profile_import(module: str) -> dict:
+    env = dict(os.environ, CHATDOUBLE_WARMUP="0")
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - t0
+    rows = parse_importtime(proc.stderr)
+    total = next((cum for name, _, cum in reversed(rows) if name == module), None)
+    top = sorted(rows, key=lambda r: r[1], reverse=True)[:10]
+    return {
+        "module": module,
+        "ok": proc.returncode == 0,
+        "cumulative_s": round(total / 1e6, 3) if total else None,
+        "process_wall_s": round(wall, 3),
+        "top_self": [{"module": n, "self_ms": round(s / 1e3, 1)} for n, s, _ in top],
+    }
+
+
+def profile_first_paint() -> dict:
+    env = dict(os.environ, CHATDOUBLE_WARMUP="0")
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", FIRST_PAINT_SNIPPET.format(lazy=LAZY_MODULES)],
+        cwd=ROOT, env=env, capture_output=True, text=True,
+    )
+    wall = time.perf_counter() - t0
+    if proc.returncode != 0:
+        return {"ok": False, "process_wall_s": round(wall, 3), "error": proc.stderr.strip()[-800:]}
+    elapsed, heavy, errors = eval(proc.stdout.strip().splitlines()[-1])
+    return {
+        "ok": not errors,
+        "render_s": round(elapsed, 3),
+        "process_wall_s": round(wall, 3),
+        "heavy_modules_loaded": heavy,
+        "errors": errors,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--modules", nargs="*", default=MODULES)
+    args = ap.parse_args()
+
+    results = {"python": sys.version.split()[0], "imports": [], "first_paint": None}
+    for mod in args.modules:
+        r = profile_import(mod)
+        results["imports"].append(r)
+        status = f"{r['cumulative_s']}s" if r["ok"] else "FAILED"
+        print(f"import {mod:<24} {status:>10}   (process {r['process_wall_s']}s)")
+
+    fp = profile_first_paint()
+    results["first_paint"] = fp
+    if fp["ok"]:
+        print(f"\nlogin page first paint: {fp['render_s']}s (process {fp['process_wall_s']}s)")
+        if fp["heavy_modules_loaded"]:
+            print(f"  WARNING: heavy modules loaded on first paint: {', '.join(fp['heavy_modules_loaded'])}")
+    else:
+        print(f"\nlogin page first paint FAILED: {fp.get('error') or fp.get('errors')}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nsaved {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,505 @@
+"""
+Offline benchmark / load-test harness.
+
+Firestore, Gemini and (by default) the sentence-transformer are replaced by the
+in-memory fakes in benchmarks/fakes.py, so this runs anywhere with faiss + numpy.
+--storage sqlite runs against a real (scratch) SQLite backend instead of the
+Firestore fake.
+
+Usage (from the repo root):
+    python benchmarks/run.py                                   # all scenarios
+    python benchmarks/run.py --scenarios ingest retrieval --sizes small medium
+    python benchmarks/run.py --out benchmarks/results/baseline.json
+    python benchmarks/run.py --compare benchmarks/results/baseline.json
+    python benchmarks/run.py --storage sqlite --scenarios ingest load
+    python benchmarks/run.py --scenarios fairness --heavy-threads 16
+    python benchmarks/run.py --scenarios api --api-clients 64
+
+Scenarios:
+    ingest      parse + embed + store synthetic exports (lines/s, Firestore ops)
+    retrieval   query latency, cold vs cached (p50/p95/p99)
+    load        concurrent chat sessions through the generation pipeline
+    fairness    light users' turn latency while one user floods sends and
+                uploads, against a capacity-limited LLM: no scheduler, fair
+                queuing alone, fair queuing + quotas
+    api         concurrent SSE chats against the ASGI server (api.py) over
+                real sockets: turns/s, first-token and full-turn latency
+    cold_start  login page first paint in a fresh interpreter
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import firebase_config  # noqa: E402
+from fakes import FakeFirestore, FakeGenaiClient, HashingEncoder  # noqa: E402
+from synthetic import SIZES, generate_export, sample_queries  # noqa: E402
+
+SCENARIOS = ("ingest", "retrieval", "load", "fairness", "api", "cold_start")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def percentiles(samples) -> dict:
+    vals = sorted(samples)
+    if not vals:
+        return {"n": 0}
+
+    def q(p):
+        return vals[min(len(vals) - 1, int(round(p * (len(vals) - 1))))]
+
+    return {
+        "n": len(vals),
+        "mean_ms": round(1000 * sum(vals) / len(vals), 3),
+        "p50_ms": round(1000 * q(0.5), 3),
+        "p95_ms": round(1000 * q(0.95), 3),
+        "p99_ms": round(1000 * q(0.99), 3),
+        "max_ms": round(1000 * vals[-1], 3),
+    }
+
+
+class Env:
+    """Wires the fakes (or a scratch SQLite db) into storage / retrieval for one run."""
+
+    def __init__(self, args):
+        import retrieval
+        import storage
+
+        # persist indexes (and the SQLite file) into a scratch dir, never the repo
+        scratch = tempfile.mkdtemp(prefix="chatdouble-bench-")
+        retrieval.INDEX_DIR = scratch
+        self.db = FakeFirestore(latency=args.firestore_latency)
+        firebase_config.set_db(self.db)
+        storage.set_backend(storage.make_backend(args.storage, path=os.path.join(scratch, "bench.sqlite3")))
+        if not args.real_embeddings:
+            retrieval.set_embed_model(HashingEncoder(cost_per_text=args.embed_cost))
+        self.genai = FakeGenaiClient(latency=args.llm_latency, chunk_latency=args.llm_chunk_latency)
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def index_for(self, bot_text, user=""):
+        # stand-in for app.build_faiss_for_bot's st.cache_resource
+        from retrieval import bot_index_hash, build_index
+        key = bot_index_hash(bot_text)
+        with self._lock:
+            if key not in self._indexes:
+                self._indexes[key] = build_index(bot_text)
+            return self._indexes[key]
+
+
+# =========================================================
+# Scenarios
+# =========================================================
+def bench_ingest(env, args) -> dict:
+    import firebase_db
+    from ingest import extract_bot_lines
+    from retrieval import build_index
+
+    out = {}
+    for size in args.sizes:
+        n = SIZES[size]
+        raw = generate_export(n, seed=n)
+        env.db.reset_ops()
+        t0 = time.perf_counter()
+        bot_text = extract_bot_lines(raw, "Raykay")
+        t_parse = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        lines = build_index(bot_text).lines
+        t_embed = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        firebase_db.add_bot("bench_user", f"Bot{size}", bot_text)
+        t_store = time.perf_counter() - t0
+        total = t_parse + t_embed + t_store
+        out[size] = {
+            "raw_lines": n,
+            "bot_lines": len(lines),
+            "raw_bytes": len(raw.encode()),
+            "parse_s": round(t_parse, 4),
+            "embed_s": round(t_embed, 4),
+            "store_s": round(t_store, 4),
+            "lines_per_s": round(n / total, 1) if total else None,
+            "firestore_ops": dict(env.db.ops),
+        }
+    return out
+
+
+def bench_retrieval(env, args) -> dict:
+    from query_cache import QueryCache
+    from retrieval import hybrid_search
+
+    size = args.sizes[-1]
+    bot_text = generate_export(SIZES[size], seed=7)
+    from ingest import extract_bot_lines
+    bot_text = extract_bot_lines(bot_text, "Raykay")
+    bot_index = env.index_for(bot_text)
+    embed_model, index = bot_index.embed_model, bot_index.index
+    queries = sample_queries(args.queries)
+
+    uncached, cached = [], []
+    for qtext in queries:
+        t0 = time.perf_counter()
+        vec = embed_model.encode([qtext], convert_to_numpy=True)
+        index.search(vec, 20)
+        uncached.append(time.perf_counter() - t0)
+    cache = QueryCache()
+    for qtext in queries:
+        t0 = time.perf_counter()
+        hybrid_search(bot_index, qtext, k=20, query_cache=cache)
+        cached.append(time.perf_counter() - t0)
+    return {
+        "corpus": size,
+        "index_size": index.ntotal,
+        "uncached": percentiles(uncached),
+        "hybrid_with_query_cache": percentiles(cached),
+        "cache_stats": cache.stats(),
+    }
+
+
+def bench_load(env, args) -> dict:
+    import firebase_db
+    from ingest import extract_bot_lines
+    from pipeline import GenerationPipeline, TurnContext, new_turn
+    from query_cache import QueryCache
+
+    bot_text = extract_bot_lines(generate_export(SIZES["small"], seed=3), "Raykay")
+    env.index_for(bot_text)
+    pipe = GenerationPipeline(
+        index_for=env.index_for,
+        query_cache=QueryCache(),
+        client_getter=lambda: env.genai,
+        persist=firebase_db.save_chat_history_cloud,
+    )
+    queries = sample_queries(args.sessions * args.turns, seed=11)
+    latencies = []
+    lat_lock = threading.Lock()
+    env.db.reset_ops()
+    calls_before = env.genai.calls
+
+    def session(i):
+        history = []
+        for t in range(args.turns):
+            history.append(new_turn(queries[i * args.turns + t]))
+            t0 = time.perf_counter()
+            firebase_db.save_chat_history_cloud(f"user{i}", "Raykay", history)
+            pipe.run(TurnContext(f"user{i}", "Raykay", history, bot_text, "", on_text=lambda _: None))
+            with lat_lock:
+                latencies.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=session, args=(i,)) for i in range(args.sessions)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    wall = time.perf_counter() - t0
+    return {
+        "sessions": args.sessions,
+        "turns_per_session": args.turns,
+        "wall_s": round(wall, 3),
+        "turns_per_s": round(len(latencies) / wall, 2) if wall else None,
+        "turn_latency": percentiles(latencies),
+        "llm_calls": env.genai.calls - calls_before,
+        "firestore_ops": dict(env.db.ops),
+    }
+
+
+def bench_fairness(env, args) -> dict:
+    import firebase_db
+    import metrics
+    from ingest import extract_bot_lines
+    from pipeline import RATE_LIMITED_REPLY, GenerationPipeline, TurnContext, new_turn
+    from query_cache import QueryCache
+    from scheduler import BACKGROUND, DEFAULT_QUOTAS, KINDS, FairScheduler, Quota, estimate_tokens
+    from fakes import FakeGenaiClient
+
+    bot_text = extract_bot_lines(generate_export(SIZES["small"], seed=3), "Raykay")
+    env.index_for(bot_text)
+    upload_prompt = "\n".join(bot_text.splitlines()[:400])   # a big export's persona prompt
+    queries = sample_queries(args.sessions * args.turns, seed=13)
+
+    def run(sched):
+        genai = FakeGenaiClient(latency=args.llm_latency, chunk_latency=args.llm_chunk_latency,
+                                capacity=args.llm_capacity)
+        pipe = GenerationPipeline(
+            index_for=env.index_for,
+            query_cache=QueryCache(),
+            client_getter=lambda: genai,
+            persist=firebase_db.save_chat_history_cloud,
+            scheduler=sched,
+        )
+        stop = threading.Event()
+        lock = threading.Lock()
+        light, heavy = [], {"turns": 0, "rate_limited": 0, "uploads": 0, "uploads_rejected": 0}
+        max_depth = [0]
+
+        def flood(i):
+            # one user, many tabs: sends back to back
+            history = []
+            while not stop.is_set():
+                history = history[-4:] + [new_turn(f"spam {i} {len(history)}")]
+                reply = pipe.run(TurnContext("heavy", "Raykay", history, bot_text, ""))
+                with lock:
+                    heavy["turns"] += 1
+                    heavy["rate_limited"] += reply == RATE_LIMITED_REPLY
+                if reply == RATE_LIMITED_REPLY:
+                    time.sleep(0.05)
+
+        def upload():
+            # the same user's uploads: background persona calls on big prompts
+            while not stop.is_set():
+                try:
+                    if sched is None:
+                        genai.models.generate_content(model="bench", contents=upload_prompt)
+                    else:
+                        with sched.slot("heavy", BACKGROUND, tokens=estimate_tokens(upload_prompt)):
+                            genai.models.generate_content(model="bench", contents=upload_prompt)
+                    key = "uploads"
+                except Exception:
+                    key = "uploads_rejected"
+                    time.sleep(0.05)
+                with lock:
+                    heavy[key] += 1
+
+        def session(i):
+            history = []
+            for t in range(args.turns):
+                history.append(new_turn(queries[i * args.turns + t]))
+                t0 = time.perf_counter()
+                pipe.run(TurnContext(f"light{i}", "Raykay", history, bot_text, "", on_text=lambda _: None))
+                with lock:
+                    light.append(time.perf_counter() - t0)
+                time.sleep(args.think_time)
+
+        def sample_depth():
+            while not stop.is_set():
+                max_depth[0] = max(max_depth[0], sched.queue_depth())
+                time.sleep(0.005)
+
+        background = [threading.Thread(target=flood, args=(i,)) for i in range(args.heavy_threads)]
+        background += [threading.Thread(target=upload) for _ in range(2)]
+        if sched is not None:
+            background.append(threading.Thread(target=sample_depth))
+        for th in background:
+            th.start()
+        time.sleep(0.2)   # let the flood saturate the LLM first
+        sessions = [threading.Thread(target=session, args=(i,)) for i in range(args.sessions)]
+        for th in sessions:
+            th.start()
+        for th in sessions:
+            th.join()
+        stop.set()
+        for th in background:
+            th.join()
+        out = {"light_turn_latency": percentiles(light), "heavy": heavy}
+        if sched is not None:
+            out["max_queue_depth"] = max_depth[0]
+        return out
+
+    # the app's default quotas with time compressed by --quota-scale
+    # (a minute of quota refills in 60/scale seconds)
+    scale = args.quota_scale
+    quotas = {kind: Quota(q.requests_per_min and q.requests_per_min * scale,
+                          q.tokens_per_min and q.tokens_per_min * scale, q.burst_s / scale)
+              for kind, q in DEFAULT_QUOTAS.items()}
+    results = {"without_scheduler": run(None),
+               "fair_queue_only": run(FairScheduler(slots=args.llm_capacity, quotas={k: None for k in KINDS}))}
+    metrics.reset()
+    sched = FairScheduler(slots=args.llm_capacity, quotas=quotas, max_wait_s=20.0 / scale,
+                          max_defer_s=30.0 / scale)
+    results["with_scheduler"] = run(sched)
+    snap = metrics.snapshot()
+    results["with_scheduler"]["queue_wait"] = {
+        kind: {f"{q}_ms": round(1000 * snap["timings"][f"scheduler.wait.{kind}"][q], 3) for q in ("p50", "p95", "p99")}
+        for kind in KINDS if f"scheduler.wait.{kind}" in snap["timings"]
+    }
+    results["with_scheduler"]["throttled"] = {
+        k.split(".", 1)[1]: v for k, v in snap["counters"].items()
+        if k.startswith(("scheduler.throttled", "scheduler.rejected"))
+    }
+    return {"llm_capacity": args.llm_capacity, "heavy_threads": args.heavy_threads, "quota_scale": scale,
+            "light_sessions": args.sessions, **results}
+
+
+def bench_api(env, args) -> dict:
+    import asyncio
+
+    import httpx
+    import uvicorn
+
+    import api
+    import firebase_db
+    from ingest import extract_bot_lines
+    from scheduler import KINDS, FairScheduler
+
+    bot_text = extract_bot_lines(generate_export(SIZES["small"], seed=3), "Raykay")
+    api.set_core(api.ChatCore(lambda: env.genai, scheduler=FairScheduler(
+        slots=args.api_clients, quotas={kind: None for kind in KINDS})))
+    users = [f"api_user{i}" for i in range(args.api_clients)]
+    bots = {}
+    for user in users:
+        firebase_db.register_user(user, "pw")
+        bots[user] = firebase_db.add_bot(user, "Raykay", bot_text)
+    queries = sample_queries(args.api_clients * args.turns, seed=17)
+
+    server = uvicorn.Server(uvicorn.Config(api.app, host="127.0.0.1", port=0, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    async def login(client, user):
+        r = await client.post("/api/login", json={"username": user, "password": "pw"})
+        return {"Authorization": f"Bearer {r.json()['token']}"}
+
+    async def session(i, client, headers, out):
+        user = users[i]
+        for t in range(args.turns):
+            t0 = time.perf_counter()
+            first = None
+            async with client.stream("POST", f"/api/bots/{bots[user]}/messages", headers=headers,
+                                     json={"text": queries[i * args.turns + t]}) as resp:
+                async for line in resp.aiter_lines():
+                    if line == "event: token" and first is None:
+                        first = time.perf_counter() - t0
+                    elif line == "event: done":
+                        break
+            out["turn"].append(time.perf_counter() - t0)
+            out["first_token"].append(first or 0.0)
+
+    async def run():
+        out = {"turn": [], "first_token": []}
+        limits = httpx.Limits(max_connections=args.api_clients)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+            # bcrypt logins first, so the timed part is chat only
+            headers = await asyncio.gather(*(login(client, user) for user in users))
+            t0 = time.perf_counter()
+            await asyncio.gather(*(session(i, client, headers[i], out) for i in range(args.api_clients)))
+            return out, time.perf_counter() - t0
+
+    env.db.reset_ops()
+    calls_before = env.genai.calls
+    try:
+        out, wall = asyncio.run(run())
+    finally:
+        server.should_exit = True
+        thread.join()
+    return {
+        "clients": args.api_clients,
+        "turns_per_client": args.turns,
+        "wall_s": round(wall, 3),
+        "turns_per_s": round(len(out["turn"]) / wall, 2) if wall else None,
+        "turn_latency": percentiles(out["turn"]),
+        "first_token": percentiles(out["first_token"]),
+        "llm_calls": env.genai.calls - calls_before,
+        "firestore_ops": dict(env.db.ops),
+    }
+
+
+def bench_cold_start(env, args) -> dict:
+    from import_profile import profile_first_paint
+    return profile_first_paint()
+
+
+# =========================================================
+# Compare
+# =========================================================
+def _flatten(d, prefix=""):
+    out = {}
+    for k, v in d.items():
+        key = f"{prefix}.{k}" if prefix else k
+        if isinstance(v, dict):
+            out.update(_flatten(v, key))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[key] = v
+    return out
+
+
+def compare(current: dict, baseline: dict, threshold: float = 0.10) -> list:
+    """
+    Lines describing metrics that got worse by more than `threshold`.
+    Latency-like keys (*_ms, *_s) regress upward, throughput (*_per_s) downward.
+    """
+    cur, base = _flatten(current["scenarios"]), _flatten(baseline["scenarios"])
+    regressions = []
+    for key, b in sorted(base.items()):
+        c = cur.get(key)
+        if c is None or not b:
+            continue
+        change = (c - b) / b
+        if key.endswith("_per_s"):
+            worse = change < -threshold
+        elif key.endswith("_ms") or key.endswith("_s"):
+            worse = change > threshold
+        else:
+            continue
+        if worse:
+            regressions.append(f"{key}: {b} -> {c} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--scenarios", nargs="*", default=list(SCENARIOS), choices=SCENARIOS)
+    ap.add_argument("--sizes", nargs="*", default=["small", "medium"], choices=list(SIZES))
+    ap.add_argument("--queries", type=int, default=500)
+    ap.add_argument("--sessions", type=int, default=8)
+    ap.add_argument("--turns", type=int, default=10)
+    ap.add_argument("--storage", default="firestore", choices=("firestore", "sqlite"),
+                    help="firestore = in-memory Firestore fake; sqlite = local SQLite backend")
+    ap.add_argument("--firestore-latency", type=float, default=0.002, help="seconds per Firestore op")
+    ap.add_argument("--llm-latency", type=float, default=0.05, help="seconds to first token")
+    ap.add_argument("--llm-chunk-latency", type=float, default=0.005)
+    ap.add_argument("--llm-capacity", type=int, default=4, help="concurrent LLM calls (fairness scenario)")
+    ap.add_argument("--heavy-threads", type=int, default=16, help="flooding threads of the heavy user (fairness)")
+    ap.add_argument("--think-time", type=float, default=0.3, help="seconds between a light user's turns (fairness)")
+    ap.add_argument("--quota-scale", type=float, default=10.0, help="speed-up of quota refill (fairness)")
+    ap.add_argument("--api-clients", type=int, default=32, help="concurrent chat clients (api)")
+    ap.add_argument("--embed-cost", type=float, default=0.0, help="extra seconds per text encoded")
+    ap.add_argument("--real-embeddings", action="store_true", help="use all-MiniLM-L6-v2")
+    ap.add_argument("--out", help="results JSON (default benchmarks/results/bench-<timestamp>.json)")
+    ap.add_argument("--compare", help="baseline results JSON; exit 1 on >10%% regression")
+    args = ap.parse_args()
+
+    env = Env(args)
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "args": vars(args),
+        },
+        "scenarios": {},
+    }
+    for name in args.scenarios:
+        print(f"== {name}", flush=True)
+        r = globals()[f"bench_{name}"](env, args)
+        results["scenarios"][name] = r
+        print(json.dumps(r, indent=2))
+
+    out = args.out or os.path.join(RESULTS_DIR, f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("no regressions vs", args.compare)
+
+
+if __name__ == "__main__":
+    main()
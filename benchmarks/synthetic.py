@@ -0,0 +1,57 @@
+"""
+Synthetic WhatsApp exports in the format extract_bot_lines() parses:
+
+    12/04/2023, 5:22 pm - Raykay: message
+"""
+import random
+from datetime import datetime, timedelta
+
+SLANG = ["bro", "lol", "fr", "ngl", "bruh", "lmao", "yaar", "scene", "chill", "vibe", "ded", "oof"]
+PLACES = ["Bandra", "Powai", "Lonavala", "Goa", "Andheri", "Marine Drive", "Juhu", "Thane"]
+NICKNAMES = ["Chintu", "Bunty", "Pinky", "Sonu", "Golu", "Raju"]
+WORDS = (
+    "what are you doing tomorrow let's meet at the usual place I was thinking we could "
+    "get food later did you finish the assignment the match was crazy yesterday call me "
+    "when free i am so tired today weekend plan is on or not send the pics from last time"
+).split()
+
+SIZES = {"small": 1_000, "medium": 10_000, "large": 50_000}
+
+
+def random_message(rng: random.Random) -> str:
+    n = rng.randint(2, 14)
+    words = [rng.choice(WORDS) for _ in range(n)]
+    if rng.random() < 0.4:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(SLANG))
+    if rng.random() < 0.15:
+        words.insert(rng.randrange(len(words) + 1), rng.choice(PLACES))
+    if rng.random() < 0.1:
+        words.insert(0, rng.choice(NICKNAMES))
+    return " ".join(words)
+
+
+def generate_export(n_lines: int, bot_name: str = "Raykay", other: str = "You",
+                    seed: int = 0, start: datetime = None) -> str:
+    """
+    n_lines chat lines alternating (randomly) between `other` and `bot_name`,
+    with ~2% system lines that the parser must skip.
+    """
+    rng = random.Random(seed)
+    ts = start or datetime(2023, 1, 1, 9, 0)
+    out = []
+    for _ in range(n_lines):
+        ts += timedelta(minutes=rng.randint(0, 90))
+        stamp = f"{ts.day:02d}/{ts.month:02d}/{ts.year}, {ts.strftime('%I:%M %p').lstrip('0').lower()}"
+        if rng.random() < 0.02:
+            out.append(f"{stamp} - Messages and calls are end-to-end encrypted.")
+            continue
+        speaker = bot_name if rng.random() < 0.5 else other
+        out.append(f"{stamp} - {speaker}: {random_message(rng)}")
+    return "\n".join(out)
+
+
+def sample_queries(n: int, seed: int = 1) -> list:
+    """User messages for load scenarios; about a third are repeated greetings."""
+    rng = random.Random(seed)
+    greetings = ["hi", "hey", "what's up", "lol", "hii", "Hey!!"]
+    return [rng.choice(greetings) if rng.random() < 0.35 else random_message(rng) for _ in range(n)]
@@ -0,0 +1,389 @@
+import hashlib
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from urllib.parse import urlparse
+
+from metrics import inc, span
+from query_cache import LRUCache
+
+# =========================================================
+# 🧊 Two-level cache: in-process L1 + shared L2
+# =========================================================
+# L1 is a per-process LRU. L2 is shared by every replica:
+#   redis://host:6379/0     any Redis-protocol server (Redis, Valkey, KeyDB...)
+#   file:///shared/dir      a directory on a shared filesystem (or local disk)
+# Keys are namespaced and versioned ("chatdouble:v1:<kind>:<key>"), so a
+# format change only needs a CACHE_VERSION bump. Values are bytes; callers
+# pass their own dumps/loads (no pickle — L2 is readable by other hosts).
+#
+# get_or_compute() is stampede-protected twice: one computation per key in
+# a process (threading lock), and one across replicas (L2 lock with TTL);
+# everyone else waits for the value to appear.
+
+CACHE_VERSION = 1
+NAMESPACE = "chatdouble"
+
+
+# =========================================================
+# 📁 Shared-filesystem L2
+# =========================================================
+class FileL2:
+    """
+    Values stored as files under root (sharded by key hash); writes are
+    atomic renames. Each file starts with its expiry time (0 = never).
+    """
+
+    _EXPIRY = struct.Struct("<d")
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key: str, suffix: str = "") -> str:
+        h = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, h[:2], h + suffix)
+
+    def get(self, key: str):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        (expires,) = self._EXPIRY.unpack_from(data)
+        if expires and expires < time.time():
+            return None
+        return data[self._EXPIRY.size:]
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._EXPIRY.pack(time.time() + ttl if ttl else 0))
+            f.write(value)
+        os.replace(tmp, path)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def lock(self, key: str, ttl: float) -> str:
+        """Try to take key's lock; returns a token, or None if someone else holds it."""
+        path = self._path(key, ".lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        token = uuid.uuid4().hex
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) <= ttl:
+                        return None
+                    os.remove(path)  # holder died; take over
+                except OSError:
+                    pass
+                continue
+            with os.fdopen(fd, "w") as f:
+                f.write(token)
+            return token
+        return None
+
+    def unlock(self, key: str, token: str) -> None:
+        path = self._path(key, ".lock")
+        try:
+            with open(path) as f:
+                if f.read() != token:
+                    return
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# =========================================================
+# 🔌 Redis-protocol L2 (no client library needed)
+# =========================================================
+class RedisL2:
+    """
+    Minimal RESP2 client: GET / SET (PX, NX) / DEL / EVAL. One connection
+    per thread, reconnected after errors.
+    """
+
+    _UNLOCK = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+               "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def __init__(self, url: str, timeout: float = 2.0):
+        u = urlparse(url)
+        self.host = u.hostname or "localhost"
+        self.port = u.port or 6379
+        self.password = u.password
+        self.db = int((u.path or "/0").lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock = sock
+        self._local.rf = sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+        self._local.sock = None
+
+    def _read(self):
+        rf = self._local.rf
+        line = rf.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = rf.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [self._read() for _ in range(n)]
+        raise RuntimeError(f"bad RESP reply {line!r}")
+
+    def _call(self, *args):
+        out = [b"*%d\r\n" % len(args)]
+        for a in args:
+            if not isinstance(a, bytes):
+                a = str(a).encode()
+            out.append(b"$%d\r\n%s\r\n" % (len(a), a))
+        self._local.sock.sendall(b"".join(out))
+        return self._read()
+
+    def call(self, *args):
+        for attempt in range(2):
+            if getattr(self._local, "sock", None) is None:
+                self._connect()
+            try:
+                return self._call(*args)
+            except (OSError, ConnectionError):
+                self._close()
+                if attempt:
+                    raise
+
+    def get(self, key: str):
+        return self.call("GET", key)
+
+    def set(self, key: str, value: bytes, ttl: float = None) -> None:
+        if ttl:
+            self.call("SET", key, value, "PX", int(ttl * 1000))
+        else:
+            self.call("SET", key, value)
+
+    def delete(self, key: str) -> None:
+        self.call("DEL", key)
+
+    def lock(self, key: str, ttl: float) -> str:
+        token = uuid.uuid4().hex
+        ok = self.call("SET", key + ":lock", token, "NX", "PX", int(ttl * 1000))
+        return token if ok == "OK" else None
+
+    def unlock(self, key: str, token: str) -> None:
+        self.call("EVAL", self._UNLOCK, 1, key + ":lock", token)
+
+
+def make_l2(url: str):
+    """L2 from a URL (redis://..., file:///...) or a plain directory path; None for ''."""
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://")):
+        if url.startswith("rediss://"):
+            raise ValueError("TLS (rediss://) isn't supported by the built-in client")
+        return RedisL2(url)
+    if url.startswith("file://"):
+        url = urlparse(url).path
+    return FileL2(url)
+
+
+# =========================================================
+# 🧊 The tier
+# =========================================================
+class CacheTier:
+    """
+    L1 (in-process LRU) over an optional shared L2. Errors talking to L2 are
+    counted and treated as misses — the cache never takes the app down — and
+    L2 is skipped for l2_retry_s seconds after one, so a dead server doesn't
+    add a connect timeout to every lookup.
+    """
+
+    def __init__(self, l2=None, l1_size: int = 512, namespace: str = NAMESPACE,
+                 version: int = CACHE_VERSION, lock_ttl: float = 120.0, poll_s: float = 0.05,
+                 l2_retry_s: float = 5.0):
+        self.l1 = LRUCache(l1_size)
+        self.l2 = l2
+        self.prefix = f"{namespace}:v{version}"
+        self.lock_ttl = lock_ttl
+        self.poll_s = poll_s
+        self.l2_retry_s = l2_retry_s
+        self._l2_down_until = 0.0
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self.counts = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "computes": 0, "waits": 0, "l2_errors": 0}
+
+    def key(self, kind: str, key: str) -> str:
+        return f"{self.prefix}:{kind}:{key}"
+
+    def _count(self, name: str) -> None:
+        self.counts[name] += 1
+        inc(f"cache_tier.{name}")
+
+    def _l2_available(self) -> bool:
+        return self.l2 is not None and time.monotonic() >= self._l2_down_until
+
+    def _l2_failed(self) -> None:
+        self._count("l2_errors")
+        self._l2_down_until = time.monotonic() + self.l2_retry_s
+
+    def _l2(self, method, *args):
+        if not self._l2_available():
+            return None
+        try:
+            return getattr(self.l2, method)(*args)
+        except Exception:
+            self._l2_failed()
+            return None
+
+    # ---- plain get / put ----
+    def get(self, kind: str, key: str, loads=bytes, l1: bool = True):
+        full = self.key(kind, key)
+        if l1:
+            value = self.l1.get(full)
+            if value is not None:
+                self._count("l1_hits")
+                return value
+        with span("cache_tier.l2_get"):
+            raw = self._l2("get", full)
+        if raw is None:
+            return None
+        value = loads(raw)
+        self._count("l2_hits")
+        if l1:
+            self.l1.put(full, value)
+        return value
+
+    def put(self, kind: str, key: str, value, dumps=bytes, ttl: float = None, l1: bool = True) -> None:
+        full = self.key(kind, key)
+        if l1:
+            self.l1.put(full, value)
+        with span("cache_tier.l2_set"):
+            self._l2("set", full, dumps(value), ttl)
+
+    # ---- stampede-protected fill ----
+    def _try_lock(self, full):
+        """L2 lock token, None if another replica holds it, "local" without a (working) L2."""
+        if not self._l2_available():
+            return "local"
+        try:
+            return self.l2.lock(full, self.lock_ttl)
+        except Exception:
+            self._l2_failed()
+            return "local"  # L2 down: don't wait on a lock nobody can release
+
+    def _local_lock(self, full):
+        # [lock, holders + waiters]: the entry is dropped only once nobody
+        # uses it, so a late arrival can't get a second lock for the key
+        with self._locks_guard:
+            entry = self._locks.get(full)
+            if entry is None:
+                entry = self._locks[full] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _release_local_lock(self, full):
+        with self._locks_guard:
+            entry = self._locks[full]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[full]
+
+    def get_or_compute(self, kind: str, key: str, compute, dumps=bytes, loads=bytes,
+                       ttl: float = None, l1: bool = True):
+        """
+        Cached value for (kind, key), else compute() it exactly once across
+        threads and replicas and publish it. A compute() result of None is
+        returned but not cached.
+        """
+        value = self.get(kind, key, loads, l1)
+        if value is not None:
+            return value
+        full = self.key(kind, key)
+        lock = self._local_lock(full)
+        try:
+            with lock:
+                # another thread may have filled it while we waited
+                value = self.get(kind, key, loads, l1)
+                if value is not None:
+                    return value
+                token = self._try_lock(full)
+                deadline = time.monotonic() + self.lock_ttl
+                while token is None and time.monotonic() < deadline:
+                    # another replica is computing it: wait for its result
+                    self._count("waits")
+                    time.sleep(self.poll_s)
+                    value = self.get(kind, key, loads, l1)
+                    if value is not None:
+                        return value
+                    token = self._try_lock(full)
+                self._count("misses")
+                try:
+                    self._count("computes")
+                    value = compute()
+                    if value is not None:
+                        self.put(kind, key, value, dumps, ttl, l1)
+                    return value
+                finally:
+                    if token not in (None, "local"):
+                        self._l2("unlock", full, token)
+        finally:
+            self._release_local_lock(full)
+
+    def stats(self) -> dict:
+        return {**self.counts, "l1": self.l1.stats(), "l2": type(self.l2).__name__ if self.l2 else None}
+
+    def gauges(self) -> dict:
+        """Flat stats for metrics.register_collector."""
+        out = {f"cache_tier.l1.{k}": v for k, v in self.l1.stats().items()}
+        out["cache_tier.l2_enabled"] = int(self.l2 is not None)
+        return out
+
+
+def pack_parts(parts) -> bytes:
+    """Length-prefixed concatenation of byte strings (multi-file cache values)."""
+    parts = list(parts)
+    return struct.pack(f"<I{len(parts)}Q", len(parts), *map(len, parts)) + b"".join(parts)
+
+
+def unpack_parts(blob: bytes) -> list:
+    (n,) = struct.unpack_from("<I", blob)
+    sizes = struct.unpack_from(f"<{n}Q", blob, 4)
+    out, pos = [], 4 + 8 * n
+    for size in sizes:
+        out.append(bytes(blob[pos:pos + size]))
+        pos += size
+    return out
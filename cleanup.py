@@ -0,0 +1,267 @@
+import json
+import os
+import threading
+import time
+
+from firebase_config import get_db
+from firebase_async import USERS_COLLECTION
+from metrics import inc, span
+from retrieval import (bot_index_hash, get_embedding_store, line_keys_in_use, list_index_files,
+                       remove_index_files)
+
+# =========================================================
+# 🧹 Cascading cleanup + orphan GC
+# =========================================================
+# A bot owns:
+#   users/{u}/bots/{bot_id}            (+ any subcollections, e.g. corpus chunks)
+#   users/{u}/chats/{bot_id}           (+ history pages subcollection)
+#   indexes/{content_hash}.*           (shared by every bot with the same corpus)
+# Deletes go out in Firestore batches of at most MAX_BATCH_OPS writes.
+
+MAX_BATCH_OPS = 500
+
+
+def _doc_size(data) -> int:
+    # rough stored size; good enough for "bytes reclaimed" reporting
+    return len(json.dumps(data, default=str).encode()) if data else 0
+
+
+def collect_doc_tree(doc_ref, with_sizes: bool = True) -> list:
+    """
+    [(ref, approx_bytes), ...] for doc_ref and every document below it
+    (subcollections, recursively). Missing parents are included so their
+    subcollections still get cleaned.
+    """
+    out = []
+    stack = [doc_ref]
+    while stack:
+        ref = stack.pop()
+        size = 0
+        if with_sizes:
+            snap = ref.get()
+            inc("firestore.reads")
+            size = _doc_size(snap.to_dict()) if snap.exists else 0
+        out.append((ref, size))
+        for coll in ref.collections():
+            stack.extend(coll.list_documents())
+    return out
+
+
+def batched_delete(refs) -> int:
+    """Delete refs in batches of MAX_BATCH_OPS. Returns the number deleted."""
+    db = get_db()
+    refs = list(refs)
+    for i in range(0, len(refs), MAX_BATCH_OPS):
+        batch = db.batch()
+        for ref in refs[i:i + MAX_BATCH_OPS]:
+            batch.delete(ref)
+        batch.commit()
+        inc("firestore.batches")
+        inc("firestore.writes", min(MAX_BATCH_OPS, len(refs) - i))
+    return len(refs)
+
+
+def _delete_tree(doc_ref) -> dict:
+    tree = collect_doc_tree(doc_ref)
+    return {"docs_deleted": batched_delete(ref for ref, _ in tree),
+            "bytes_reclaimed": sum(size for _, size in tree)}
+
+
+def _merge(report, more) -> dict:
+    for k, v in more.items():
+        report[k] = report.get(k, 0) + v
+    return report
+
+
+def content_in_use(content_hash: str, exclude_path: str = None) -> bool:
+    """
+    True if any bot (of any user) still has this corpus. Needs the
+    collection-group index on bots.content_hash (firestore.indexes.json);
+    without it Firestore raises FailedPrecondition.
+    """
+    query = get_db().collection_group("bots").where("content_hash", "==", content_hash).limit(2)
+    for snap in query.stream():
+        inc("firestore.reads")
+        if snap.reference.path != exclude_path:
+            return True
+    return False
+
+
+@span("cleanup.clear_history")
+def clear_history(username: str, bot_id: str) -> dict:
+    """
+    Remove a bot's chat history (document + pages) instead of rewriting it
+    as an empty list.
+    """
+    chat_ref = get_db().collection(USERS_COLLECTION).document(username).collection("chats").document(bot_id)
+    report = _delete_tree(chat_ref)
+    inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+    return report
+
+
+@span("cleanup.purge_bot")
+def purge_bot(username: str, bot_id: str) -> dict:
+    """
+    Delete a bot with everything derived from it. Returns
+    {docs_deleted, files_deleted, bytes_reclaimed}.
+    """
+    user_ref = get_db().collection(USERS_COLLECTION).document(username)
+    bot_ref = user_ref.collection("bots").document(bot_id)
+    snap = bot_ref.get()
+    inc("firestore.reads")
+    data = snap.to_dict() if snap.exists else {}
+    content_hash = data.get("content_hash") or (bot_index_hash(data["file_text"]) if data.get("file_text") else None)
+
+    # index files are content-addressed: keep them while another bot uses the
+    # corpus. Asked before deleting, so a failed check can't strand a half
+    # done delete; if it fails the files stay for gc_sweep to remove.
+    shared = True
+    if content_hash:
+        try:
+            shared = content_in_use(content_hash, exclude_path=bot_ref.path)
+        except Exception:
+            inc("cleanup.in_use_check_failed")
+
+    report = {"docs_deleted": 0, "files_deleted": 0, "bytes_reclaimed": 0}
+    _merge(report, _delete_tree(user_ref.collection("chats").document(bot_id)))
+    _merge(report, _delete_tree(bot_ref))
+
+    if not shared:
+        files = list_index_files().get(content_hash, [])
+        report["bytes_reclaimed"] += remove_index_files(content_hash)
+        report["files_deleted"] += len(files)
+
+    inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+    return report
+
+
+# =========================================================
+# ♻️ Orphan sweep
+# =========================================================
+@span("cleanup.gc_sweep")
+def gc_sweep(dry_run: bool = False, tmp_grace_s: float = 3600) -> dict:
+    """
+    Find and (unless dry_run) remove:
+      - chats/{id} trees whose bot no longer exists (incl. history orphaned by
+        the old copy-on-rename scheme)
+      - persisted index files no live bot references
+      - half-written *.tmp index files older than tmp_grace_s
+      - embedding-store rows for lines no live corpus has
+    Returns counts and bytes reclaimed.
+    """
+    db = get_db()
+    report = {"orphan_chats": 0, "orphan_index_files": 0, "docs_deleted": 0,
+              "files_deleted": 0, "bytes_reclaimed": 0, "dry_run": dry_run}
+    live_hashes = set()
+
+    for user_ref in db.collection(USERS_COLLECTION).list_documents():
+        bots = {}
+        for snap in user_ref.collection("bots").select(["content_hash"]).stream():
+            inc("firestore.reads")
+            bots[snap.id] = (snap.to_dict() or {}).get("content_hash")
+        for bot_id, h in bots.items():
+            if h:
+                live_hashes.add(h)
+            else:
+                # legacy bot without the field: hash its text once and backfill
+                bot_ref = user_ref.collection("bots").document(bot_id)
+                text = (bot_ref.get().to_dict() or {}).get("file_text", "")
+                inc("firestore.reads")
+                h = bot_index_hash(text)
+                live_hashes.add(h)
+                if not dry_run:
+                    bot_ref.update({"content_hash": h})
+                    inc("firestore.writes")
+
+        for chat_ref in user_ref.collection("chats").list_documents():
+            if chat_ref.id in bots:
+                continue
+            report["orphan_chats"] += 1
+            tree = collect_doc_tree(chat_ref)
+            report["bytes_reclaimed"] += sum(size for _, size in tree)
+            if not dry_run:
+                report["docs_deleted"] += batched_delete(ref for ref, _ in tree)
+
+    sweep_index_files(live_hashes, report, dry_run=dry_run, tmp_grace_s=tmp_grace_s)
+
+    if not dry_run:
+        inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+        inc("cleanup.gc_runs")
+    return report
+
+
+def sweep_index_files(live_hashes, report: dict, dry_run: bool = False, tmp_grace_s: float = 3600) -> dict:
+    """
+    Remove persisted index files whose content hash isn't in live_hashes and
+    stale *.tmp files, then compact the embedding store. Adds to report's
+    orphan_index_files / files_deleted / embeddings_dropped / bytes_reclaimed
+    (shared by every storage backend's gc_sweep).
+    """
+    now = time.time()
+    for key, paths in list_index_files().items():
+        for path in paths:
+            stale_tmp = path.endswith(".tmp") and now - os.path.getmtime(path) > tmp_grace_s
+            if key in live_hashes and not stale_tmp:
+                continue
+            if path.endswith(".tmp") and not stale_tmp:
+                continue  # a build may be writing it right now
+            if not stale_tmp:
+                report["orphan_index_files"] += 1
+            try:
+                report["bytes_reclaimed"] += os.path.getsize(path)
+                if not dry_run:
+                    os.remove(path)
+                    report["files_deleted"] += 1
+            except OSError:
+                pass
+    compact_embeddings(live_hashes, report, dry_run=dry_run)
+    return report
+
+
+def compact_embeddings(live_hashes, report: dict, dry_run: bool = False) -> dict:
+    """
+    Drop embedding-store rows no live corpus has a line for (deleted bots,
+    replaced corpora). Adds embeddings_dropped and bytes_reclaimed to report.
+    """
+    store = get_embedding_store()
+    dropped, freed = store.compact(line_keys_in_use(live_hashes), dry_run=dry_run)
+    report["embeddings_dropped"] = report.get("embeddings_dropped", 0) + dropped
+    report["bytes_reclaimed"] += freed
+    if dropped and not dry_run:
+        inc("cleanup.embeddings_dropped", dropped)
+    return report
+
+
+_gc_started = False
+_gc_lock = threading.Lock()
+_last_report = {}
+
+
+def last_gc_report() -> dict:
+    return dict(_last_report)
+
+
+def start_gc_thread(interval_s: float, sweep=None) -> bool:
+    """
+    Run sweep() (default: the Firestore gc_sweep) every interval_s seconds on
+    a daemon thread (once per process). Returns True if this call started it.
+    """
+    sweep = sweep or gc_sweep
+    global _gc_started
+    with _gc_lock:
+        if _gc_started:
+            return False
+        _gc_started = True
+
+    def loop():
+        while True:
+            time.sleep(interval_s)
+            try:
+                _last_report.clear()
+                _last_report.update(sweep())
+                _last_report["at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            except Exception as e:
+                _last_report["error"] = str(e)
+
+    threading.Thread(target=loop, name="chatdouble-gc", daemon=True).start()
+    return True
@@ -0,0 +1,235 @@
+import hashlib
+import os
+import struct
+import threading
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:   # Windows: only threads of this process are serialized
+    fcntl = None
+
+# =========================================================
+# 🧬 Content-addressed line embeddings
+# =========================================================
+# One append-only store per embedding model, shared by every bot, user and
+# process on the node:
+#
+#   {model}.keys   sha1(line) digests, 20 bytes each          (row i)
+#   {model}.vecs   b"CDVECS1\0" + uint32 dim, then float32[dim] rows
+#
+# A line that appears in ten bots (or ten uploads of the same group export)
+# is encoded once. Writers append under an flock, vectors before keys, so a
+# reader that sees key i can always read row i; a torn append is ignored
+# (the row count comes from the keys file) and overwritten by the next one.
+#
+# Rows are never deleted in place: compact() (run by cleanup's gc sweep)
+# rewrites both files with only the rows still wanted and swaps them in.
+# The lock lives in {model}.lock, which is never replaced; readers take it
+# shared and notice a swapped keys file by its inode.
+
+_COMPACT_CHUNK = 65536   # rows copied at a time
+
+MAGIC = b"CDVECS1\0"
+_HEADER = struct.Struct("<8sI")
+_KEY_BYTES = 20
+
+
+def line_key(line: str) -> bytes:
+    return hashlib.sha1(line.encode("utf-8", "ignore")).digest()
+
+
+class EmbeddingStore:
+    """
+    store = EmbeddingStore(os.path.join(INDEX_DIR, "embeddings"), "all-MiniLM-L6-v2")
+    keys = [line_key(line) for line in lines]
+    vectors, missing = store.lookup(keys)     # float32 rows, None where missing
+    store.add([keys[i] for i in missing], model.encode([lines[i] for i in missing]))
+    """
+
+    def __init__(self, directory: str, model_name: str):
+        self.directory = directory
+        safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in model_name)
+        self.keys_path = os.path.join(directory, f"{safe}.keys")
+        self.vecs_path = os.path.join(directory, f"{safe}.vecs")
+        self.lock_path = os.path.join(directory, f"{safe}.lock")
+        self._lock = threading.Lock()
+        self._rows = {}    # digest -> row
+        self._count = 0    # rows of the keys file already read into _rows
+        self._ident = None # (st_dev, st_ino) of that keys file
+        self.dim = None
+
+    @contextmanager
+    def _flock(self, shared: bool = False):
+        if fcntl is None:
+            yield
+            return
+        try:
+            f = open(self.lock_path, "a")
+        except OSError:
+            yield   # read-only store: nobody can be writing it either
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)   # released on close
+            yield
+
+    def _reset(self) -> None:
+        self._rows, self._count, self._ident, self.dim = {}, 0, None, None
+
+    # ---- reading ----
+    def _refresh(self) -> None:
+        # caller holds self._lock and the flock; picks up rows other
+        # processes appended, or starts over if compact() swapped the files
+        try:
+            st = os.stat(self.keys_path)
+        except OSError:
+            self._reset()
+            return
+        ident = (st.st_dev, st.st_ino)
+        if ident != self._ident or st.st_size < self._count * _KEY_BYTES:
+            self._reset()
+            self._ident = ident
+        try:
+            with open(self.keys_path, "rb") as f:
+                f.seek(self._count * _KEY_BYTES)
+                data = f.read()
+            if self.dim is None:
+                with open(self.vecs_path, "rb") as f:
+                    magic, dim = _HEADER.unpack(f.read(_HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError("not an embedding store")
+                self.dim = dim
+        except (OSError, ValueError, struct.error):
+            return
+        for i in range(len(data) // _KEY_BYTES):
+            self._rows.setdefault(data[i * _KEY_BYTES:(i + 1) * _KEY_BYTES], self._count + i)
+        self._count += len(data) // _KEY_BYTES
+
+    def _read_rows(self, rows):
+        import numpy as np
+
+        vecs = np.memmap(self.vecs_path, dtype=np.float32, mode="r", offset=_HEADER.size,
+                         shape=(self._count, self.dim))
+        return np.array(vecs[rows])   # copy out; the map is closed with `vecs`
+
+    def lookup(self, keys) -> tuple:
+        """
+        (vectors, missing) for a list of line_key digests: vectors[i] is the
+        stored float32 row or None, missing lists the positions with None.
+        """
+        with self._lock, self._flock(shared=True):
+            self._refresh()
+            rows = [self._rows.get(k) for k in keys]
+            found = [i for i, r in enumerate(rows) if r is not None]
+            vectors = [None] * len(keys)
+            if found:
+                try:
+                    got = self._read_rows([rows[i] for i in found])
+                except (OSError, ValueError):
+                    found, got = [], []
+                for i, vec in zip(found, got):
+                    vectors[i] = vec
+        return vectors, [i for i, v in enumerate(vectors) if v is None]
+
+    # ---- writing ----
+    def add(self, keys, embeddings) -> int:
+        """Append rows for keys not stored yet. Returns how many were written."""
+        import numpy as np
+
+        if len(keys) == 0:
+            return 0
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with self._lock, self._flock(), open(self.keys_path, "ab") as keys_file:
+                self._refresh()
+                if self.dim is None:
+                    self.dim = embeddings.shape[1]
+                    with open(self.vecs_path, "wb") as f:
+                        f.write(_HEADER.pack(MAGIC, self.dim))
+                elif embeddings.shape[1] != self.dim:
+                    raise ValueError(f"embedding dim {embeddings.shape[1]} != store dim {self.dim}")
+                seen = set()
+                pick = []
+                for i, k in enumerate(keys):
+                    if k not in self._rows and k not in seen:
+                        seen.add(k)
+                        pick.append(i)
+                if not pick:
+                    return 0
+                row_bytes = 4 * self.dim
+                with open(self.vecs_path, "r+b") as f:
+                    f.seek(_HEADER.size + self._count * row_bytes)
+                    f.write(embeddings[pick].tobytes())
+                keys_file.seek(0, os.SEEK_END)
+                if keys_file.tell() != self._count * _KEY_BYTES:
+                    keys_file.truncate(self._count * _KEY_BYTES)   # drop a torn key
+                keys_file.write(b"".join(keys[i] for i in pick))
+                keys_file.flush()
+                for n, i in enumerate(pick):
+                    self._rows[keys[i]] = self._count + n
+                self._count += len(pick)
+                st = os.fstat(keys_file.fileno())
+                self._ident = (st.st_dev, st.st_ino)
+                return len(pick)
+        except OSError:
+            return 0   # read-only / full disk: callers still have the vectors
+
+    def compact(self, keep, dry_run: bool = False) -> tuple:
+        """
+        Rewrite the store with only the rows whose key is in `keep` (a set of
+        line_key digests). Returns (rows dropped, bytes freed).
+        """
+        import numpy as np
+
+        with self._lock, self._flock():
+            self._refresh()
+            if not self._count or self.dim is None:
+                return 0, 0
+            rows = sorted(r for k, r in self._rows.items() if k in keep)
+            dropped = self._count - len(rows)
+            if not dropped:
+                return 0, 0
+            by_row = {r: k for k, r in self._rows.items()}
+            kept_keys = [by_row[r] for r in rows]
+            freed = self.nbytes - (_HEADER.size + len(rows) * (4 * self.dim + _KEY_BYTES))
+            if dry_run:
+                return dropped, freed
+            suffix = f".{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            keys_tmp, vecs_tmp = self.keys_path + suffix, self.vecs_path + suffix
+            try:
+                vecs = np.memmap(self.vecs_path, dtype=np.float32, mode="r", offset=_HEADER.size,
+                                 shape=(self._count, self.dim))
+                with open(vecs_tmp, "wb") as f:
+                    f.write(_HEADER.pack(MAGIC, self.dim))
+                    for i in range(0, len(rows), _COMPACT_CHUNK):
+                        f.write(np.ascontiguousarray(vecs[rows[i:i + _COMPACT_CHUNK]]).tobytes())
+                del vecs
+                with open(keys_tmp, "wb") as f:
+                    f.write(b"".join(kept_keys))
+                # keys go first and come back last: a crash in between leaves
+                # an empty store (re-encoded later), never keys over other rows
+                os.remove(self.keys_path)
+                os.replace(vecs_tmp, self.vecs_path)
+                os.replace(keys_tmp, self.keys_path)
+            except (OSError, ValueError):
+                for path in (keys_tmp, vecs_tmp):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self._reset()
+                return 0, 0
+            self._reset()
+            self._refresh()
+            return dropped, freed
+
+    def __len__(self) -> int:
+        with self._lock, self._flock(shared=True):
+            self._refresh()
+            return self._count
+
+    @property
+    def nbytes(self) -> int:
+        return _HEADER.size + self._count * 4 * (self.dim or 0) + self._count * _KEY_BYTES
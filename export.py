@@ -0,0 +1,96 @@
+import io
+import json
+from datetime import date, datetime
+
+from firebase_db import iter_history_pages
+from metrics import inc
+
+# =========================================================
+# 📤 Chat history export (.txt / .json), streamed
+# =========================================================
+# History is read page by page and written out as a generator of text
+# chunks, so an export never holds the whole conversation (or the whole
+# output) in memory. Filters: turn positions [start, end) and/or dates.
+
+EXPORT_FORMATS = ("txt", "json")
+MIME_TYPES = {"txt": "text/plain", "json": "application/json"}
+PAGE_SIZE = 200
+
+
+def _turn_date(turn):
+    at = turn.get("at")
+    if not at:
+        return None
+    try:
+        return datetime.fromisoformat(at).date()
+    except ValueError:
+        return None
+
+
+def iter_turns(user: str, bot_id: str, start: int = 0, end: int = None,
+               since: date = None, until: date = None, page_size: int = PAGE_SIZE):
+    """
+    Yield stored turns in order. start/end are turn positions (end exclusive);
+    since/until are inclusive dates matched against each turn's `at`.
+    Turns saved before `at` was recorded have no date and are left out
+    whenever a date filter is given.
+    """
+    pos = start
+    for page in iter_history_pages(user, bot_id, start, page_size):
+        for turn in page:
+            if end is not None and pos >= end:
+                return
+            pos += 1
+            if since or until:
+                d = _turn_date(turn)
+                if d is None or (since and d < since) or (until and d > until):
+                    continue
+            yield turn
+
+
+def iter_txt(turns, bot_name: str = "Bot"):
+    for turn in turns:
+        stamp = f"[{turn['at'].replace('T', ' ')}] " if turn.get("at") else (f"[{turn['ts']}] " if turn.get("ts") else "")
+        chunk = f"{stamp}You: {turn.get('user', '')}\n"
+        if turn.get("bot") and not turn.get("error"):   # canned error replies aren't the bot's
+            chunk += f"{stamp}{bot_name}: {turn['bot']}\n"
+        yield chunk + "\n"
+
+
+def iter_json(turns, meta: dict = None):
+    """A JSON document {"meta": {...}, "turns": [...]} written one turn at a time."""
+    yield '{"meta": ' + json.dumps(meta or {}, ensure_ascii=False) + ', "turns": ['
+    sep = "\n  "
+    for turn in turns:
+        yield sep + json.dumps(turn, ensure_ascii=False, default=str)
+        sep = ",\n  "
+    yield "\n]}\n"
+
+
+def export_history(user: str, bot_id: str, fmt: str = "txt", bot_name: str = None, **filters):
+    """
+    Generator of text chunks for the bot's history in `fmt` ("txt" or "json").
+    `filters` go to iter_turns (start, end, since, until).
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r} (expected one of {', '.join(EXPORT_FORMATS)})")
+    inc(f"export.{fmt}")
+    turns = iter_turns(user, bot_id, **filters)
+    if fmt == "json":
+        meta = {"user": user, "bot_id": bot_id, "bot": bot_name,
+                "exported_at": datetime.now().isoformat(timespec="seconds"),
+                **{k: str(v) for k, v in filters.items() if v is not None}}
+        return iter_json(turns, meta)
+    return iter_txt(turns, bot_name or "Bot")
+
+
+def export_bytes(chunks) -> bytes:
+    """
+    Encode chunks into one bytes object (for st.download_button, which needs
+    the finished file). Peak memory is the encoded output, not a list of turns.
+    """
+    buf = io.BytesIO()
+    for chunk in chunks:
+        buf.write(chunk.encode("utf-8"))
+    inc("export.bytes", buf.tell())
+    return buf.getvalue()
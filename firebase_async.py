@@ -0,0 +1,384 @@
+import asyncio
+import threading
+
+from firebase_config import get_async_db
+from metrics import attach_trace, current_trace, inc, span
+from retrieval import bot_index_hash
+from storage import StorageBackend, check_password, hash_password
+
+# =========================================================
+# ⚡ Async Firestore data layer
+# =========================================================
+# Built on Firestore's AsyncClient. Independent reads run concurrently
+# (asyncio.gather / get_all), multi-doc writes go out as one batch, and
+# read-modify-write goes through a transaction. firebase_db wraps these
+# coroutines for the synchronous Streamlit code via run_sync(), and
+# FirestoreBackend adapts them to the storage.StorageBackend interface.
+
+USERS_COLLECTION = "users"
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# =========================================================
+# 🔁 Event loop bridge (sync callers)
+# =========================================================
+def _get_loop():
+    """One background event loop per process; the AsyncClient lives on it."""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="chatdouble-firestore", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+async def _bound(coro, trace_record):
+    attach_trace(trace_record)
+    return await coro
+
+
+def run_sync(coro):
+    """
+    Run a coroutine from this module on the shared loop and block for the
+    result. Safe to call from any thread except the loop's own.
+    """
+    fut = asyncio.run_coroutine_threadsafe(_bound(coro, current_trace()), _get_loop())
+    return fut.result()
+
+
+def _is_error(exc, *names) -> bool:
+    # google.api_core.exceptions.{NotFound, AlreadyExists, Conflict}, matched by
+    # name so the in-memory fakes can raise their own classes
+    return any(cls.__name__ in names for cls in type(exc).__mro__)
+
+
+async def run_transaction(fn):
+    """
+    Run `async fn(transaction)` in a Firestore transaction (retried on
+    contention by the client library).
+    """
+    db = get_async_db()
+    runner = getattr(db, "run_transaction", None)   # in-memory fakes
+    if runner is not None:
+        return await runner(fn)
+    from google.cloud.firestore import async_transactional
+    return await async_transactional(fn)(db.transaction())
+
+
+def _user_ref(username: str):
+    return get_async_db().collection(USERS_COLLECTION).document(username)
+
+
+def _bots_ref(username: str):
+    return _user_ref(username).collection("bots")
+
+
+def _chat_ref(username: str, bot_id: str):
+    return _user_ref(username).collection("chats").document(bot_id)
+
+
+# =========================================================
+# 👤 Authentication
+# =========================================================
+@span("firestore.async.register_user")
+async def register_user(username: str, password: str) -> bool:
+    """
+    Create the user document; a single create() instead of get() + set().
+    Returns False if the username already exists.
+    """
+    # bcrypt is CPU bound — keep it off the event loop
+    hashed = await asyncio.to_thread(hash_password, password)
+    try:
+        await _user_ref(username).create({"password": hashed})
+    except Exception as e:
+        if _is_error(e, "AlreadyExists", "Conflict"):
+            return False
+        raise
+    inc("firestore.writes")
+    return True
+
+
+@span("firestore.async.login_user")
+async def login_user(username: str, password: str) -> bool:
+    if not username:
+        return False
+    doc = await _user_ref(username).get()
+    inc("firestore.reads")
+    if not doc.exists:
+        return False
+    stored = (doc.to_dict() or {}).get("password")
+    if not stored:
+        return False
+    return await asyncio.to_thread(check_password, password, stored)
+
+
+# =========================================================
+# 🤖 Bots
+# =========================================================
+def _bot_data(name, file_text, persona=None) -> dict:
+    data = {"name": name, "file_text": file_text, "content_hash": bot_index_hash(file_text)}
+    if persona:
+        data["persona"] = persona
+    return data
+
+
+def _bot_dict(snap) -> dict:
+    data = snap.to_dict() or {}
+    return {
+        "id": snap.id,
+        "name": data.get("name") or snap.id,
+        "file_text": data.get("file_text", ""),
+        "persona": data.get("persona", ""),
+        "content_hash": data.get("content_hash") or bot_index_hash(data.get("file_text", "")),
+        "last_message_at": data.get("last_message_at"),
+        "stamp_format": data.get("stamp_format"),
+    }
+
+
+@span("firestore.async.add_bot")
+async def add_bot(username: str, name: str, file_text: str, persona: str = None) -> str:
+    doc_ref = _bots_ref(username).document()
+    await doc_ref.set(_bot_data(name, file_text, persona))
+    inc("firestore.writes")
+    return doc_ref.id
+
+
+@span("firestore.async.add_bot_limited")
+async def add_bot_limited(username: str, name: str, file_text: str, persona: str = None,
+                          max_bots: int = 2):
+    """
+    Count the user's bots and create the new one in one transaction, so two
+    concurrent uploads can't both slip under the limit.
+    Returns the new bot_id, or None if the user is at the limit.
+    """
+    async def txn(transaction):
+        existing = [s async for s in _bots_ref(username).select([]).stream(transaction=transaction)]
+        inc("firestore.reads", max(1, len(existing)))
+        if len(existing) >= max_bots:
+            return None
+        doc_ref = _bots_ref(username).document()
+        transaction.set(doc_ref, _bot_data(name, file_text, persona))
+        inc("firestore.writes")
+        return doc_ref.id
+
+    return await run_transaction(txn)
+
+
+@span("firestore.async.get_user_bots")
+async def get_user_bots(username: str) -> list:
+    """
+    [{id, name, file, persona}, ...] — projected, so the (large) file_text
+    of each bot is never downloaded just to list names.
+    """
+    bots = []
+    async for doc in _bots_ref(username).select(["name", "persona"]).stream():
+        inc("firestore.reads")
+        data = doc.to_dict() or {}
+        bots.append({"id": doc.id, "name": data.get("name"), "file": doc.id, "persona": data.get("persona", "")})
+    return bots
+
+
+@span("firestore.async.get_bot")
+async def get_bot(username: str, bot_id: str):
+    doc = await _bots_ref(username).document(bot_id).get()
+    inc("firestore.reads")
+    return _bot_dict(doc) if doc.exists else None
+
+
+@span("firestore.async.get_bots")
+async def get_bots(username: str, bot_ids) -> dict:
+    """{bot_id: bot dict} for several bots in one get_all round trip."""
+    refs = [_bots_ref(username).document(b) for b in bot_ids]
+    out = {}
+    async for snap in get_async_db().get_all(refs):
+        inc("firestore.reads")
+        if snap.exists:
+            out[snap.id] = _bot_dict(snap)
+    return out
+
+
+@span("firestore.async.update_bot")
+async def update_bot(username: str, bot_id: str, new_name: str, new_file_text: str = None) -> bool:
+    fields = {"name": new_name}
+    if new_file_text:
+        fields["file_text"] = new_file_text
+        fields["content_hash"] = bot_index_hash(new_file_text)
+    return await _update_if_exists(_bots_ref(username).document(bot_id), fields)
+
+
+@span("firestore.async.extend_bot")
+async def extend_bot(username: str, bot_id: str, base_hash: str, file_text: str,
+                     last_message_at: str = None, stamp_format: str = None) -> bool:
+    """
+    Swap in an extended corpus transactionally, only if the bot still has
+    content hash base_hash, so two concurrent appends can't drop each
+    other's messages. False if the bot is gone or changed meanwhile.
+    """
+    ref = _bots_ref(username).document(bot_id)
+
+    async def txn(transaction):
+        snap = await ref.get(transaction=transaction)
+        inc("firestore.reads")
+        if not snap.exists or _bot_dict(snap)["content_hash"] != base_hash:
+            return False
+        fields = {"file_text": file_text, "content_hash": bot_index_hash(file_text)}
+        if last_message_at:
+            fields["last_message_at"] = last_message_at
+        if stamp_format:
+            fields["stamp_format"] = stamp_format
+        transaction.update(ref, fields)
+        inc("firestore.writes")
+        return True
+
+    return await run_transaction(txn)
+
+
+@span("firestore.async.update_bot_persona")
+async def update_bot_persona(username: str, bot_id: str, persona_text: str) -> bool:
+    """One update() (which fails on a missing doc) instead of get() + update()."""
+    return await _update_if_exists(_bots_ref(username).document(bot_id), {"persona": persona_text})
+
+
+async def _update_if_exists(doc_ref, fields) -> bool:
+    try:
+        await doc_ref.update(fields)
+    except Exception as e:
+        if _is_error(e, "NotFound"):
+            return False
+        raise
+    inc("firestore.writes")
+    return True
+
+
+# =========================================================
+# 💬 Chat history
+# =========================================================
+@span("firestore.async.save_chat_history")
+async def save_chat_history(username: str, bot_id: str, history: list, start: int = 0) -> None:
+    """
+    Replace the stored history from position `start` on with `history`.
+    With start > 0 the older turns are kept (read-modify-write in a
+    transaction, since they live in the same document).
+    """
+    ref = _chat_ref(username, bot_id)
+    if not start:
+        await ref.set({"history": history})
+        inc("firestore.writes")
+        return
+
+    async def txn(transaction):
+        snap = await ref.get(transaction=transaction)
+        inc("firestore.reads")
+        stored = (snap.to_dict() or {}).get("history", []) if snap.exists else []
+        transaction.set(ref, {"history": stored[:start] + list(history)})
+        inc("firestore.writes")
+
+    await run_transaction(txn)
+
+
+@span("firestore.async.load_chat_history")
+async def load_chat_history(username: str, bot_id: str) -> list:
+    doc = await _chat_ref(username, bot_id).get()
+    inc("firestore.reads")
+    if doc.exists:
+        return (doc.to_dict() or {}).get("history", [])
+    return []
+
+
+# =========================================================
+# 📄 Page loads (independent reads, concurrently)
+# =========================================================
+@span("firestore.async.load_chat_view")
+async def load_chat_view(username: str, bot_id: str = None, history_limit: int = None) -> dict:
+    """
+    Everything the Chat tab needs: {"bots", "bot", "history", "history_start"}.
+    With a known bot_id the bot list, bot document and history are fetched
+    concurrently; otherwise the first listed bot is used. history_limit
+    keeps only the newest turns (0: the history isn't read at all);
+    history_start is the position of the first one returned.
+    """
+    async def history_of(bid):
+        return [] if history_limit == 0 else await load_chat_history(username, bid)
+
+    if bot_id:
+        bots, bot, history = await asyncio.gather(
+            get_user_bots(username), get_bot(username, bot_id), history_of(bot_id)
+        )
+        if bot is not None:
+            return _chat_view(bots, bot, history, history_limit)
+    else:
+        bots = await get_user_bots(username)
+    if not bots:
+        return {"bots": [], "bot": None, "history": [], "history_start": 0}
+    first = bots[0]["id"]
+    bot, history = await asyncio.gather(get_bot(username, first), history_of(first))
+    return _chat_view(bots, bot, history, history_limit)
+
+
+def _chat_view(bots, bot, history, history_limit) -> dict:
+    start = max(0, len(history) - history_limit) if history_limit else 0
+    return {"bots": bots, "bot": bot, "history": history[start:], "history_start": start}
+
+
+# =========================================================
+# 🗄️ StorageBackend adapter
+# =========================================================
+class FirestoreBackend(StorageBackend):
+    """Firestore behind the storage interface; deletes/GC go through cleanup."""
+
+    name = "firestore"
+
+    def register_user(self, username, password):
+        return run_sync(register_user(username, password))
+
+    def login_user(self, username, password):
+        return run_sync(login_user(username, password))
+
+    def add_bot(self, username, name, file_text, persona=None):
+        return run_sync(add_bot(username, name, file_text, persona))
+
+    def add_bot_limited(self, username, name, file_text, persona=None, max_bots=2):
+        return run_sync(add_bot_limited(username, name, file_text, persona, max_bots))
+
+    def get_user_bots(self, username):
+        return run_sync(get_user_bots(username))
+
+    def get_bot(self, username, bot_id):
+        return run_sync(get_bot(username, bot_id))
+
+    def get_bots(self, username, bot_ids):
+        return run_sync(get_bots(username, bot_ids))
+
+    def update_bot(self, username, bot_id, new_name, new_file_text=None):
+        return run_sync(update_bot(username, bot_id, new_name, new_file_text))
+
+    def extend_bot(self, username, bot_id, base_hash, file_text, last_message_at=None, stamp_format=None):
+        return run_sync(extend_bot(username, bot_id, base_hash, file_text, last_message_at, stamp_format))
+
+    def update_bot_persona(self, username, bot_id, persona_text):
+        return run_sync(update_bot_persona(username, bot_id, persona_text))
+
+    def delete_bot(self, username, bot_id):
+        from cleanup import purge_bot
+        return purge_bot(username, bot_id)
+
+    def save_chat_history(self, username, bot_id, history, start=0):
+        run_sync(save_chat_history(username, bot_id, history, start))
+
+    def load_chat_history(self, username, bot_id):
+        return run_sync(load_chat_history(username, bot_id))
+
+    def clear_history(self, username, bot_id):
+        from cleanup import clear_history
+        return clear_history(username, bot_id)
+
+    def load_chat_view(self, username, bot_id=None, history_limit=None):
+        return run_sync(load_chat_view(username, bot_id, history_limit))
+
+    def gc_sweep(self, dry_run=False):
+        from cleanup import gc_sweep
+        return gc_sweep(dry_run=dry_run)
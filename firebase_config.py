@@ -1,15 +1,72 @@
-import streamlit as st
-import firebase_admin
-from firebase_admin import credentials, firestore
+import threading
 
-# Load Firebase credentials from Streamlit secrets
-firebase_secrets = dict(st.secrets["firebase_service_account"])
+# The Firestore client is created on first use instead of at import time,
+# so pages that never touch the database (e.g. the login screen) start fast.
+_db = None
+_async_db = None
+_lock = threading.Lock()
 
-cred = credentials.Certificate(firebase_secrets)
 
-if not firebase_admin._apps:
-    firebase_admin.initialize_app(cred)
+def _init_app():
+    import streamlit as st
+    import firebase_admin
+    from firebase_admin import credentials
 
-db = firestore.client()
+    if not firebase_admin._apps:
+        # Load Firebase credentials from Streamlit secrets
+        firebase_secrets = dict(st.secrets["firebase_service_account"])
 
+        cred = credentials.Certificate(firebase_secrets)
 
+        firebase_admin.initialize_app(cred)
+
+
+def get_db():
+    """
+    Return the shared Firestore client, initializing Firebase on first call.
+    Credentials come from Streamlit secrets.
+    """
+    global _db
+    if _db is None:
+        with _lock:
+            if _db is None:
+                from firebase_admin import firestore
+
+                _init_app()
+                _db = firestore.client()
+    return _db
+
+
+def get_async_db():
+    """
+    Return the shared Firestore AsyncClient (used by firebase_async).
+    It must only be awaited on firebase_async's event loop.
+    """
+    global _async_db
+    if _async_db is None:
+        with _lock:
+            if _async_db is None:
+                from firebase_admin import firestore_async
+
+                _init_app()
+                _async_db = firestore_async.client()
+    return _async_db
+
+
+def set_db(client) -> None:
+    """
+    Use `client` instead of the real Firestore client (in-memory fakes for
+    benchmarks and local runs). Must be called before the first get_db().
+    """
+    global _db, _async_db
+    with _lock:
+        _db = client
+        # fakes expose their AsyncClient flavour via async_client()
+        _async_db = client.async_client() if hasattr(client, "async_client") else None
+
+
+def __getattr__(name):
+    # keep `from firebase_config import db` working (resolved lazily)
+    if name == "db":
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
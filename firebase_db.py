@@ -1,154 +1,200 @@
-import bcrypt
-from firebase_config import db
+from metrics import span
+from storage import get_backend
 
 # =========================================================
-# 🔖 Firestore Collections
+# 🔖 Storage facade
 # =========================================================
-USERS_COLLECTION = "users"
+# The app imports these functions; each forwards to the configured
+# storage backend (storage.get_backend(): Firestore by default, or local
+# SQLite). Signatures and return values are the same for every backend.
 
 # =========================================================
 # 👤 Authentication Functions
 # =========================================================
+@span("storage.register_user")
 def register_user(username: str, password: str) -> bool:
     """
     Register a new user with hashed password.
     Returns False if username already exists.
     """
-    doc_ref = db.collection(USERS_COLLECTION).document(username)
-    if doc_ref.get().exists:
-        return False
-
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode("utf-8", "ignore")
-    doc_ref.set({"password": hashed})
-    return True
+    return get_backend().register_user(username, password)
 
 
+@span("storage.login_user")
 def login_user(username: str, password: str) -> bool:
-    if not username:
-        return False
-    doc = db.collection(USERS_COLLECTION).document(username).get()
     """
     Validate login credentials.
     Returns True if correct, False otherwise.
     """
-    doc = db.collection(USERS_COLLECTION).document(username).get()
-    if not doc.exists:
-        return False
-
-    stored = doc.to_dict().get("password")
-    if not stored:
-        return False
-
-    return bcrypt.checkpw(password.encode(), stored.encode())
+    return get_backend().login_user(username, password)
 
 
 # =========================================================
 # 🤖 Bot Management
 # =========================================================
-def add_bot(username: str, name: str, file_text: str, persona: str = None) -> None:
+@span("storage.add_bot")
+def add_bot(username: str, name: str, file_text: str, persona: str = None) -> str:
     """
-    Store bot data inside Firestore:
-      users/{username}/bots/{bot_name}
+    Store a bot for `username`. bot_id is generated once and never changes;
+    the display name is a field, so renames don't move the bot (or orphan
+    its history / indexes).
     Supports optional 'persona' (personality description).
+    Returns the new bot_id.
     """
-    bots_ref = db.collection(USERS_COLLECTION).document(username).collection("bots")
-    bot_data = {
-        "name": name,
-        "file_text": file_text,
-    }
-    if persona:
-        bot_data["persona"] = persona
+    return get_backend().add_bot(username, name, file_text, persona)
 
-    bots_ref.document(name.lower()).set(bot_data)
 
+@span("storage.add_bot_limited")
+def add_bot_limited(username: str, name: str, file_text: str, persona: str = None, max_bots: int = 2):
+    """
+    Like add_bot, but only if the user has fewer than max_bots bots
+    (checked inside the same transaction). Returns the bot_id or None.
+    """
+    return get_backend().add_bot_limited(username, name, file_text, persona, max_bots)
 
+
+@span("storage.get_user_bots")
 def get_user_bots(username: str):
     """
     Retrieve all bots for a given user.
-    Returns a list of dicts [{name, file, persona?}, ...]
+    Returns a list of dicts [{id, name, file, persona?}, ...]
+    (`file` is kept as an alias of `id` for older callers.)
     """
-    bots_ref = db.collection(USERS_COLLECTION).document(username).collection("bots").stream()
-    bots = []
-    for doc in bots_ref:
-        data = doc.to_dict()
-        bots.append({
-            "name": data.get("name"),
-            "file": doc.id,
-            "persona": data.get("persona", "")
-        })
-    return bots
+    return get_backend().get_user_bots(username)
 
 
-def get_bot_file(username: str, bot_name: str):
+@span("storage.get_bot")
+def get_bot(username: str, bot_id: str):
+    """
+    Get one bot as {id, name, file_text, persona}, or None if it doesn't exist.
+    """
+    return get_backend().get_bot(username, bot_id)
+
+
+@span("storage.get_bots")
+def get_bots(username: str, bot_ids) -> dict:
+    """
+    {bot_id: bot} for several bots in one round trip (Firestore get_all,
+    one SQLite query). Missing bots are left out.
+    """
+    bot_ids = list(bot_ids)
+    if not bot_ids:
+        return {}
+    return get_backend().get_bots(username, bot_ids)
+
+
+@span("storage.get_bot_file")
+def get_bot_file(username: str, bot_id: str):
     """
     Get the bot's full text content and optional persona.
     Returns (file_text, persona)
     """
-    doc_ref = db.collection(USERS_COLLECTION).document(username).collection("bots").document(bot_name.lower()).get()
-    if doc_ref.exists:
-        data = doc_ref.to_dict()
-        return data.get("file_text", ""), data.get("persona", "")
+    bot = get_bot(username, bot_id)
+    if bot:
+        return bot["file_text"], bot["persona"]
     return "", ""
 
 
-def update_bot(username: str, old_name: str, new_name: str, new_file_text: str = None):
+@span("storage.update_bot")
+def update_bot(username: str, bot_id: str, new_name: str, new_file_text: str = None):
     """
-    Rename a bot or update its file text.
-    Creates a new document and deletes the old one.
+    Rename a bot and/or replace its file text.
+    A rename is a single field update on the same record — history,
+    persisted indexes and caches are keyed by id / content and stay valid.
+    A missing bot is a no-op.
     """
-    user_ref = db.collection(USERS_COLLECTION).document(username)
-    old_ref = user_ref.collection("bots").document(old_name.lower())
-    old_doc = old_ref.get()
-
-    if not old_doc.exists:
-        return
+    get_backend().update_bot(username, bot_id, new_name, new_file_text)
 
-    data = old_doc.to_dict()
-    data["name"] = new_name
-    if new_file_text:
-        data["file_text"] = new_file_text
 
-    # Create new doc, then delete old
-    new_ref = user_ref.collection("bots").document(new_name.lower())
-    new_ref.set(data)
-    old_ref.delete()
+@span("storage.extend_bot")
+def extend_bot(username: str, bot_id: str, base_hash: str, file_text: str, last_message_at: str = None,
+               stamp_format: str = None) -> bool:
+    """
+    Replace a bot's corpus with an extended one (see ingest.append_export),
+    only if it still has content hash base_hash. Returns False if the bot
+    is gone or another update got there first.
+    """
+    return get_backend().extend_bot(username, bot_id, base_hash, file_text, last_message_at, stamp_format)
 
 
-def delete_bot(username: str, bot_name: str):
+@span("storage.delete_bot")
+def delete_bot(username: str, bot_id: str) -> dict:
     """
-    Delete a bot and its data from Firestore.
+    Delete a bot and everything derived from it: the bot itself, its chat
+    history, and its persisted index files if no other bot shares the same
+    content. Returns {docs_deleted, files_deleted, bytes_reclaimed}.
     """
-    db.collection(USERS_COLLECTION).document(username).collection("bots").document(bot_name.lower()).delete()
+    return get_backend().delete_bot(username, bot_id)
 
 
-def update_bot_persona(username: str, bot_name: str, persona_text: str):
+@span("storage.update_bot_persona")
+def update_bot_persona(username: str, bot_id: str, persona_text: str):
     """
     Update only the persona field for a bot.
     """
-    doc_ref = db.collection(USERS_COLLECTION).document(username).collection("bots").document(bot_name.lower())
-    if doc_ref.get().exists:
-        doc_ref.update({"persona": persona_text})
+    get_backend().update_bot_persona(username, bot_id, persona_text)
 
 
 # =========================================================
-# 💬 Chat History (Cloud Stored)
+# 💬 Chat History
 # =========================================================
-def save_chat_history_cloud(user: str, bot: str, history: list) -> None:
+@span("storage.save_chat_history_cloud")
+def save_chat_history_cloud(user: str, bot_id: str, history: list, start: int = 0) -> None:
     """
-    Save chat history to Firestore under:
-      users/{user}/chats/{bot}
+    Save a bot's chat history for `user` (replaces what was stored).
+    With start > 0, `history` is the turns from that position on and the
+    older ones stay as they are (a session window, see session_history).
+    (bots created before stable ids use their lowercased name as id, which is
+    where their history already lives)
     """
-    db.collection(USERS_COLLECTION).document(user).collection("chats").document(bot.lower()).set({
-        "history": history
-    })
+    get_backend().save_chat_history(user, bot_id, history, start)
 
 
-def load_chat_history_cloud(user: str, bot: str) -> list:
+@span("storage.load_chat_history_cloud")
+def load_chat_history_cloud(user: str, bot_id: str) -> list:
     """
-    Load chat history from Firestore.
+    Load chat history.
     Returns an empty list if no history found.
     """
-    doc = db.collection(USERS_COLLECTION).document(user).collection("chats").document(bot.lower()).get()
-    if doc.exists:
-        return doc.to_dict().get("history", [])
-    return []
+    return get_backend().load_chat_history(user, bot_id)
+
+
+@span("storage.load_history_page")
+def load_history_page(user: str, bot_id: str, limit: int = 50, before: int = None) -> dict:
+    """
+    One page of history, oldest first: {"turns": [...], "before": cursor}.
+    Pass `before` back in for the previous page; it is None at the start.
+    """
+    return get_backend().load_history_page(user, bot_id, limit, before)
+
+
+@span("storage.load_history_range")
+def load_history_range(user: str, bot_id: str, start: int = 0, limit: int = 200) -> list:
+    """Turns at positions [start, start + limit), oldest first."""
+    return get_backend().load_history_range(user, bot_id, start, limit)
+
+
+def iter_history_pages(user: str, bot_id: str, start: int = 0, page_size: int = 200):
+    """Yield the history from position `start` on, page_size turns at a time."""
+    return get_backend().iter_history_pages(user, bot_id, start, page_size)
+
+
+@span("storage.clear_history")
+def clear_history(user: str, bot_id: str) -> dict:
+    """Remove a bot's chat history. Returns {docs_deleted, bytes_reclaimed}."""
+    return get_backend().clear_history(user, bot_id)
+
+
+@span("storage.load_chat_view")
+def load_chat_view(username: str, bot_id: str = None, history_limit: int = None) -> dict:
+    """
+    {"bots", "bot", "history", "history_start"} for the Chat tab (concurrent
+    reads on Firestore). Falls back to the first bot if bot_id is missing or
+    gone. history_limit: only the newest turns (0: skip the history read).
+    """
+    return get_backend().load_chat_view(username, bot_id, history_limit)
+
+
+def gc_sweep(dry_run: bool = False) -> dict:
+    """Orphan sweep on the active backend (see cleanup.gc_sweep for the report)."""
+    return get_backend().gc_sweep(dry_run=dry_run)
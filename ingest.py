@@ -0,0 +1,174 @@
+import hashlib
+from collections import Counter
+from datetime import datetime
+
+from firebase_db import extend_bot, get_bot
+from retrieval import bot_index_hash, extend_index, join_corpus, split_lines
+
+# =========================================================
+# 📥 Chat export parsing
+# =========================================================
+def parse_messages(raw_text, bot_name):
+    """
+    (timestamp text, message) for each of that person's messages in a
+    WhatsApp-style chat export, e.g.
+    12/04/2023, 5:22 pm - Raykay: message
+    """
+    messages = []
+    name_lower = bot_name.strip().lower()
+
+    for line in raw_text.splitlines():
+        if "-" not in line or ":" not in line:
+            continue
+
+        try:
+            # Example: "12/04/2023, 5:22 pm - Raykay: Hello"
+            meta, msg = line.split("-", 1)
+            speaker, content = msg.split(":", 1)
+            speaker = speaker.strip().lower()
+            content = content.strip()
+        except:
+            continue
+
+        if speaker == name_lower and len(content.split()) > 1:
+            # remove emojis or keep? keep them.
+            messages.append((meta.strip(), content))
+
+    return messages
+
+
+def extract_bot_lines(raw_text, bot_name):
+    """
+    Extract only that person's messages from WhatsApp-style chat exports.
+    Supports formats like:
+    12/04/2023, 5:22 pm - Raykay: message
+    """
+    return "\n".join(content for _, content in parse_messages(raw_text, bot_name))
+
+
+# =========================================================
+# 🕒 Message timestamps
+# =========================================================
+# Exports use the phone's locale: day/month or month/day, 12h or 24h.
+# One export uses one format, so pick the first that parses every stamp
+# (which also settles 04/05 vs 05/04 from the unambiguous dates around it).
+# The format is saved with the bot's watermark; a later export is read in
+# it, since that export alone may not have a day above 12 to settle it.
+STAMP_FORMATS = (
+    "%d/%m/%Y, %I:%M %p", "%m/%d/%Y, %I:%M %p", "%d/%m/%y, %I:%M %p", "%m/%d/%y, %I:%M %p",
+    "%d/%m/%Y, %H:%M", "%m/%d/%Y, %H:%M", "%d/%m/%y, %H:%M", "%m/%d/%y, %H:%M",
+    "%d.%m.%y, %H:%M", "%d.%m.%Y, %H:%M", "%Y-%m-%d, %H:%M",
+)
+
+
+def _clean_stamp(stamp):
+    # newer exports put a narrow no-break space before am/pm
+    return " ".join(stamp.replace("\u202f", " ").replace("\xa0", " ").split())
+
+
+def _parse_stamp(stamp, fmt):
+    try:
+        return datetime.strptime(_clean_stamp(stamp), fmt)
+    except ValueError:
+        return None
+
+
+def stamp_formats(stamps):
+    """Every STAMP_FORMATS entry that parses all the stamps, in order."""
+    stamps = [s for s in stamps if s]
+    if not stamps:
+        return []
+    return [fmt for fmt in STAMP_FORMATS if all(_parse_stamp(s, fmt) for s in stamps)]
+
+
+def stamp_format(stamps, saved=None):
+    """
+    The format to read these stamps with, or None if it can't be settled.
+    `saved` (the format an earlier export of this chat was read with) wins
+    when it still fits. Otherwise the fitting formats must all give the
+    same times: an export whose days are all <= 12 fits both day/month and
+    month/day, and guessing there would shift every later watermark.
+    """
+    fits = stamp_formats(stamps)
+    if saved in fits:
+        return saved
+    if not fits:
+        return None
+    readings = {tuple(_parse_stamp(s, fmt) for s in stamps if s) for fmt in fits}
+    return fits[0] if len(readings) == 1 else None
+
+
+# =========================================================
+# ➕ Appending a newer export to an existing bot
+# =========================================================
+def _line_hash(text):
+    return hashlib.sha1(text.encode("utf-8", "ignore")).digest()
+
+
+def select_new_messages(messages, existing_lines, watermark=None, watermark_format=None):
+    """
+    Which parsed messages (parse_messages) aren't in the bot yet.
+    Returns (new message texts in export order, newest message time as ISO
+    text or None, the stamp format it was read with or None).
+
+    With a watermark (newest message time already ingested) and stamps that
+    read unambiguously in the format the watermark was taken with,
+    everything after it is new; messages in the watermark minute, and ones
+    with no stamp at all, are new unless the bot has that text. Otherwise — bots from before watermarks
+    were kept, a format that can't be settled, or stamps we can't read —
+    messages are matched against the corpus by content hash, counting
+    repeats, so an export that overlaps the old one only contributes what
+    it adds.
+    """
+    fmt = stamp_format([stamp for stamp, _ in messages], saved=watermark_format)
+    times = [_parse_stamp(stamp, fmt) for stamp, _ in messages] if fmt else [None] * len(messages)
+    newest = max((t for t in times if t), default=None)
+    if watermark and fmt and fmt == watermark_format:
+        mark = datetime.fromisoformat(watermark)
+        if newest is None or newest < mark:
+            newest = mark
+        known = {_line_hash(line) for line in existing_lines}
+        new = [text for (_, text), t in zip(messages, times)
+               if (t is not None and t > mark)
+               or ((t is None or t == mark) and _line_hash(text) not in known)]
+    else:
+        remaining = Counter(_line_hash(line) for line in existing_lines)
+        new = []
+        for _, text in messages:
+            h = _line_hash(text)
+            if remaining[h]:
+                remaining[h] -= 1
+            else:
+                new.append(text)
+        if newest is None:
+            return new, watermark, watermark_format   # keep the old watermark
+        if watermark and fmt == watermark_format:
+            newest = max(newest, datetime.fromisoformat(watermark))
+    return new, newest.isoformat(timespec="minutes"), fmt
+
+
+def append_export(user, bot_id, raw_text, speaker=None, shared=None, admit=None):
+    """
+    Add the messages in a newer export of the same chat to an existing bot.
+    Only new messages are embedded (retrieval.extend_index); the bot's
+    corpus and watermark are then swapped in with a compare-and-set.
+    Returns {"parsed", "new", "skipped", "content_hash"}; raises ValueError
+    for an unknown bot and RuntimeError if the bot changed meanwhile.
+    """
+    bot = get_bot(user, bot_id)
+    if not bot:
+        raise ValueError(f"Unknown bot {bot_id!r}")
+    base_text = bot.get("file_text", "")
+    base_hash = bot.get("content_hash") or bot_index_hash(base_text)
+    messages = parse_messages(raw_text, speaker or bot.get("name", ""))
+    existing = split_lines(base_text) if base_text.strip() else []
+    new, newest, fmt = select_new_messages(messages, existing, bot.get("last_message_at"), bot.get("stamp_format"))
+    report = {"parsed": len(messages), "new": len(new), "skipped": len(messages) - len(new),
+              "content_hash": base_hash}
+    if not new:
+        return report
+    bot_index = extend_index(base_text, new, shared=shared, admit=admit)
+    if not extend_bot(user, bot_id, base_hash, join_corpus(base_text, new), newest, fmt):
+        raise RuntimeError("The bot was changed while appending; try again.")
+    report["content_hash"] = bot_index.key
+    return report
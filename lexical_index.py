@@ -0,0 +1,133 @@
+import json
+import math
+import re
+from array import array
+from collections import Counter, defaultdict
+
+from query_cache import normalize_query
+
+# =========================================================
+# 🔤 BM25 inverted index
+# =========================================================
+# Kept next to each bot's FAISS index. Catches exact slang, nicknames and place
+# names that MiniLM blurs, and answers short keyword queries without an
+# encoder pass. Postings are compact arrays (doc ids + term frequencies).
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60
+FORMAT_VERSION = 2   # bump when tokenize() changes: older saved indexes are rebuilt
+
+
+def tokenize(text: str) -> list:
+    return _TOKEN_RE.findall(normalize_query(text))
+
+
+class BM25Index:
+    def __init__(self):
+        self.postings = {}          # term -> (array('I') doc ids, array('I') tfs)
+        self.doc_len = array("I")
+        self.avgdl = 0.0
+
+    @classmethod
+    def build(cls, lines) -> "BM25Index":
+        self = cls()
+        self._add(lines)
+        return self
+
+    def extended(self, lines) -> "BM25Index":
+        """A copy with `lines` appended as new docs (ids continue from len(self))."""
+        new = BM25Index()
+        new.doc_len = array("I", self.doc_len)
+        new.postings = {t: (array("I", ids), array("I", tfs)) for t, (ids, tfs) in self.postings.items()}
+        new._add(lines)
+        return new
+
+    def _add(self, lines) -> None:
+        # new doc ids are larger than every existing one, so postings stay sorted
+        postings = self.postings
+        for doc_id, line in enumerate(lines, start=len(self.doc_len)):
+            toks = tokenize(line)
+            self.doc_len.append(len(toks))
+            for term, tf in Counter(toks).items():
+                entry = postings.get(term)
+                if entry is None:
+                    entry = postings[term] = (array("I"), array("I"))
+                entry[0].append(doc_id)
+                entry[1].append(tf)
+        self.avgdl = (sum(self.doc_len) / len(self.doc_len)) if self.doc_len else 0.0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def idf(self, term: str) -> float:
+        n = len(self.postings[term][0]) if term in self.postings else 0
+        return math.log(1 + (len(self.doc_len) - n + 0.5) / (n + 0.5))
+
+    def search(self, query: str, k: int = 20) -> list:
+        """
+        Returns [(doc_id, score), ...] best first; empty if no query term
+        occurs in the corpus.
+        """
+        scores = defaultdict(float)
+        avgdl = self.avgdl or 1.0
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            idf = self.idf(term)
+            ids, tfs = self.postings[term]
+            for doc_id, tf in zip(ids, tfs):
+                dl = self.doc_len[doc_id]
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+        return sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:k]
+
+    def is_keyword_query(self, query: str, max_terms: int = 3, min_idf: float = 2.0) -> bool:
+        """
+        Short query containing at least one rare corpus term (a nickname,
+        place, slang word) — the lexical index alone is a good answer.
+        """
+        toks = tokenize(query)
+        if not toks or len(toks) > max_terms:
+            return False
+        return any(t in self.postings and self.idf(t) >= min_idf for t in toks)
+
+    # ---- persistence ----
+    def to_dict(self) -> dict:
+        return {
+            "v": FORMAT_VERSION,
+            "avgdl": self.avgdl,
+            "doc_len": self.doc_len.tolist(),
+            "postings": {t: [ids.tolist(), tfs.tolist()] for t, (ids, tfs) in self.postings.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BM25Index":
+        if data.get("v") != FORMAT_VERSION:
+            raise ValueError(f"BM25 index format {data.get('v')}, expected {FORMAT_VERSION}")
+        self = cls()
+        self.avgdl = data["avgdl"]
+        self.doc_len = array("I", data["doc_len"])
+        self.postings = {t: (array("I", ids), array("I", tfs)) for t, (ids, tfs) in data["postings"].items()}
+        return self
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def rrf_fuse(*rankings, k: int = 20, rrf_k: int = RRF_K) -> list:
+    """
+    Reciprocal rank fusion of several ranked id lists -> fused id list.
+    """
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] += 1.0 / (rrf_k + rank + 1)
+    return [d for d, _ in sorted(scores.items(), key=lambda kv: (-kv[1], kv[0]))[:k]]
@@ -0,0 +1,125 @@
+import mmap
+import os
+import struct
+import sys
+import uuid
+from array import array
+
+# =========================================================
+# 🗃️ Compact corpus line store
+# =========================================================
+# One UTF-8 buffer + an offsets table instead of a list of str:
+#
+#   header   b"CDLINES1" + uint32 count           (12 bytes)
+#   offsets  uint32[count + 1], little endian     (line i = blob[off[i]:off[i+1]])
+#   blob     the lines, UTF-8, back to back
+#
+# Files are memory-mapped read-only, so every process on the node shares
+# the same page-cache pages, and only the lines actually returned by a
+# search get decoded into Python strings.
+
+MAGIC = b"CDLINES1"
+_HEADER = struct.Struct("<8sI")
+_NATIVE_LE = sys.byteorder == "little"
+
+
+def encode_lines(lines) -> bytes:
+    """Serialize lines into the on-disk format."""
+    offsets = array("I", [0])
+    chunks = []
+    pos = 0
+    for line in lines:
+        data = line.encode("utf-8")
+        chunks.append(data)
+        pos += len(data)
+        offsets.append(pos)
+    if pos > 0xFFFFFFFF:
+        raise ValueError("corpus too large for a line store (> 4 GiB)")
+    if not _NATIVE_LE:
+        offsets.byteswap()
+    return _HEADER.pack(MAGIC, len(offsets) - 1) + offsets.tobytes() + b"".join(chunks)
+
+
+class LineStore:
+    """
+    Read-only sequence of corpus lines (FAISS id == position).
+    Open a file with LineStore.open(path), or wrap in-memory bytes with
+    LineStore.from_lines(lines) when nothing is persisted.
+    """
+
+    def __init__(self, buf, mm=None, path=None):
+        magic, count = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("not a line store")
+        start = _HEADER.size
+        end = start + 4 * (count + 1)
+        if len(buf) < end:
+            raise ValueError("truncated line store")
+        self._buf = memoryview(buf)
+        if _NATIVE_LE:
+            self._offsets = self._buf[start:end].cast("I")   # zero-copy view into the map
+        else:
+            self._offsets = array("I", bytes(self._buf[start:end]))
+            self._offsets.byteswap()
+        self._base = end
+        self._count = count
+        self._mm = mm
+        self.path = path
+        if self._base + self._offsets[count] != len(buf):
+            raise ValueError("corrupt line store")
+
+    @classmethod
+    def open(cls, path: str) -> "LineStore":
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mm, mm=mm, path=path)
+
+    @classmethod
+    def from_lines(cls, lines) -> "LineStore":
+        return cls(encode_lines(lines))
+
+    @staticmethod
+    def write(path: str, lines) -> None:
+        """
+        Atomically write lines to path (temp file + rename). The temp name is
+        unique, so processes writing the same store don't share one file.
+        """
+        data = encode_lines(lines)
+        tmp = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("line id out of range")
+        a, b = self._offsets[i], self._offsets[i + 1]
+        return str(self._buf[self._base + a:self._base + b], "utf-8")
+
+    def __iter__(self):
+        for i in range(self._count):
+            yield self[i]
+
+    def get_many(self, ids) -> list:
+        """Decode just these lines (FAISS / BM25 result ids); unknown ids are skipped."""
+        return [self[i] for i in ids if 0 <= i < self._count]
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._buf)
+
+    @property
+    def mapped(self) -> bool:
+        return self._mm is not None
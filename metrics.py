@@ -0,0 +1,250 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# =========================================================
+# 📈 In-process metrics: timers, counters, request traces
+# =========================================================
+# Everything lives in one process-wide registry. Durations keep a bounded
+# window of recent samples for percentiles plus lifetime count/sum.
+# Exported as Prometheus text (render_prometheus / start_metrics_server)
+# or as JSON log lines per traced request (CHATDOUBLE_TRACE_LOG=1).
+
+SAMPLE_WINDOW = int(os.getenv("METRICS_SAMPLE_WINDOW", "2048"))
+QUANTILES = (0.5, 0.95, 0.99)
+
+log = logging.getLogger("chatdouble.trace")
+
+_lock = threading.Lock()
+_timings = {}       # name -> {"count", "sum", "samples": deque}
+_counters = {}      # name -> float
+_collectors = []    # callables returning {name: value} gauges
+_server = None
+
+_trace = contextvars.ContextVar("chatdouble_trace", default=None)
+
+
+def _metric_name(name: str) -> str:
+    return "chatdouble_" + "".join(c if c.isalnum() else "_" for c in name)
+
+
+# ---- recording ----
+def observe(name: str, seconds: float) -> None:
+    """Record one duration sample for `name` (and on the active trace)."""
+    with _lock:
+        t = _timings.get(name)
+        if t is None:
+            t = _timings[name] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=SAMPLE_WINDOW)}
+        t["count"] += 1
+        t["sum"] += seconds
+        t["samples"].append(seconds)
+    tr = _trace.get()
+    if tr is not None:
+        tr["spans"].append({"name": name, "ms": round(seconds * 1000, 2)})
+
+
+def inc(name: str, value: float = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def register_collector(fn) -> None:
+    """fn() -> {name: number}; read at export time (e.g. cache sizes/hit counts)."""
+    if fn not in _collectors:
+        _collectors.append(fn)
+
+
+class span:
+    """
+    Time a block (or a function, as a decorator) under `name`:
+
+        with span("storage.get_bot_file"):
+            ...
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self.t0)
+        if exc_type is not None:
+            inc(f"{self.name}.errors")
+        return False
+
+    def __call__(self, fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(self.name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(self.name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+class trace:
+    """
+    Group every span recorded in this block into one request trace.
+    With CHATDOUBLE_TRACE_LOG=1 each finished trace is logged as one JSON line.
+    """
+
+    def __init__(self, name: str, **attrs):
+        self.record = {"trace_id": uuid.uuid4().hex[:16], "name": name, "attrs": attrs, "spans": []}
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        self.token = _trace.set(self.record)
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        _trace.reset(self.token)
+        elapsed = time.perf_counter() - self.t0
+        observe(f"request.{self.record['name']}", elapsed)
+        self.record["ms"] = round(elapsed * 1000, 2)
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        if os.getenv("CHATDOUBLE_TRACE_LOG", "0") == "1":
+            log.info(json.dumps(self.record, default=str))
+        return False
+
+
+def current_trace():
+    return _trace.get()
+
+
+def attach_trace(record) -> None:
+    """
+    Continue `record` (from current_trace()) in another thread / asyncio task,
+    so spans recorded there still land on the originating request.
+    """
+    if record is not None:
+        _trace.set(record)
+
+
+def record_token_usage(resp, model: str = "") -> None:
+    """Add Gemini usage_metadata (prompt/output/total tokens) to the counters."""
+    usage = getattr(resp, "usage_metadata", None)
+    if usage is None and isinstance(resp, dict):
+        usage = resp.get("usage_metadata")
+    if not usage:
+        return
+    get = usage.get if isinstance(usage, dict) else (lambda k: getattr(usage, k, None))
+    for field, name in (("prompt_token_count", "prompt"), ("candidates_token_count", "output"),
+                        ("total_token_count", "total")):
+        n = get(field)
+        if n:
+            inc(f"gemini.tokens.{name}", n)
+            tr = _trace.get()
+            if tr is not None:
+                tr["attrs"][f"tokens_{name}"] = tr["attrs"].get(f"tokens_{name}", 0) + n
+    inc("gemini.calls")
+    if model:
+        inc(f"gemini.calls.{model}")
+
+
+# ---- export ----
+def _quantile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    i = min(len(sorted_vals) - 1, max(0, int(round(q * (len(sorted_vals) - 1)))))
+    return sorted_vals[i]
+
+
+def snapshot() -> dict:
+    """
+    {"timings": {name: {count, sum, p50, p95, p99}}, "counters": {...}, "gauges": {...}}
+    Percentiles are over the most recent SAMPLE_WINDOW samples.
+    """
+    with _lock:
+        timings = {n: (t["count"], t["sum"], sorted(t["samples"])) for n, t in _timings.items()}
+        counters = dict(_counters)
+    out = {"timings": {}, "counters": counters, "gauges": {}}
+    for name, (count, total, vals) in sorted(timings.items()):
+        row = {"count": count, "sum": round(total, 6)}
+        for q in QUANTILES:
+            row[f"p{int(q * 100)}"] = round(_quantile(vals, q), 6)
+        out["timings"][name] = row
+    for fn in list(_collectors):
+        try:
+            out["gauges"].update(fn() or {})
+        except Exception:
+            pass
+    return out
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition format (summaries, counters, gauges)."""
+    snap = snapshot()
+    lines = []
+    for name, row in snap["timings"].items():
+        m = _metric_name(name) + "_seconds"
+        lines.append(f"# TYPE {m} summary")
+        for q in QUANTILES:
+            lines.append(f'{m}{{quantile="{q}"}} {row[f"p{int(q * 100)}"]}')
+        lines.append(f"{m}_sum {row['sum']}")
+        lines.append(f"{m}_count {row['count']}")
+    for name, value in sorted(snap["counters"].items()):
+        m = _metric_name(name) + "_total"
+        lines.append(f"# TYPE {m} counter")
+        lines.append(f"{m} {value}")
+    for name, value in sorted(snap["gauges"].items()):
+        m = _metric_name(name)
+        lines.append(f"# TYPE {m} gauge")
+        lines.append(f"{m} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset() -> None:
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> bool:
+    """
+    Serve /metrics (Prometheus) and /metrics.json on a daemon thread.
+    Streamlit can't add routes, so this listens on its own port (METRICS_PORT).
+    Returns True if this call started it.
+    """
+    global _server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, ctype = json.dumps(snapshot()).encode(), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, ctype = render_prometheus().encode(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    with _lock:
+        if _server is not None:
+            return False
+        _server = ThreadingHTTPServer((host, int(port)), Handler)
+    threading.Thread(target=_server.serve_forever, name="chatdouble-metrics", daemon=True).start()
+    return True
@@ -0,0 +1,357 @@
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime
+
+from metrics import inc, observe, record_token_usage, trace
+from query_cache import LRUCache
+from retrieval import hybrid_search
+from scheduler import INTERACTIVE, QuotaExceeded, estimate_tokens
+from singleflight import SingleFlight
+
+# =========================================================
+# ⚙️ Generation settings
+# =========================================================
+TOP_K = 20                 # FAISS candidates per query
+MAX_EXAMPLES = 12          # examples kept after rerank
+MAX_EXAMPLES_CHARS = 3000
+MAX_HISTORY_CHARS = 4000
+MODELS = ("gemini-2.0-flash-exp", "gemini-2.0-flash")   # primary, fallback
+OFFLINE_REPLY = "⚠️Offline (Text after sometime)"
+NO_KEY_REPLY = "⚠️ Gemini API key not set. Add GEMINI_API_KEY to environment or Streamlit secrets."
+RATE_LIMITED_REPLY = "⚠️ You're sending messages too fast — wait a few seconds and try again."
+# shown in place of a reply; saved with "error": True and left out of prompts
+ERROR_REPLIES = (OFFLINE_REPLY, NO_KEY_REPLY, RATE_LIMITED_REPLY)
+REPLY_CACHE_TTL = 24 * 3600  # seconds a generated reply stays in the shared cache
+DOUBLE_SEND_WINDOW = 3.0     # seconds in which an identical message counts as a double-click
+
+STAGES = ("retrieve", "rerank", "assemble", "generate", "persist")
+
+
+def new_turn(user_msg: str) -> dict:
+    """
+    A pending chat turn. `id` makes every turn addressable so the
+    pipeline can process it exactly once. `at` (ISO date-time) is what
+    history exports filter on; `ts` is the display time.
+    """
+    now = datetime.now()
+    return {"id": uuid.uuid4().hex, "user": user_msg, "bot": "", "ts": now.strftime("%I:%M %p"),
+            "at": now.isoformat(timespec="seconds")}
+
+
+def is_double_send(history: list, user_msg: str, window_s: float = DOUBLE_SEND_WINDOW) -> bool:
+    """
+    True if user_msg repeats the last turn and that turn is still pending or
+    was sent less than window_s ago (double-click on send, rerun mid-send).
+    """
+    if not history or not isinstance(history[-1], dict):
+        return False
+    last = history[-1]
+    if last.get("user", "").strip() != user_msg.strip():
+        return False
+    if last.get("bot") == "":
+        return True
+    try:
+        age = (datetime.now() - datetime.fromisoformat(last.get("at", ""))).total_seconds()
+    except ValueError:
+        return False
+    return age < window_s
+
+
+def turn_id(user: str, bot_id: str, history: list, pos: int, start: int = 0) -> str:
+    """
+    ID of the turn at position pos (history holds the turns from position
+    start on); older turns saved before IDs existed get a positional one.
+    """
+    return history[pos - start].get("id") or f"{user}:{bot_id}:{pos}"
+
+
+def response_text(resp) -> str:
+    """Text from a genai response/chunk (supports dict-like and object-like)."""
+    if resp is None:
+        return ""
+    if isinstance(resp, dict):
+        return resp.get("message", {}).get("content", "") or resp.get("text", "") or ""
+    return getattr(resp, "text", None) or ""
+
+
+# =========================================================
+# 🧾 Per-turn context
+# =========================================================
+class TurnContext:
+    """
+    Everything the stages read and write for one pending turn.
+    """
+
+    def __init__(self, user, bot_name, history, bot_text, persona="", on_text=None, bot_id=None,
+                 history_start=0):
+        self.user = user
+        self.bot_name = bot_name        # display name, used in the prompt
+        self.bot_id = bot_id or bot_name  # storage key for history
+        self.history = history          # the turns from position history_start on (a session window)
+        self.history_start = history_start
+        self.pos = history_start + len(history) - 1
+        self.turn = history[-1]
+        self.turn_id = turn_id(user, self.bot_id, history, self.pos, history_start)
+        self.user_msg = self.turn.get("user", "")
+        self.bot_text = bot_text or ""
+        self.persona = persona or ""
+        self.on_text = on_text          # optional callback(partial_text) while streaming
+        self.candidates = []            # retrieved lines (rank order)
+        self.examples = []              # lines after rerank
+        self.prompt = ""
+        self.reply = ""
+        self.model = None
+        self.timings = {}
+
+
+def metrics_hook(stage, seconds, ctx):
+    """Default hook: per-stage latency into the metrics registry."""
+    observe(f"chat.{stage}", seconds)
+
+
+# =========================================================
+# 🔁 Pipeline
+# =========================================================
+class GenerationPipeline:
+    """
+    retrieve -> rerank -> assemble -> generate -> persist
+
+    Stages are plain callables taking a TurnContext and can be swapped with
+    set_stage(). Hooks registered with add_hook() are called as
+    hook(stage, seconds, ctx) after every stage.
+
+    Turns are single-flighted by ID: a rerun or a second session thread that
+    asks for a turn already in progress waits for that run and gets its reply,
+    so the same turn is never retrieved or generated twice.
+    """
+
+    def __init__(self, index_for, query_cache, client_getter, persist, k=TOP_K, shared=None, scheduler=None):
+        self.index_for = index_for              # (bot_text, user) -> retrieval.BotIndex
+        self.query_cache = query_cache
+        self.client_getter = client_getter      # () -> genai client or None
+        self.persist = persist                  # (user, bot_id, history, start=) -> None
+        self.k = k
+        self.shared = shared                    # cache_tier.CacheTier: replies shared across replicas
+        self.scheduler = scheduler              # scheduler.FairScheduler: per-user quotas, fair share of Gemini
+        self.stages = [(name, getattr(self, f"stage_{name}")) for name in STAGES]
+        self.hooks = [metrics_hook]
+        self._flights = SingleFlight("chat.turns")
+        self._done = LRUCache(10000)
+
+    # ---- extension points ----
+    def set_stage(self, name: str, fn) -> None:
+        if name not in STAGES:
+            raise ValueError(f"unknown stage {name!r}")
+        self.stages = [(n, fn if n == name else f) for n, f in self.stages]
+
+    def add_hook(self, fn) -> None:
+        self.hooks.append(fn)
+
+    # ---- idempotency ----
+    def in_flight(self, tid: str) -> bool:
+        return self._flights.in_flight(tid)
+
+    def is_pending(self, history: list) -> bool:
+        return bool(history) and isinstance(history[-1], dict) and history[-1].get("bot") == ""
+
+    # ---- run ----
+    def run(self, ctx: TurnContext):
+        """
+        Run all stages for ctx and return the reply. If the same turn is
+        already running, wait for it and take its reply (also written into
+        ctx.turn). Returns None if the turn was already answered before
+        this call; one answered while it was claiming the turn gets that
+        reply instead of a second generation.
+        """
+        if ctx.turn.get("bot") or self._done.get(ctx.turn_id) is not None:
+            inc("chat.turns.deduplicated")
+            return None
+        reply, _ = self._flights.do(ctx.turn_id, lambda: self._run_once(ctx))
+        if reply and not ctx.turn.get("bot"):
+            # answered by another run (shared flight, or one that finished
+            # between the check above and claiming the flight)
+            ctx.reply = reply
+            ctx.turn["bot"] = reply
+        return reply
+
+    def _run_once(self, ctx):
+        # checked again under the flight: a run that finished after run()'s
+        # check has released it, and this one must not generate the turn again
+        done = ctx.turn.get("bot") or self._done.get(ctx.turn_id)
+        if done:
+            inc("chat.turns.deduplicated")
+            return done
+        with trace("chat_turn", bot=ctx.bot_name, turn_id=ctx.turn_id):
+            self._run_stages(ctx)
+        # only completed turns count as done; an interrupted one can be retried
+        self._done.put(ctx.turn_id, ctx.reply or OFFLINE_REPLY)
+        inc("chat.turns")
+        return ctx.reply
+
+    def _run_stages(self, ctx):
+        for name, fn in self.stages:
+            t0 = time.perf_counter()
+            fn(ctx)
+            ctx.timings[name] = time.perf_counter() - t0
+            for hook in self.hooks:
+                try:
+                    hook(name, ctx.timings[name], ctx)
+                except Exception:
+                    pass
+
+    # ---- stages ----
+    def stage_retrieve(self, ctx):
+        if not ctx.bot_text.strip() or not ctx.user_msg:
+            return
+        try:
+            # a build's encoder pass is charged to this user's quota
+            bot_index = self.index_for(ctx.bot_text, ctx.user)
+            ids = hybrid_search(bot_index, ctx.user_msg, k=self.k, query_cache=self.query_cache)
+        except QuotaExceeded:
+            inc("chat.rate_limited")
+            ctx.reply = RATE_LIMITED_REPLY
+            return
+        except Exception:
+            inc("chat.retrieve_errors")   # answer without examples
+            return
+        # decodes only the k returned lines from the (memory-mapped) store
+        ctx.candidates = bot_index.lines.get_many(ids)
+
+    def stage_rerank(self, ctx):
+        # prefer substantive lines (> 2 words), drop duplicates, keep rank order
+        seen = set()
+        picked = []
+        for line in ctx.candidates:
+            line = line.strip()
+            if line and line not in seen and len(line.split()) > 2:
+                seen.add(line)
+                picked.append(line)
+        if not picked:
+            picked = [l.strip() for l in ctx.candidates if l.strip()]
+        ctx.examples = picked[:MAX_EXAMPLES]
+
+    def stage_assemble(self, ctx):
+        history_lines = []
+        for entry in ctx.history:
+            if "user" in entry:
+                history_lines.append(f"User: {entry['user']}")
+            if "bot" in entry and not entry.get("error"):
+                history_lines.append(f"{ctx.bot_name}: {entry['bot']}")
+        recent_history = "\n".join(history_lines)
+        if len(recent_history) > MAX_HISTORY_CHARS:
+            recent_history = recent_history[-MAX_HISTORY_CHARS:]
+
+        retrieved_examples = "\n".join(ctx.examples)[:MAX_EXAMPLES_CHARS]
+        persona_block = f"Persona: {ctx.persona}\n\n" if ctx.persona else ""
+
+        ctx.prompt = f"""{persona_block}
+You are a real person (not an AI) who previously chatted with the user.
+
+RULES:
+1) Use all facts found in the 'Recent conversation' below. Do NOT contradict them.
+2) Detect your real name from the examples (the text before ":" in the examples).
+Do NOT invent names or placeholders like {{User's Name}}.
+3) If persona above is empty, infer a personality from the examples & stick to it.
+4) If you don't know a fact, ask — don't assume.
+STRICT RULES:
+- NEVER use placeholders like [User], [User's Name], {{user}}, <name>, or anything inside {{}}, [], <>.
+- NEVER guess names. ONLY use names that actually exist inside the real chat data.
+- If you do NOT know a name from the real examples, say “I don’t know, you never told me.”
+- NEVER invent formatting like **bold**, __underline__, *, ~, or any markdown.
+- NEVER use too many emojis in a reply, use them as same frequency in chat. Keep it natural, not exaggerated and hallucinated.
+- NEVER talk like an assistant or narrator. Just speak casually like in the chat data.
+
+--- Recent conversation ---
+{recent_history}
+
+--- Examples from real exported chat ---
+{retrieved_examples}
+
+Continue the conversation naturally, same tone and slang.
+
+User: {ctx.user_msg}
+{ctx.bot_name}:
+"""
+
+    def stage_generate(self, ctx):
+        if ctx.reply == RATE_LIMITED_REPLY:
+            return   # retrieval already ran out of quota
+        client = self.client_getter()
+        if not client:
+            ctx.reply = NO_KEY_REPLY
+            return
+        if self.shared is None:
+            self._generate_scheduled(client, ctx)
+            return
+        # the same turn reaching two replicas (retry, rerun after failover)
+        # is generated once; the other replica gets the stored reply
+        key = f"{ctx.turn_id}:{hashlib.sha1(ctx.prompt.encode('utf-8')).hexdigest()}"
+        generated = []
+
+        def compute():
+            self._generate_scheduled(client, ctx)
+            generated.append(True)
+            if ctx.reply in (OFFLINE_REPLY, RATE_LIMITED_REPLY):
+                return None  # don't share failures
+            return json.dumps({"reply": ctx.reply, "model": ctx.model}).encode()
+
+        cached = self.shared.get_or_compute("reply", key, compute, ttl=REPLY_CACHE_TTL)
+        if cached is not None and not generated:
+            data = json.loads(cached)
+            ctx.reply, ctx.model = data["reply"], data["model"]
+            inc("chat.replies_shared")
+            if ctx.on_text is not None:
+                ctx.on_text(ctx.reply)
+
+    def _generate_scheduled(self, client, ctx):
+        if self.scheduler is None:
+            self._generate_any(client, ctx)
+            return
+        try:
+            with self.scheduler.slot(ctx.user, INTERACTIVE, tokens=estimate_tokens(ctx.prompt)):
+                self._generate_any(client, ctx)
+        except QuotaExceeded:
+            inc("chat.rate_limited")
+            ctx.reply = RATE_LIMITED_REPLY
+
+    def _generate_any(self, client, ctx):
+        for model in MODELS:
+            try:
+                ctx.reply = self._generate(client, model, ctx)
+                ctx.model = model
+                if ctx.reply:
+                    return
+            except Exception:
+                inc(f"gemini.errors.{model}")
+                continue
+        ctx.reply = ctx.reply or OFFLINE_REPLY
+
+    def _generate(self, client, model, ctx) -> str:
+        # stream if the client supports it, so callers can show partial text
+        stream = getattr(client.models, "generate_content_stream", None)
+        if stream is None or ctx.on_text is None:
+            resp = client.models.generate_content(model=model, contents=ctx.prompt)
+            record_token_usage(resp, model)
+            return response_text(resp).strip()
+        accumulated = ""
+        t0 = time.perf_counter()
+        chunk = None
+        for chunk in stream(model=model, contents=ctx.prompt):
+            text = response_text(chunk)
+            if text:
+                if not accumulated:
+                    observe("chat.first_token", time.perf_counter() - t0)
+                accumulated += text
+                ctx.on_text(accumulated)
+        # usage is reported on the last chunk
+        record_token_usage(chunk, model)
+        return accumulated.strip()
+
+    def stage_persist(self, ctx):
+        ctx.turn["bot"] = ctx.reply or OFFLINE_REPLY
+        if ctx.turn["bot"] in ERROR_REPLIES:
+            ctx.turn["error"] = True   # the bot never said it: keep it out of later prompts
+        ctx.turn["ts"] = datetime.now().strftime("%I:%M %p")
+        self.persist(ctx.user, ctx.bot_id, ctx.history, start=ctx.history_start)
@@ -0,0 +1,213 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from metrics import inc, observe
+from query_cache import LRUCache
+from retrieval import bot_index_hash
+
+# =========================================================
+# 🏃 Prefetch a user's bots before the first message
+# =========================================================
+# On login, and whenever the Chat tab lists bots, a background job walks
+# the user's bots (the selected one first), reads their bot documents and
+# gets each retrieval index loaded or built. Entries keep the BotIndex
+# alive, so the send path's build_index() gets it from the live registry
+# without any work.
+#
+# History is not prefetched: entries are shared by every session and live
+# until evicted, and a window opened from an old page would splice stale
+# turns over newer ones on its next save. Sessions read it when they open
+# the bot.
+#
+# One job per browser session: selecting another bot or logging out
+# cancels the old job between steps (an encoder pass that already has its
+# scheduler slot runs to the end; one still waiting for it is dropped).
+
+
+class PrefetchCancelled(Exception):
+    """The session switched away before this step started."""
+
+
+class _Entry:
+    """What was warmed for one (user, bot_id); `done` is set once it is finished."""
+
+    __slots__ = ("bot", "index", "cost_s", "error", "done")
+
+    def __init__(self):
+        self.bot = None         # the bot document without file_text
+        self.index = None
+        self.cost_s = 0.0
+        self.error = None
+        self.done = threading.Event()
+
+
+class _Job:
+    __slots__ = ("user", "bot_ids", "cancelled", "finished")
+
+    def __init__(self, user, bot_ids):
+        self.user = user
+        self.bot_ids = bot_ids
+        self.cancelled = threading.Event()
+        self.finished = False
+
+
+class Prefetcher:
+    """
+    prefetcher = Prefetcher(firebase_db, index_for=lambda text, admit: build_index(text, admit=admit))
+    prefetcher.start(session_id, user)                        # after login
+    prefetcher.start(session_id, user, [selected, *others])   # Chat tab
+    prefetcher.first_send(user, bot_id)                       # records time saved
+
+    `storage` needs get_user_bots / get_bots / get_bot (the firebase_db
+    module has them). `admit(user, lines)`, if given, returns
+    the context manager held around encoder passes (a scheduler slot).
+    """
+
+    def __init__(self, storage, index_for, admit=None, threads: int = 2,
+                 max_entries: int = 64, max_sessions: int = 1024):
+        self.storage = storage
+        self.index_for = index_for
+        self.admit = admit
+        self._pool = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix="chatdouble-prefetch")
+        self._entries = LRUCache(max_entries)   # (user, bot_id) -> _Entry
+        self._jobs = LRUCache(max_sessions)     # session id -> _Job
+        self._lock = threading.Lock()
+
+    # ---- jobs ----
+    def start(self, session_id: str, user: str, bot_ids=None) -> bool:
+        """
+        Warm `user`'s bots in bot_ids order (None: every bot, listed by the
+        job). A no-op while this session's job already covers that order
+        and nothing it warmed was dropped; otherwise the previous job is
+        cancelled. Returns True if a new job was started.
+        """
+        bot_ids = list(bot_ids) if bot_ids is not None else None
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if job is not None and job.user == user and not job.cancelled.is_set():
+                same = bot_ids is None or job.bot_ids == bot_ids
+                if same and (not job.finished or all(self._warmed(user, b) for b in job.bot_ids)):
+                    return False
+                job.cancelled.set()
+                if not job.finished:
+                    inc("prefetch.cancelled")
+            job = _Job(user, bot_ids)
+            self._jobs.put(session_id, job)
+        self._pool.submit(self._run, job)
+        inc("prefetch.started")
+        return True
+
+    def cancel(self, session_id: str) -> None:
+        """Stop this session's job (e.g. on logout)."""
+        job = self._jobs.pop(session_id)
+        if job is not None and not job.finished and not job.cancelled.is_set():
+            job.cancelled.set()
+            inc("prefetch.cancelled")
+
+    def _run(self, job) -> None:
+        t0 = time.perf_counter()
+        try:
+            if job.bot_ids is None:
+                job.bot_ids = [b["id"] for b in self.storage.get_user_bots(job.user)]
+            # every bot document this job needs, in one round trip
+            cold = [b for b in job.bot_ids if not self._warmed(job.user, b)]
+            bots = self.storage.get_bots(job.user, cold) if cold else {}
+            for bot_id in job.bot_ids:
+                if job.cancelled.is_set():
+                    return
+                self._warm(job, bot_id, bots.get(bot_id))
+        except Exception:
+            inc("prefetch.errors")
+        finally:
+            job.finished = True
+            observe("prefetch.job", time.perf_counter() - t0)
+
+    def _warmed(self, user, bot_id) -> bool:
+        entry = self._entries.get((user, bot_id))
+        return entry is not None and entry.error is None
+
+    def _warm(self, job, bot_id, bot) -> None:
+        key = (job.user, bot_id)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None or (entry.done.is_set() and entry.error is not None):
+                    entry = _Entry()
+                    self._entries.put(key, entry)
+                    break
+                if entry.done.is_set():
+                    return   # warm already
+            entry.done.wait()   # another job (maybe a cancelled one) is on it
+            if job.cancelled.is_set():
+                return
+
+        def admit(lines):
+            if job.cancelled.is_set():
+                raise PrefetchCancelled()
+            return self.admit(job.user, lines) if self.admit else nullcontext()
+
+        t0 = time.perf_counter()
+        try:
+            if bot is None:   # warm when the job started, dropped since
+                bot = self.storage.get_bot(job.user, bot_id) or {}
+            entry.bot = {k: v for k, v in bot.items() if k != "file_text"}
+            bot_text = bot.get("file_text", "")
+            if bot_text.strip():
+                entry.index = self.index_for(bot_text, admit)
+            inc("prefetch.bots_warmed")
+        except Exception as e:
+            entry.error = e
+            inc("prefetch.steps_cancelled" if isinstance(e, PrefetchCancelled) else "prefetch.errors")
+        finally:
+            entry.cost_s = time.perf_counter() - t0
+            entry.done.set()
+
+    # ---- results ----
+    def entry(self, user: str, bot_id: str, bot_text: str = None):
+        """
+        The finished entry for this bot, or None while it is missing or in
+        progress. With bot_text, an entry warmed from different content
+        (the bot was edited since) is dropped and None returned.
+        """
+        entry = self._entries.get((user, bot_id))
+        if entry is None or not entry.done.is_set():
+            return None
+        if bot_text is not None and entry.index is not None and entry.index.key != bot_index_hash(bot_text):
+            self.forget(user, bot_id)
+            return None
+        return entry
+
+    def forget(self, user: str, bot_id: str) -> None:
+        """Drop an entry so the next start() for this bot warms it again."""
+        self._entries.pop((user, bot_id))
+
+    def first_send(self, user: str, bot_id: str, timeout: float = 30.0) -> float:
+        """
+        Call before the first message to a bot in a session. Waits for its
+        warm-up if one is running (the send path would do the same work)
+        and records prefetch.first_send_wait plus prefetch.time_saved, the
+        warm-up time that no longer sits in front of the reply. Returns the
+        seconds saved.
+        """
+        entry = self._entries.get((user, bot_id))
+        if entry is None:
+            inc("prefetch.first_send.miss")
+            return 0.0
+        ready = entry.done.is_set()
+        t0 = time.perf_counter()
+        entry.done.wait(timeout)
+        waited = time.perf_counter() - t0
+        observe("prefetch.first_send_wait", waited)
+        if not entry.done.is_set() or entry.error is not None:
+            inc("prefetch.first_send.miss")
+            return 0.0
+        inc("prefetch.first_send.ready" if ready else "prefetch.first_send.partial")
+        saved = max(0.0, entry.cost_s - waited)
+        observe("prefetch.time_saved", saved)
+        return saved
+
+    def gauges(self) -> dict:
+        """Flat stats for metrics.register_collector."""
+        return {"prefetch.entries": len(self._entries), "prefetch.sessions": len(self._jobs)}
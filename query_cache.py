@@ -0,0 +1,169 @@
+import hashlib
+import re
+import struct
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from metrics import span
+
+# =========================================================
+# 🧠 Query normalization
+# =========================================================
+_WS_RE = re.compile(r"\s+")
+_REPEAT_RE = re.compile(r"([^\W\d_])\1{2,}")   # letters only: "1000" stays "1000"
+_EDGE_PUNCT = " \t\n.,!?;:~-_'\"()[]{}…"
+
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a user message into a cache key.
+    "Hiii!!", "hii" and "  HII  " all map to the same key, so the
+    common greetings share one cached embedding.
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _WS_RE.sub(" ", text).strip(_EDGE_PUNCT)
+    # squash stretched letters ("heyyyy" -> "heyy")
+    return _REPEAT_RE.sub(r"\1\1", text)
+
+
+# =========================================================
+# 📦 Thread-safe LRU cache with hit metrics
+# =========================================================
+class LRUCache:
+    """
+    Small bounded LRU map shared by every session in the process.
+    Streamlit runs sessions on separate threads, so all access is locked.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = max(1, int(maxsize))
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            }
+
+
+def _vec_dumps(vec) -> bytes:
+    rows, dim = vec.shape
+    return struct.pack("<II", rows, dim) + vec.astype("<f4").tobytes()
+
+
+def _vec_loads(raw: bytes):
+    import numpy as np
+
+    rows, dim = struct.unpack_from("<II", raw)
+    return np.frombuffer(raw, dtype="<f4", offset=8).reshape(rows, dim).copy()
+
+
+# =========================================================
+# 🔎 Query embedding + top-k retrieval cache
+# =========================================================
+class QueryCache:
+    """
+    Two LRU layers in front of the retrieval path:
+      - embeddings: normalized query -> query vector (skips the encoder)
+      - results:    (bot index hash, normalized query, k) -> top-k ids (skips FAISS)
+    With a cache_tier.CacheTier as `shared`, embedding misses also check
+    (and fill) the cross-replica L2 before running the encoder.
+    """
+
+    def __init__(self, embed_size: int = 2048, result_size: int = 4096, shared=None):
+        self.embeddings = LRUCache(embed_size)
+        self.results = LRUCache(result_size)
+        self.shared = shared
+
+    def encode(self, embed_model, query: str):
+        """
+        Return the (1, dim) embedding for query, encoding only on a miss.
+        The normalized text is only the cache key; the encoder sees the
+        message as typed.
+        """
+        key = normalize_query(query) or query
+        vec = self.embeddings.get(key)
+        if vec is None:
+            if self.shared is not None:
+                from retrieval import EMBED_MODEL_NAME
+
+                vec = self.shared.get_or_compute(
+                    "embed", f"{EMBED_MODEL_NAME}:{hashlib.sha1(key.encode()).hexdigest()}",
+                    lambda: self._encode(embed_model, query), dumps=_vec_dumps, loads=_vec_loads, l1=False,
+                )
+            else:
+                vec = self._encode(embed_model, query)
+            self.embeddings.put(key, vec)
+        return vec
+
+    @staticmethod
+    def _encode(embed_model, text):
+        with span("retrieval.embed_query"):
+            return embed_model.encode([text], convert_to_numpy=True)
+
+    def search(self, index_hash: str, embed_model, index, query: str, k: int = 20) -> list:
+        """
+        Return the list of FAISS ids for query against one bot index.
+        Both the embedding and the search result are memoized.
+        """
+        key = (index_hash, normalize_query(query) or query, k)
+        ids = self.results.get(key)
+        if ids is None:
+            vec = self.encode(embed_model, query)
+            with span("retrieval.faiss_search"):
+                _, idxs = index.search(vec, k)
+            ids = [int(i) for i in idxs[0] if i >= 0]
+            self.results.put(key, ids)
+        return ids
+
+    def stats(self) -> dict:
+        return {"embeddings": self.embeddings.stats(), "results": self.results.stats()}
+
+    def gauges(self) -> dict:
+        """Flat stats for metrics.register_collector."""
+        out = {}
+        for layer, st in self.stats().items():
+            for k, v in st.items():
+                out[f"query_cache.{layer}.{k}"] = v
+        return out
@@ -0,0 +1,508 @@
+import hashlib
+import itertools
+import os
+import re
+import threading
+import uuid
+import weakref
+from contextlib import nullcontext
+from struct import error as struct_error
+
+from embedding_store import EmbeddingStore, line_key
+from lexical_index import BM25Index, rrf_fuse
+from line_store import LineStore
+from metrics import inc, span
+from singleflight import SingleFlight
+
+# Heavy dependencies (sentence_transformers -> torch, faiss) are imported
+# inside the functions that need them, so the login page never pays for them.
+
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+
+# Built indexes are persisted here as {hash}.faiss + {hash}.bm25.json +
+# {hash}.lines so a restart (or another process on the node) skips the
+# encoder entirely; the .lines store and the vectors are memory-mapped and
+# shared. Line embeddings are kept once per distinct line in embeddings/
+# (embedding_store), so a line any bot already has is never encoded again.
+INDEX_DIR = os.getenv("CHATDOUBLE_INDEX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "indexes"))
+
+_embed_model = None
+_embed_lock = threading.Lock()
+_index_builds = SingleFlight("retrieval.index_build")
+_embedding_stores = {}
+_stores_lock = threading.Lock()
+# content hash -> the BotIndex in use; an entry lives as long as something
+# (a Streamlit cache, the API's LRU, a running turn) still references it
+_live_indexes = weakref.WeakValueDictionary()
+_live_lock = threading.Lock()
+
+
+# =========================================================
+# 🧩 Embedding model (one per process)
+# =========================================================
+def get_embed_model():
+    """
+    Load the sentence-transformer once per process.
+    Safe to call from the warm-up thread and from script runs at the same time.
+    """
+    global _embed_model
+    if _embed_model is None:
+        with _embed_lock:
+            if _embed_model is None:
+                with span("retrieval.load_model"):
+                    from sentence_transformers import SentenceTransformer
+                    _embed_model = SentenceTransformer(EMBED_MODEL_NAME)
+    return _embed_model
+
+
+def set_embed_model(model) -> None:
+    """Use `model` (anything with .encode) instead of the sentence-transformer."""
+    global _embed_model
+    with _embed_lock:
+        _embed_model = model
+
+
+def embed_model_loaded() -> bool:
+    return _embed_model is not None
+
+
+class LazyEmbedModel:
+    """Stands in for the model until .encode() is actually needed."""
+
+    def encode(self, *args, **kwargs):
+        return get_embed_model().encode(*args, **kwargs)
+
+
+lazy_embed_model = LazyEmbedModel()
+
+
+def get_embedding_store() -> EmbeddingStore:
+    """The per-line embedding store under the current INDEX_DIR."""
+    directory = os.path.join(INDEX_DIR, "embeddings")
+    with _stores_lock:
+        store = _embedding_stores.get(directory)
+        if store is None:
+            store = _embedding_stores[directory] = EmbeddingStore(directory, EMBED_MODEL_NAME)
+    return store
+
+
+def embed_lines(lines, admit=None, use_store: bool = True):
+    """
+    float32 embeddings for lines, in order. Each distinct line is encoded at
+    most once: repeats within the corpus share a row, and (with use_store)
+    lines any earlier corpus had come from the embedding store. Only the
+    lines actually encoded are held under `admit` and added to the store.
+    """
+    import numpy as np
+
+    keys = [line_key(line) for line in lines]
+    first = {}
+    for i, k in enumerate(keys):
+        first.setdefault(k, i)
+    unique = list(first)
+    store = get_embedding_store() if use_store else None
+    if store is not None:
+        stored, missing = store.lookup(unique)
+    else:
+        stored, missing = [None] * len(unique), list(range(len(unique)))
+    if missing:
+        todo = [lines[first[unique[j]]] for j in missing]
+        with (admit(todo) if admit else nullcontext()), span("retrieval.embed_lines"):
+            encoded = get_embed_model().encode(todo, convert_to_numpy=True)
+        for j, vec in zip(missing, encoded):
+            stored[j] = vec
+        if store is not None:
+            store.add([unique[j] for j in missing], encoded)
+    inc("retrieval.lines_embedded", len(missing))
+    inc("retrieval.lines_reused", len(lines) - len(missing))
+    rows = np.asarray(stored, dtype=np.float32)
+    slot = {k: j for j, k in enumerate(unique)}
+    return rows[[slot[k] for k in keys]]
+
+
+# =========================================================
+# 📚 FAISS index
+# =========================================================
+def bot_index_hash(bot_text: str) -> str:
+    """Stable key for a bot's FAISS index (same content -> same index)."""
+    return hashlib.sha1(bot_text.encode("utf-8", "ignore")).hexdigest()
+
+
+class BotIndex:
+    """
+    Everything retrieval needs for one bot corpus:
+      key      content hash (bot_index_hash)
+      lines    LineStore of corpus lines, FAISS id == position
+      index    FAISS vector index
+      lexical  BM25Index over the same lines
+    """
+
+    def __init__(self, key, lines, index, lexical):
+        self.key = key
+        self.lines = lines
+        self.index = index
+        self.lexical = lexical
+
+    @property
+    def embed_model(self):
+        return lazy_embed_model
+
+
+def index_paths(key: str, index_dir: str = None) -> tuple:
+    """(vectors, bm25, lines) file paths for one content hash."""
+    d = index_dir or INDEX_DIR
+    return (os.path.join(d, f"{key}.faiss"), os.path.join(d, f"{key}.bm25.json"),
+            os.path.join(d, f"{key}.lines"))
+
+
+# {hash}.faiss / .bm25.json / .lines, or a temp file _persist left behind
+# ({path}.{pid}.{uuid}.tmp, or {path}.tmp from before unique names)
+_INDEX_FILE_RE = re.compile(r"^([0-9a-f]{40})\.(?:faiss|bm25\.json|lines)(?:(?:\.\d+\.[0-9a-f]{32})?\.tmp)?$")
+
+
+def list_index_files(index_dir: str = None) -> dict:
+    """
+    {content_hash: [paths]} for every persisted index file (incl. stale
+    .tmp). Anything else in the directory (embeddings/, a database someone
+    put there) is not ours and never listed.
+    """
+    d = index_dir or INDEX_DIR
+    out = {}
+    if not os.path.isdir(d):
+        return out
+    for name in os.listdir(d):
+        m = _INDEX_FILE_RE.match(name)
+        path = os.path.join(d, name)
+        if m is None or not os.path.isfile(path):
+            continue
+        out.setdefault(m.group(1), []).append(path)
+    return out
+
+
+def _tmp_path(path: str) -> str:
+    # unique per writer: two processes building the same hash must not write
+    # one temp file. Still "{hash}....tmp", so sweep_index_files finds strays.
+    return f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+
+
+def _discard(paths) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def remove_index_files(key: str, index_dir: str = None) -> int:
+    """Delete the persisted files for one content hash. Returns bytes freed."""
+    freed = 0
+    for path in list_index_files(index_dir).get(key, []):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    return freed
+
+
+def line_keys_in_use(live_hashes, index_dir: str = None) -> set:
+    """
+    line_key digests of every line this node holds for the given corpora
+    (their persisted line stores) or has loaded (live indexes). The
+    embedding store keeps these rows when it is compacted.
+    """
+    keep = set()
+    with _live_lock:
+        indexes = list(_live_indexes.values())
+    for bot_index in indexes:
+        keep.update(line_key(line) for line in bot_index.lines)
+    for key in live_hashes:
+        lines_path = index_paths(key, index_dir)[2]
+        try:
+            lines = LineStore.open(lines_path)
+        except (OSError, ValueError, struct_error):
+            continue   # never built here: nothing of it to keep
+        keep.update(line_key(line) for line in lines)
+    return keep
+
+
+def split_lines(bot_text: str) -> list:
+    lines = [line.strip() for line in bot_text.splitlines() if line.strip()]
+    # minimal fallback: single placeholder
+    return lines or ["hello"]
+
+
+def join_corpus(base_text: str, new_lines) -> str:
+    """base_text with new_lines appended; split_lines() of it == split_lines(base) + new_lines."""
+    new_text = "\n".join(new_lines)
+    if not base_text.strip():
+        return new_text
+    return base_text.rstrip("\n") + "\n" + new_text
+
+
+def _read_vectors(vec_path):
+    """
+    FAISS index from disk, memory-mapped where this faiss build can (flat
+    indexes): the vectors stay in the page cache, shared by every process
+    and bot with this corpus, instead of a private copy per load.
+    """
+    import faiss
+
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if flag is not None:
+        try:
+            return faiss.read_index(vec_path, flag)
+        except RuntimeError:
+            pass
+    return faiss.read_index(vec_path)
+
+
+def _load_persisted(key, bot_text, index_dir=None):
+    vec_path, lex_path, lines_path = index_paths(key, index_dir)
+    if not (os.path.exists(vec_path) and os.path.exists(lex_path)):
+        return None
+    try:
+        with span("retrieval.load_index"):
+            index = _read_vectors(vec_path)
+            lexical = BM25Index.load(lex_path)
+            if not os.path.exists(lines_path):
+                # persisted before line stores existed: add one, keep the vectors
+                LineStore.write(lines_path, split_lines(bot_text))
+            lines = LineStore.open(lines_path)
+    except Exception:
+        return None
+    if index.ntotal != len(lines) or len(lexical) != len(lines):
+        return None
+    inc("retrieval.index_loaded")
+    return lines, index, lexical
+
+
+def _persist(key, lines, index, lexical, index_dir=None):
+    """
+    Write all three files; returns (mapped LineStore, mapped vectors) so the
+    in-memory copies can be dropped, or None if the disk refused.
+    """
+    import faiss
+
+    vec_path, lex_path, lines_path = index_paths(key, index_dir)
+    vec_tmp, lex_tmp = _tmp_path(vec_path), _tmp_path(lex_path)
+    try:
+        os.makedirs(os.path.dirname(vec_path), exist_ok=True)
+        # write to temp names first so a concurrent reader never sees half a file
+        faiss.write_index(index, vec_tmp)
+        lexical.save(lex_tmp)
+        LineStore.write(lines_path, lines)
+        os.replace(vec_tmp, vec_path)
+        os.replace(lex_tmp, lex_path)
+        return LineStore.open(lines_path), _read_vectors(vec_path)
+    except (OSError, RuntimeError):
+        _discard((vec_tmp, lex_tmp))
+        return None  # read-only / full disk: the in-memory index still works
+
+
+def _pack_index_files(key, index_dir=None):
+    from cache_tier import pack_parts
+
+    try:
+        parts = []
+        for path in index_paths(key, index_dir):
+            with open(path, "rb") as f:
+                parts.append(f.read())
+    except OSError:
+        return None
+    return pack_parts(parts)
+
+
+def _unpack_index_files(key, blob, index_dir=None) -> None:
+    from cache_tier import unpack_parts
+
+    paths = index_paths(key, index_dir)
+    os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+    for path, data in zip(paths, unpack_parts(blob)):
+        tmp = _tmp_path(path)
+        try:
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            _discard((tmp,))
+            raise
+
+
+def build_index(bot_text: str, persist: bool = True, shared=None, admit=None) -> BotIndex:
+    """
+    Returns the BotIndex for a bot corpus, loading it from INDEX_DIR when it
+    was built before (no encoder pass), otherwise embedding + persisting it.
+    With a cache_tier.CacheTier as `shared`, a missing index is first fetched
+    from the shared L2 (built by another replica); if nobody has it, this
+    process builds it once and publishes the files for everyone else.
+    Concurrent calls for the same corpus share one build, and while a
+    BotIndex for a corpus is alive every caller (any user, any bot) gets
+    that same object. `admit(lines)`, if given, returns a context manager
+    held around the encoder pass only (e.g. a scheduler slot), so loads from
+    disk or L2 never wait on it.
+    """
+    key = bot_index_hash(bot_text)
+    bot_index = _live_index(key)
+    if bot_index is not None:
+        return bot_index
+    bot_index, _ = _index_builds.do(
+        (key, persist), lambda: _track(_load_or_build(key, bot_text, persist, shared, admit)))
+    return bot_index
+
+
+def _live_index(key):
+    with _live_lock:
+        bot_index = _live_indexes.get(key)
+    if bot_index is not None:
+        inc("retrieval.index_shared")
+    return bot_index
+
+
+def _track(bot_index: BotIndex) -> BotIndex:
+    # first one registered wins, so callers never hold two copies of a corpus
+    with _live_lock:
+        return _live_indexes.setdefault(bot_index.key, bot_index)
+
+
+def live_index_gauges() -> dict:
+    """Flat stats for metrics.register_collector."""
+    with _live_lock:
+        indexes = list(_live_indexes.values())
+    return {
+        "retrieval.live_indexes": len(indexes),
+        "retrieval.live_vectors": sum(i.index.ntotal for i in indexes),
+        "retrieval.stored_line_embeddings": len(get_embedding_store()),
+    }
+
+
+def _load_or_build(key, bot_text, persist, shared, admit=None) -> BotIndex:
+    loaded = _load_persisted(key, bot_text) if persist else None
+    if loaded:
+        return BotIndex(key, *loaded)
+
+    if persist and shared is not None:
+        built = {}
+
+        def build_and_pack():
+            built["index"] = _build(key, bot_text, persist=True, admit=admit)
+            return _pack_index_files(key)
+
+        blob = shared.get_or_compute("index", f"{EMBED_MODEL_NAME}:{key}", build_and_pack, l1=False)
+        if "index" in built:
+            return built["index"]
+        if blob is not None:
+            try:
+                _unpack_index_files(key, blob)
+                loaded = _load_persisted(key, bot_text)
+            except (OSError, ValueError, struct_error):
+                loaded = None
+            if loaded:
+                inc("retrieval.index_from_shared")
+                return BotIndex(key, *loaded)
+    return _build(key, bot_text, persist, admit)
+
+
+def _publish(shared, key) -> None:
+    blob = _pack_index_files(key)
+    if blob is not None:
+        shared.put("index", f"{EMBED_MODEL_NAME}:{key}", blob, l1=False)
+
+
+def extend_index(base_text: str, new_lines, shared=None, admit=None) -> BotIndex:
+    """
+    BotIndex for join_corpus(base_text, new_lines), made from base_text's
+    index plus embeddings of new_lines only: the FAISS index is copied and
+    extended, BM25 gets the new docs, and the result is persisted (and
+    published to the shared L2) under the new content hash. Existing line
+    ids don't move, so cost is proportional to the new lines.
+    """
+    new_lines = [line.strip() for line in new_lines if line.strip()]
+    if not new_lines:
+        return build_index(base_text, shared=shared, admit=admit)
+    if not base_text.strip():
+        return build_index(join_corpus(base_text, new_lines), shared=shared, admit=admit)
+    bot_text = join_corpus(base_text, new_lines)
+    key = bot_index_hash(bot_text)
+    bot_index = _live_index(key)
+    if bot_index is not None:
+        return bot_index
+    bot_index, _ = _index_builds.do(
+        (key, True), lambda: _track(_load_or_extend(key, bot_text, base_text, new_lines, shared, admit)))
+    return bot_index
+
+
+def _load_or_extend(key, bot_text, base_text, new_lines, shared, admit) -> BotIndex:
+    import faiss
+
+    loaded = _load_persisted(key, bot_text)
+    if loaded:
+        return BotIndex(key, *loaded)
+    base = build_index(base_text, shared=shared, admit=admit)   # usually a load from disk
+    embeddings = embed_lines(new_lines, admit)
+    with span("retrieval.extend_index"):
+        # an owned copy: clone_index of a memory-mapped index keeps the read-only view
+        index = faiss.deserialize_index(faiss.serialize_index(base.index))
+        index.add(embeddings)
+        lexical = base.lexical.extended(new_lines)
+    inc("retrieval.index_extended")
+    persisted = _persist(key, itertools.chain(base.lines, new_lines), index, lexical)
+    if persisted is None:
+        return BotIndex(key, LineStore.from_lines(itertools.chain(base.lines, new_lines)), index, lexical)
+    if shared is not None:
+        _publish(shared, key)
+    return BotIndex(key, persisted[0], persisted[1], lexical)
+
+
+def _build(key, bot_text, persist, admit=None) -> BotIndex:
+    import faiss
+
+    bot_lines = split_lines(bot_text)
+    embeddings = embed_lines(bot_lines, admit, use_store=persist)
+    with span("retrieval.build_index"):
+        index = faiss.IndexFlatL2(embeddings.shape[1])
+        index.add(embeddings)
+        lexical = BM25Index.build(bot_lines)
+    # the list of str and the built vectors are only needed until they are
+    # on disk; keep the mapped copies
+    persisted = _persist(key, bot_lines, index, lexical) if persist else None
+    if persisted is None:
+        return BotIndex(key, LineStore.from_lines(bot_lines), index, lexical)
+    return BotIndex(key, persisted[0], persisted[1], lexical)
+
+
+# =========================================================
+# 🔀 Hybrid retrieval (BM25 + vectors, RRF)
+# =========================================================
+def hybrid_search(bot_index: BotIndex, query: str, k: int = 20, query_cache=None) -> list:
+    """
+    Top-k line ids for query.
+    Short keyword-like queries that hit rare corpus terms are answered from
+    BM25 alone (no encoder pass); everything else fuses BM25 and FAISS
+    rankings with reciprocal rank fusion.
+    """
+    lex = bot_index.lexical
+    if lex is not None and lex.is_keyword_query(query):
+        with span("retrieval.bm25"):
+            hits = lex.search(query, k)
+        if hits:
+            inc("retrieval.lexical_only")
+            return [d for d, _ in hits]
+
+    if query_cache is not None:
+        vec_ids = query_cache.search(bot_index.key, bot_index.embed_model, bot_index.index, query, k=k)
+    else:
+        with span("retrieval.embed_query"):
+            vec = bot_index.embed_model.encode([query], convert_to_numpy=True)
+        with span("retrieval.faiss_search"):
+            _, idxs = bot_index.index.search(vec, k)
+        vec_ids = [int(i) for i in idxs[0] if i >= 0]
+    if lex is None:
+        return vec_ids
+    with span("retrieval.bm25"):
+        lex_ids = [d for d, _ in lex.search(query, k)]
+    if not lex_ids:
+        return vec_ids
+    inc("retrieval.hybrid")
+    return rrf_fuse(vec_ids, lex_ids, k=k)
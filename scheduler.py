@@ -0,0 +1,282 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import inc, observe
+
+# =========================================================
+# 🚦 Fair scheduling of model work (Gemini calls, encoder passes)
+# =========================================================
+# Every model call goes through FairScheduler.slot(user, kind, tokens):
+#
+#   1. quota    per-user token buckets (requests/min and prompt tokens/min)
+#               per kind; a user over quota waits for the refill, or gets
+#               QuotaExceeded if that would take longer than max_wait_s
+#   2. queue    at most `slots` calls run at once; queued calls are ordered
+#               by weighted fair queuing between users (start-time fair
+#               queuing on token cost), so a user with 50 queued calls
+#               doesn't delay another user's single one by 50 calls
+#   3. priority interactive chat is always served before background
+#               ingestion, except that ingestion waiting longer than
+#               max_defer_s goes next (no starvation)
+
+INTERACTIVE = "chat"
+BACKGROUND = "ingest"
+KINDS = (INTERACTIVE, BACKGROUND)   # priority order
+
+
+class QuotaExceeded(RuntimeError):
+    """The user's quota for this kind of work won't refill within max_wait_s."""
+
+    def __init__(self, user: str, kind: str, retry_after: float):
+        super().__init__(f"{user or 'anonymous'} is over the {kind} quota (retry in {retry_after:.0f}s)")
+        self.user = user
+        self.kind = kind
+        self.retry_after = retry_after
+
+
+def estimate_tokens(text) -> int:
+    """Rough prompt-token count (~4 chars per token) for a str or a list of str."""
+    chars = len(text) if isinstance(text, str) else sum(map(len, text))
+    return chars // 4 + 1
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second, holding at most `burst`. reserve() takes the
+    tokens even when short — the level goes negative — and returns how long
+    the caller has to wait before using them, so later callers queue behind.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.level = burst
+        self.t = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.burst, self.level + (now - self.t) * self.rate)
+        self.t = now
+
+    def wait_for(self, n: float, now: float) -> float:
+        self._refill(now)
+        return max(0.0, (n - self.level) / self.rate)
+
+    def reserve(self, n: float, now: float) -> float:
+        wait = self.wait_for(n, now)
+        self.level -= n
+        return wait
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.level >= self.burst
+
+
+class Quota:
+    """Per-user allowance for one kind of work; None means unmetered."""
+
+    def __init__(self, requests_per_min: float = None, tokens_per_min: float = None, burst_s: float = 15.0):
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+        self.burst_s = burst_s
+
+    def buckets(self) -> list:
+        out = []
+        for per_min in (self.requests_per_min, self.tokens_per_min):
+            if per_min:
+                rate = per_min / 60.0
+                out.append(TokenBucket(rate, max(1.0, rate * self.burst_s)))
+            else:
+                out.append(None)
+        return out
+
+
+DEFAULT_QUOTAS = {
+    INTERACTIVE: Quota(requests_per_min=20, tokens_per_min=60000),
+    # uploads are metered per request; their (large) token cost only
+    # affects fair-queue order, not admission
+    BACKGROUND: Quota(requests_per_min=10, burst_s=30.0),
+}
+
+
+class _Job:
+    __slots__ = ("user", "kind", "start", "finish", "seq", "enqueued", "granted")
+
+    def __init__(self, user, kind, start, finish, seq):
+        self.user = user
+        self.kind = kind
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.enqueued = time.monotonic()
+        self.granted = False
+
+    def __lt__(self, other):
+        return (self.finish, self.seq) < (other.finish, other.seq)
+
+
+class FairScheduler:
+    """
+    sched = FairScheduler(slots=8)
+    with sched.slot(user, INTERACTIVE, tokens=estimate_tokens(prompt)):
+        reply = call_gemini(prompt)
+
+    `weights` ({user: weight}, default 1) scales a user's share of the queue.
+    """
+
+    def __init__(self, slots: int = 8, quotas: dict = None, weights: dict = None,
+                 max_wait_s: float = 20.0, max_defer_s: float = 30.0):
+        self.slots = max(1, int(slots))
+        self.quotas = {**DEFAULT_QUOTAS, **(quotas or {})}
+        self.weights = dict(weights or {})
+        self.max_wait_s = max_wait_s
+        self.max_defer_s = max_defer_s
+        self._cv = threading.Condition()
+        self._queues = {kind: [] for kind in KINDS}   # heaps of _Job by virtual finish
+        self._vtime = {kind: 0.0 for kind in KINDS}
+        self._last_finish = {}   # (kind, user) -> virtual finish of their last queued job
+        self._buckets = {}       # (kind, user) -> [requests bucket, tokens bucket]
+        self._running = 0
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> "FairScheduler":
+        """
+        Configured from SCHED_SLOTS, CHAT_RPM / CHAT_TPM (chat) and
+        INGEST_RPM (uploads, index builds); unset ones keep the defaults.
+        """
+        chat, ingest = DEFAULT_QUOTAS[INTERACTIVE], DEFAULT_QUOTAS[BACKGROUND]
+        return cls(
+            slots=int(os.getenv("SCHED_SLOTS", "8")),
+            quotas={
+                INTERACTIVE: Quota(requests_per_min=float(os.getenv("CHAT_RPM", chat.requests_per_min)),
+                                   tokens_per_min=float(os.getenv("CHAT_TPM", chat.tokens_per_min)),
+                                   burst_s=chat.burst_s),
+                BACKGROUND: Quota(requests_per_min=float(os.getenv("INGEST_RPM", ingest.requests_per_min)),
+                                  burst_s=ingest.burst_s),
+            },
+        )
+
+    # ---- 1. quota ----
+    def _admit(self, user, kind, tokens) -> float:
+        """Reserve quota; returns seconds to wait for it, or raises QuotaExceeded."""
+        quota = self.quotas.get(kind)
+        if quota is None:
+            return 0.0
+        now = time.monotonic()
+        with self._cv:
+            buckets = self._buckets.get((kind, user))
+            if buckets is None:
+                if len(self._buckets) > 10000:
+                    self._prune(now)
+                buckets = self._buckets[(kind, user)] = quota.buckets()
+            needs = [(b, n) for b, n in zip(buckets, (1, tokens)) if b is not None]
+            wait = max((b.wait_for(n, now) for b, n in needs), default=0.0)
+            if wait > self.max_wait_s:
+                inc(f"scheduler.rejected.{kind}")
+                raise QuotaExceeded(user, kind, wait)
+            for b, n in needs:
+                b.reserve(n, now)
+        return wait
+
+    def _prune(self, now) -> None:
+        # idle users: full buckets are the same as fresh ones
+        for key, buckets in list(self._buckets.items()):
+            if all(b is None or b.full(now) for b in buckets):
+                del self._buckets[key]
+        for key, finish in list(self._last_finish.items()):
+            if finish <= self._vtime[key[0]]:
+                del self._last_finish[key]
+
+    # ---- 2./3. queue ----
+    def _enqueue(self, user, kind, tokens) -> _Job:
+        weight = self.weights.get(user, 1.0)
+        with self._cv:
+            start = max(self._vtime[kind], self._last_finish.get((kind, user), 0.0))
+            job = _Job(user, kind, start, start + max(tokens, 1) / weight, next(self._seq))
+            self._last_finish[(kind, user)] = job.finish
+            heapq.heappush(self._queues[kind], job)
+            self._dispatch()
+        return job
+
+    def _next_job(self):
+        background = self._queues[BACKGROUND]
+        if background:
+            oldest = min(background, key=lambda j: j.enqueued)
+            if time.monotonic() - oldest.enqueued > self.max_defer_s:
+                background.remove(oldest)
+                heapq.heapify(background)
+                return oldest
+        for kind in KINDS:
+            if self._queues[kind]:
+                return heapq.heappop(self._queues[kind])
+        return None
+
+    def _dispatch(self) -> None:
+        # caller holds self._cv
+        while self._running < self.slots:
+            job = self._next_job()
+            if job is None:
+                break
+            self._vtime[job.kind] = max(self._vtime[job.kind], job.start)
+            job.granted = True
+            self._running += 1
+            self._cv.notify_all()
+
+    def _release(self) -> None:
+        with self._cv:
+            self._running -= 1
+            self._dispatch()
+
+    def _cancel(self, job) -> None:
+        with self._cv:
+            if job.granted:
+                self._running -= 1
+            else:
+                queue = self._queues[job.kind]
+                queue.remove(job)
+                heapq.heapify(queue)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, user: str, kind: str = INTERACTIVE, tokens: int = 1):
+        """Block until `user` may run one call of `kind` costing `tokens`."""
+        wait = self._admit(user, kind, tokens)
+        if wait > 0:
+            inc(f"scheduler.throttled.{kind}")
+            observe(f"scheduler.throttle.{kind}", wait)
+            time.sleep(wait)
+        t0 = time.perf_counter()
+        job = self._enqueue(user, kind, tokens)
+        try:
+            with self._cv:
+                while not job.granted:
+                    self._cv.wait()
+        except BaseException:
+            self._cancel(job)   # e.g. the script thread was stopped while queued
+            raise
+        observe(f"scheduler.wait.{kind}", time.perf_counter() - t0)
+        inc(f"scheduler.admitted.{kind}")
+        try:
+            yield
+        finally:
+            self._release()
+
+    # ---- introspection ----
+    def queue_depth(self, kind: str = None) -> int:
+        with self._cv:
+            if kind:
+                return len(self._queues[kind])
+            return sum(len(q) for q in self._queues.values())
+
+    def gauges(self) -> dict:
+        """Flat stats for metrics.register_collector."""
+        with self._cv:
+            out = {f"scheduler.queue_depth.{kind}": len(q) for kind, q in self._queues.items()}
+            out["scheduler.running"] = self._running
+            out["scheduler.slots"] = self.slots
+            out["scheduler.tracked_users"] = len(self._buckets)
+        return out
@@ -0,0 +1,145 @@
+import os
+from collections import OrderedDict
+
+from metrics import inc
+
+# =========================================================
+# 🪟 Bounded chat history per browser session
+# =========================================================
+# A session keeps only the newest HISTORY_WINDOW turns of each bot it has
+# open; older turns stay in storage and are paged in on request ("load
+# older"), up to HISTORY_MAX_LOADED. Saves write the window at its
+# position (save_chat_history_cloud(..., start=)), so the older turns are
+# never re-sent. Turns waiting for a reply are listed in an explicit index,
+# so a rerun finds them without looking at any history.
+
+HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", "50"))
+HISTORY_MAX_LOADED = int(os.getenv("HISTORY_MAX_LOADED", "500"))
+SESSION_MAX_BOTS = 8
+
+
+class HistoryWindow:
+    """
+    The newest turns of one conversation: turns[0] is at position `start`
+    of the stored history. `limit` is how many turns are kept (raised by
+    load_older, never above HISTORY_MAX_LOADED).
+    """
+
+    __slots__ = ("bot_id", "turns", "start", "limit")
+
+    def __init__(self, bot_id: str, turns: list, start: int = 0, limit: int = HISTORY_WINDOW):
+        self.bot_id = bot_id
+        self.turns = list(turns)
+        self.start = start
+        self.limit = max(1, limit)
+        self._trim()
+
+    @property
+    def total(self) -> int:
+        """Turns in the whole stored history."""
+        return self.start + len(self.turns)
+
+    @property
+    def has_older(self) -> bool:
+        return self.start > 0
+
+    @property
+    def pending(self):
+        """The last turn if it is still waiting for its reply, else None."""
+        last = self.turns[-1] if self.turns else None
+        return last if isinstance(last, dict) and last.get("bot") == "" else None
+
+    def append(self, turn: dict) -> None:
+        self.turns.append(turn)
+        self._trim()
+
+    def _trim(self) -> None:
+        excess = len(self.turns) - self.limit
+        if excess > 0:
+            del self.turns[:excess]
+            self.start += excess
+            inc("history.turns_trimmed", excess)
+
+    def load_older(self, load_page, user: str, page_size: int = HISTORY_WINDOW) -> int:
+        """
+        Prepend the page before the window (load_page is
+        firebase_db.load_history_page). Returns how many turns were added.
+        """
+        room = HISTORY_MAX_LOADED - len(self.turns)
+        if not self.has_older or room <= 0:
+            return 0
+        page = load_page(user, self.bot_id, limit=min(page_size, room), before=self.start)
+        older = page["turns"]
+        self.turns[:0] = older
+        self.start = page["before"] or 0
+        self.limit = min(HISTORY_MAX_LOADED, max(self.limit, len(self.turns)))
+        inc("history.pages_loaded")
+        return len(older)
+
+    def save(self, persist, user: str) -> None:
+        """persist is save_chat_history_cloud: writes the window at its position."""
+        persist(user, self.bot_id, self.turns, start=self.start)
+
+
+class SessionHistories:
+    """
+    histories = SessionHistories(user)            # one per session (st.session_state)
+    window = histories.open(bot_id, turns, start) # or histories.get(bot_id)
+    histories.add_turn(bot_id, new_turn(text))    # indexes it as pending
+    ...pipeline.run(...)...
+    histories.settle(bot_id)                      # drops it from the pending index
+
+    At most max_bots windows are held; the least recently used is dropped
+    (it is all in storage) unless it has a pending turn.
+    """
+
+    def __init__(self, user: str, max_bots: int = SESSION_MAX_BOTS):
+        self.user = user
+        self.max_bots = max(1, max_bots)
+        self._windows = OrderedDict()   # bot_id -> HistoryWindow
+        self._pending = {}              # bot_id -> pending turn id
+
+    def get(self, bot_id: str):
+        window = self._windows.get(bot_id)
+        if window is not None:
+            self._windows.move_to_end(bot_id)
+        return window
+
+    def open(self, bot_id: str, turns: list, start: int = 0) -> HistoryWindow:
+        """Hold the newest turns of a history just read from storage."""
+        window = self._windows[bot_id] = HistoryWindow(bot_id, turns, start)
+        self._windows.move_to_end(bot_id)
+        self.settle(bot_id)
+        for old in list(self._windows):
+            if len(self._windows) <= self.max_bots:
+                break
+            if old != bot_id and old not in self._pending:
+                del self._windows[old]
+        return window
+
+    def drop(self, bot_id: str) -> None:
+        """Forget a bot's window (history cleared, bot deleted)."""
+        self._windows.pop(bot_id, None)
+        self._pending.pop(bot_id, None)
+
+    def add_turn(self, bot_id: str, turn: dict) -> HistoryWindow:
+        window = self._windows[bot_id]
+        window.append(turn)
+        self.settle(bot_id)
+        return window
+
+    def settle(self, bot_id: str) -> None:
+        """Re-index bot_id after its last turn changed (answered or new)."""
+        window = self._windows.get(bot_id)
+        turn = window.pending if window is not None else None
+        if turn is not None:
+            self._pending[bot_id] = turn.get("id")
+        else:
+            self._pending.pop(bot_id, None)
+
+    def pending_bots(self) -> list:
+        """Bots with a turn waiting for its reply (no history is scanned)."""
+        return list(self._pending)
+
+    def __len__(self) -> int:
+        return len(self._windows)
@@ -0,0 +1,73 @@
+import threading
+
+from metrics import inc
+
+# =========================================================
+# 🛫 Single-flight: coalesce concurrent identical work
+# =========================================================
+# The first caller for a key runs the work; callers arriving while it is
+# in flight wait and get the same result (or the same exception).
+# Nothing is cached afterwards — pair it with a cache for that.
+
+
+class _Call:
+    __slots__ = ("event", "value", "exc")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc = None
+
+
+class SingleFlight:
+    """
+    flights = SingleFlight("index_build")
+    value, shared = flights.do(content_hash, lambda: expensive(content_hash))
+
+    `shared` is True for callers that received another caller's result.
+    If the running call is interrupted by something that isn't an Exception
+    (e.g. a Streamlit rerun stopping the script thread), waiters don't
+    inherit that; one of them runs the work instead.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+            if leader:
+                return self._lead(key, call, fn), False
+            inc(f"{self.name}.coalesced")
+            call.event.wait()
+            if call.exc is None:
+                return call.value, True
+            if isinstance(call.exc, Exception):
+                raise call.exc
+            # leader was interrupted: try again (one of the waiters leads)
+
+    def _lead(self, key, call, fn):
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.exc = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def in_flight(self, key) -> bool:
+        with self._lock:
+            return key in self._calls
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,358 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from metrics import inc, span
+from retrieval import bot_index_hash
+from storage import StorageBackend, check_password, hash_password
+
+# =========================================================
+# 💾 SQLite storage backend (single node / offline)
+# =========================================================
+# One file, WAL mode: readers never block the writer, commits are a local
+# fsync instead of a network round trip. One connection per thread.
+# Bot text lives once per content hash in `corpora`; chat history is one
+# row per turn, so appends and paged reads don't touch the whole history.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username    TEXT PRIMARY KEY,
+    password    TEXT NOT NULL,
+    created_at  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS corpora (
+    content_hash  TEXT PRIMARY KEY,
+    text          TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bots (
+    id            TEXT PRIMARY KEY,
+    username      TEXT NOT NULL,
+    name          TEXT NOT NULL,
+    content_hash  TEXT NOT NULL REFERENCES corpora(content_hash),
+    persona       TEXT NOT NULL DEFAULT '',
+    created_at    REAL NOT NULL,
+    last_message_at  TEXT,
+    stamp_format     TEXT
+);
+CREATE INDEX IF NOT EXISTS bots_by_user ON bots(username, created_at);
+CREATE INDEX IF NOT EXISTS bots_by_content ON bots(content_hash);
+CREATE TABLE IF NOT EXISTS chat_turns (
+    username  TEXT NOT NULL,
+    bot_id    TEXT NOT NULL,
+    seq       INTEGER NOT NULL,
+    data      TEXT NOT NULL,
+    PRIMARY KEY (username, bot_id, seq)
+) WITHOUT ROWID;
+"""
+
+
+def _new_id() -> str:
+    # same length as Firestore auto ids
+    return uuid.uuid4().hex[:20]
+
+
+class SQLiteBackend(StorageBackend):
+    """storage.StorageBackend on a local SQLite database at `path`."""
+
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn().executescript(SCHEMA)
+        self._migrate()
+
+    # ---- connection / transactions ----
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit mode; transactions are explicit (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")   # durable at checkpoints; WAL keeps it consistent
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    class _Tx:
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            # take the write lock up front so read-then-write can't interleave
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            return False
+
+    def _tx(self):
+        return self._Tx(self._conn())
+
+    def _migrate(self) -> None:
+        # columns added after the first release
+        conn = self._conn()
+        columns = {r["name"] for r in conn.execute("PRAGMA table_info(bots)")}
+        if "last_message_at" not in columns:
+            conn.execute("ALTER TABLE bots ADD COLUMN last_message_at TEXT")
+        if "stamp_format" not in columns:
+            conn.execute("ALTER TABLE bots ADD COLUMN stamp_format TEXT")
+
+    def _read(self, sql, params=()):
+        inc("sqlite.reads")
+        return self._conn().execute(sql, params).fetchall()
+
+    def close(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # ---- users ----
+    @span("sqlite.register_user")
+    def register_user(self, username, password):
+        hashed = hash_password(password)
+        with self._tx() as conn:
+            cur = conn.execute("INSERT OR IGNORE INTO users (username, password, created_at) VALUES (?, ?, ?)",
+                               (username, hashed, time.time()))
+        inc("sqlite.writes")
+        return cur.rowcount == 1
+
+    @span("sqlite.login_user")
+    def login_user(self, username, password):
+        if not username:
+            return False
+        rows = self._read("SELECT password FROM users WHERE username = ?", (username,))
+        return bool(rows) and check_password(password, rows[0]["password"])
+
+    # ---- bots ----
+    def _insert_bot(self, conn, username, name, file_text, persona) -> str:
+        content_hash = bot_index_hash(file_text)
+        conn.execute("INSERT OR IGNORE INTO corpora (content_hash, text) VALUES (?, ?)", (content_hash, file_text))
+        bot_id = _new_id()
+        conn.execute(
+            "INSERT INTO bots (id, username, name, content_hash, persona, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (bot_id, username, name, content_hash, persona or "", time.time()),
+        )
+        inc("sqlite.writes")
+        return bot_id
+
+    @span("sqlite.add_bot")
+    def add_bot(self, username, name, file_text, persona=None):
+        with self._tx() as conn:
+            return self._insert_bot(conn, username, name, file_text, persona)
+
+    @span("sqlite.add_bot_limited")
+    def add_bot_limited(self, username, name, file_text, persona=None, max_bots=2):
+        with self._tx() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM bots WHERE username = ?", (username,)).fetchone()
+            if count >= max_bots:
+                return None
+            return self._insert_bot(conn, username, name, file_text, persona)
+
+    @span("sqlite.get_user_bots")
+    def get_user_bots(self, username):
+        rows = self._read("SELECT id, name, persona FROM bots WHERE username = ? ORDER BY created_at, id",
+                          (username,))
+        return [{"id": r["id"], "name": r["name"], "file": r["id"], "persona": r["persona"]} for r in rows]
+
+    _BOT_SQL = ("SELECT b.id, b.name, b.persona, b.content_hash, b.last_message_at, b.stamp_format, c.text FROM bots b "
+                "JOIN corpora c ON c.content_hash = b.content_hash WHERE b.username = ?")
+
+    @staticmethod
+    def _bot_dict(row) -> dict:
+        return {"id": row["id"], "name": row["name"] or row["id"], "file_text": row["text"],
+                "persona": row["persona"], "content_hash": row["content_hash"],
+                "last_message_at": row["last_message_at"], "stamp_format": row["stamp_format"]}
+
+    @span("sqlite.get_bot")
+    def get_bot(self, username, bot_id):
+        rows = self._read(self._BOT_SQL + " AND b.id = ?", (username, bot_id))
+        return self._bot_dict(rows[0]) if rows else None
+
+    @span("sqlite.get_bots")
+    def get_bots(self, username, bot_ids):
+        bot_ids = list(bot_ids)
+        if not bot_ids:
+            return {}
+        marks = ",".join("?" * len(bot_ids))
+        rows = self._read(self._BOT_SQL + f" AND b.id IN ({marks})", (username, *bot_ids))
+        return {r["id"]: self._bot_dict(r) for r in rows}
+
+    @span("sqlite.update_bot")
+    def update_bot(self, username, bot_id, new_name, new_file_text=None):
+        with self._tx() as conn:
+            if new_file_text:
+                content_hash = bot_index_hash(new_file_text)
+                conn.execute("INSERT OR IGNORE INTO corpora (content_hash, text) VALUES (?, ?)",
+                             (content_hash, new_file_text))
+                cur = conn.execute("UPDATE bots SET name = ?, content_hash = ? WHERE username = ? AND id = ?",
+                                   (new_name, content_hash, username, bot_id))
+            else:
+                cur = conn.execute("UPDATE bots SET name = ? WHERE username = ? AND id = ?",
+                                   (new_name, username, bot_id))
+        inc("sqlite.writes")
+        return cur.rowcount == 1
+
+    @span("sqlite.extend_bot")
+    def extend_bot(self, username, bot_id, base_hash, file_text, last_message_at=None, stamp_format=None):
+        content_hash = bot_index_hash(file_text)
+        with self._tx() as conn:
+            conn.execute("INSERT OR IGNORE INTO corpora (content_hash, text) VALUES (?, ?)",
+                         (content_hash, file_text))
+            cur = conn.execute(
+                "UPDATE bots SET content_hash = ?, last_message_at = COALESCE(?, last_message_at), "
+                "stamp_format = COALESCE(?, stamp_format) "
+                "WHERE username = ? AND id = ? AND content_hash = ?",
+                (content_hash, last_message_at, stamp_format, username, bot_id, base_hash))
+        inc("sqlite.writes")
+        return cur.rowcount == 1
+
+    @span("sqlite.update_bot_persona")
+    def update_bot_persona(self, username, bot_id, persona_text):
+        with self._tx() as conn:
+            cur = conn.execute("UPDATE bots SET persona = ? WHERE username = ? AND id = ?",
+                               (persona_text, username, bot_id))
+        inc("sqlite.writes")
+        return cur.rowcount == 1
+
+    @span("sqlite.delete_bot")
+    def delete_bot(self, username, bot_id):
+        from retrieval import list_index_files, remove_index_files
+
+        report = {"docs_deleted": 0, "files_deleted": 0, "bytes_reclaimed": 0}
+        with self._tx() as conn:
+            row = conn.execute("SELECT content_hash FROM bots WHERE username = ? AND id = ?",
+                               (username, bot_id)).fetchone()
+            report.update(self._delete_history(conn, username, bot_id))
+            if row is None:
+                return report
+            content_hash = row["content_hash"]
+            conn.execute("DELETE FROM bots WHERE username = ? AND id = ?", (username, bot_id))
+            report["docs_deleted"] += 1
+            # corpora and index files are shared by content; drop them with the last user
+            shared = conn.execute("SELECT 1 FROM bots WHERE content_hash = ? LIMIT 1", (content_hash,)).fetchone()
+            if not shared:
+                (size,) = conn.execute("SELECT COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM corpora "
+                                       "WHERE content_hash = ?", (content_hash,)).fetchone()
+                conn.execute("DELETE FROM corpora WHERE content_hash = ?", (content_hash,))
+                report["docs_deleted"] += 1
+                report["bytes_reclaimed"] += size
+        inc("sqlite.writes")
+        if not shared:
+            files = list_index_files().get(content_hash, [])
+            report["bytes_reclaimed"] += remove_index_files(content_hash)
+            report["files_deleted"] += len(files)
+        inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+        return report
+
+    # ---- chat history ----
+    @span("sqlite.save_chat_history")
+    def save_chat_history(self, username, bot_id, history, start=0):
+        """
+        Rewrite only what changed: unchanged turns are left alone, so the
+        usual "one turn appended / last reply filled in" save is 1-2 row writes.
+        Rows before `start` aren't read or touched.
+        """
+        new = [json.dumps(t, ensure_ascii=False, default=str) for t in history]
+        with self._tx() as conn:
+            old = {seq: data for seq, data in conn.execute(
+                "SELECT seq, data FROM chat_turns WHERE username = ? AND bot_id = ? AND seq >= ?",
+                (username, bot_id, start))}
+            changed = [(username, bot_id, start + i, d) for i, d in enumerate(new) if old.get(start + i) != d]
+            conn.executemany("INSERT OR REPLACE INTO chat_turns (username, bot_id, seq, data) VALUES (?, ?, ?, ?)",
+                             changed)
+            conn.execute("DELETE FROM chat_turns WHERE username = ? AND bot_id = ? AND seq >= ?",
+                         (username, bot_id, start + len(new)))
+        inc("sqlite.writes", max(1, len(changed)))
+
+    @span("sqlite.load_chat_history")
+    def load_chat_history(self, username, bot_id):
+        rows = self._read("SELECT data FROM chat_turns WHERE username = ? AND bot_id = ? ORDER BY seq",
+                          (username, bot_id))
+        return [json.loads(r["data"]) for r in rows]
+
+    @span("sqlite.load_history_page")
+    def load_history_page(self, username, bot_id, limit=50, before=None):
+        sql = "SELECT seq, data FROM chat_turns WHERE username = ? AND bot_id = ?"
+        params = [username, bot_id]
+        if before is not None:
+            sql += " AND seq < ?"
+            params.append(before)
+        rows = self._read(sql + " ORDER BY seq DESC LIMIT ?", (*params, limit))
+        rows.reverse()
+        start = rows[0]["seq"] if rows else 0
+        return {"turns": [json.loads(r["data"]) for r in rows], "before": start or None}
+
+    @span("sqlite.load_history_range")
+    def load_history_range(self, username, bot_id, start=0, limit=200):
+        rows = self._read("SELECT data FROM chat_turns WHERE username = ? AND bot_id = ? AND seq >= ? "
+                          "ORDER BY seq LIMIT ?", (username, bot_id, start, limit))
+        return [json.loads(r["data"]) for r in rows]
+
+    def iter_history_pages(self, username, bot_id, start=0, page_size=200):
+        while True:
+            page = self.load_history_range(username, bot_id, start, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            start += len(page)
+
+    @staticmethod
+    def _delete_history(conn, username, bot_id) -> dict:
+        (count, size) = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM chat_turns "
+            "WHERE username = ? AND bot_id = ?", (username, bot_id)).fetchone()
+        conn.execute("DELETE FROM chat_turns WHERE username = ? AND bot_id = ?", (username, bot_id))
+        return {"docs_deleted": count, "bytes_reclaimed": size}
+
+    @span("sqlite.clear_history")
+    def clear_history(self, username, bot_id):
+        with self._tx() as conn:
+            report = self._delete_history(conn, username, bot_id)
+        inc("sqlite.writes")
+        inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+        return report
+
+    # ---- maintenance ----
+    @span("sqlite.gc_sweep")
+    def gc_sweep(self, dry_run=False, tmp_grace_s=3600):
+        """
+        Same report as cleanup.gc_sweep: history rows of bots that no longer
+        exist, corpora no bot references, orphan / stale index files.
+        """
+        from cleanup import sweep_index_files
+
+        report = {"orphan_chats": 0, "orphan_index_files": 0, "docs_deleted": 0,
+                  "files_deleted": 0, "bytes_reclaimed": 0, "dry_run": dry_run}
+        orphan_turns = ("chat_turns WHERE NOT EXISTS (SELECT 1 FROM bots b "
+                        "WHERE b.username = chat_turns.username AND b.id = chat_turns.bot_id)")
+        orphan_corpora = "corpora WHERE NOT EXISTS (SELECT 1 FROM bots b WHERE b.content_hash = corpora.content_hash)"
+        with self._tx() as conn:
+            chats, turns, turn_bytes = conn.execute(
+                "SELECT COUNT(DISTINCT username || '/' || bot_id), COUNT(*), "
+                "COALESCE(SUM(LENGTH(CAST(data AS BLOB))), 0) FROM " + orphan_turns).fetchone()
+            corpora, corpus_bytes = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(text AS BLOB))), 0) FROM " + orphan_corpora).fetchone()
+            report["orphan_chats"] = chats
+            report["bytes_reclaimed"] = turn_bytes + corpus_bytes
+            if not dry_run:
+                conn.execute("DELETE FROM " + orphan_turns)
+                conn.execute("DELETE FROM " + orphan_corpora)
+                report["docs_deleted"] = turns + corpora
+            live_hashes = {r[0] for r in conn.execute("SELECT DISTINCT content_hash FROM bots")}
+
+        sweep_index_files(live_hashes, report, dry_run=dry_run, tmp_grace_s=tmp_grace_s)
+        if not dry_run:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            inc("cleanup.bytes_reclaimed", report["bytes_reclaimed"])
+            inc("cleanup.gc_runs")
+        return report
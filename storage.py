@@ -0,0 +1,196 @@
+import os
+import threading
+
+import bcrypt
+
+# =========================================================
+# 🗄️ Pluggable storage backends
+# =========================================================
+# firebase_db (the facade the app imports) forwards every call to the
+# active backend:
+#   firestore  Firestore via firebase_async (default; multi-replica)
+#   sqlite     local SQLite file in WAL mode (single node / offline / benchmarks)
+# Selected with CHATDOUBLE_STORAGE or st.secrets["storage_backend"].
+
+BACKENDS = ("firestore", "sqlite")
+SQLITE_PATH = os.getenv(
+    "CHATDOUBLE_SQLITE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "chatdouble.sqlite3"),
+)
+
+_backend = None
+_lock = threading.Lock()
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode("utf-8", "ignore")
+
+
+def check_password(password: str, stored: str) -> bool:
+    if not stored:
+        return False
+    return bcrypt.checkpw(password.encode(), stored.encode())
+
+
+class StorageBackend:
+    """
+    Users, bots, corpora (bot text, keyed by content hash) and chat history.
+    Bot dicts look like {id, name, file_text, persona}; listings leave out
+    file_text. All methods are synchronous and thread-safe.
+    """
+
+    name = "base"
+
+    # ---- users ----
+    def register_user(self, username: str, password: str) -> bool:
+        raise NotImplementedError
+
+    def login_user(self, username: str, password: str) -> bool:
+        raise NotImplementedError
+
+    # ---- bots ----
+    def add_bot(self, username: str, name: str, file_text: str, persona: str = None) -> str:
+        raise NotImplementedError
+
+    def add_bot_limited(self, username: str, name: str, file_text: str, persona: str = None,
+                        max_bots: int = 2):
+        raise NotImplementedError
+
+    def get_user_bots(self, username: str) -> list:
+        raise NotImplementedError
+
+    def get_bot(self, username: str, bot_id: str):
+        raise NotImplementedError
+
+    def get_bots(self, username: str, bot_ids) -> dict:
+        out = {}
+        for bot_id in bot_ids:
+            bot = self.get_bot(username, bot_id)
+            if bot is not None:
+                out[bot_id] = bot
+        return out
+
+    def update_bot(self, username: str, bot_id: str, new_name: str, new_file_text: str = None) -> bool:
+        raise NotImplementedError
+
+    def extend_bot(self, username: str, bot_id: str, base_hash: str, file_text: str,
+                   last_message_at: str = None, stamp_format: str = None) -> bool:
+        """
+        Replace the bot's corpus with file_text (its current text plus appended
+        messages) if its content hash is still base_hash, and record the newest
+        message time with the stamp format it was read in. False if the bot is
+        gone or was changed meanwhile.
+        """
+        raise NotImplementedError
+
+    def update_bot_persona(self, username: str, bot_id: str, persona_text: str) -> bool:
+        raise NotImplementedError
+
+    def delete_bot(self, username: str, bot_id: str) -> dict:
+        """Bot + history + unshared index files; {docs_deleted, files_deleted, bytes_reclaimed}."""
+        raise NotImplementedError
+
+    # ---- chat history ----
+    def save_chat_history(self, username: str, bot_id: str, history: list, start: int = 0) -> None:
+        """
+        Store `history` as the turns from position `start` on (0: the whole
+        history). Turns before `start` are kept, so a session holding only
+        its newest turns can save them without the older ones.
+        """
+        raise NotImplementedError
+
+    def load_chat_history(self, username: str, bot_id: str) -> list:
+        raise NotImplementedError
+
+    def load_history_page(self, username: str, bot_id: str, limit: int = 50, before: int = None) -> dict:
+        """
+        Up to `limit` turns ending just before position `before` (None = the
+        newest), oldest first: {"turns": [...], "before": cursor or None}.
+        Pass the returned cursor back to get the previous page.
+        """
+        history = self.load_chat_history(username, bot_id)
+        end = len(history) if before is None else max(0, min(before, len(history)))
+        start = max(0, end - limit)
+        return {"turns": history[start:end], "before": start or None}
+
+    def load_history_range(self, username: str, bot_id: str, start: int = 0, limit: int = 200) -> list:
+        """Turns at positions [start, start + limit), oldest first (forward paging)."""
+        return self.load_chat_history(username, bot_id)[start:start + limit]
+
+    def iter_history_pages(self, username: str, bot_id: str, start: int = 0, page_size: int = 200):
+        """
+        Yield the history from position `start` on as lists of at most
+        page_size turns. This default reads the history once (it is a single
+        Firestore document, capped at 1 MiB); row-per-turn backends override
+        it to hold only one page at a time.
+        """
+        history = self.load_chat_history(username, bot_id)
+        for i in range(start, len(history), page_size):
+            yield history[i:i + page_size]
+
+    def clear_history(self, username: str, bot_id: str) -> dict:
+        raise NotImplementedError
+
+    # ---- page loads / maintenance ----
+    def load_chat_view(self, username: str, bot_id: str = None, history_limit: int = None) -> dict:
+        """
+        {"bots", "bot", "history", "history_start"} for the Chat tab (first
+        bot if bot_id is unknown). history_limit keeps only the newest turns
+        (0: no history read); history_start is the first one's position.
+        """
+        bots = self.get_user_bots(username)
+        if not bots:
+            return {"bots": [], "bot": None, "history": [], "history_start": 0}
+        if bot_id not in {b["id"] for b in bots}:
+            bot_id = bots[0]["id"]
+        view = {"bots": bots, "bot": self.get_bot(username, bot_id), "history": [], "history_start": 0}
+        if history_limit is None:
+            view["history"] = self.load_chat_history(username, bot_id)
+        elif history_limit:
+            page = self.load_history_page(username, bot_id, limit=history_limit)
+            view["history"], view["history_start"] = page["turns"], page["before"] or 0
+        return view
+
+    def gc_sweep(self, dry_run: bool = False) -> dict:
+        raise NotImplementedError
+
+
+def _configured_backend() -> str:
+    name = os.getenv("CHATDOUBLE_STORAGE")
+    if not name:
+        try:
+            import streamlit as st
+            name = st.secrets.get("storage_backend") if st.secrets else None
+        except Exception:
+            name = None
+    name = (name or "firestore").strip().lower()
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {name!r} (expected one of {', '.join(BACKENDS)})")
+    return name
+
+
+def make_backend(name: str, **kwargs) -> StorageBackend:
+    if name == "sqlite":
+        from sqlite_store import SQLiteBackend
+        return SQLiteBackend(kwargs.get("path") or SQLITE_PATH)
+    if name == "firestore":
+        from firebase_async import FirestoreBackend
+        return FirestoreBackend()
+    raise ValueError(f"Unknown storage backend {name!r}")
+
+
+def get_backend() -> StorageBackend:
+    """The process-wide backend, created from config on first use."""
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = make_backend(_configured_backend())
+    return _backend
+
+
+def set_backend(backend: StorageBackend) -> None:
+    """Use `backend` from now on (benchmarks, local runs)."""
+    global _backend
+    with _lock:
+        _backend = backend
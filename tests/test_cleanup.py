@@ -0,0 +1,48 @@
+import os
+
+import retrieval
+from cleanup import sweep_index_files
+
+LIVE, DEAD = "a" * 40, "b" * 40
+
+
+def test_sweep_only_touches_index_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval, "INDEX_DIR", str(tmp_path))
+    names = [f"{LIVE}.faiss", f"{DEAD}.faiss", f"{DEAD}.bm25.json", f"{DEAD}.lines",
+             "bench.sqlite3", "bench.sqlite3-wal", "bench.sqlite3-shm", "notes.txt"]
+    for name in names:
+        (tmp_path / name).write_bytes(b"x")
+    stale = tmp_path / f"{LIVE}.lines.{os.getpid()}.{'c' * 32}.tmp"
+    stale.write_bytes(b"x")
+    os.utime(stale, (0, 0))
+    (tmp_path / "embeddings").mkdir()
+
+    report = {"orphan_index_files": 0, "files_deleted": 0, "bytes_reclaimed": 0}
+    sweep_index_files({LIVE}, report)
+
+    assert report["orphan_index_files"] == 3
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        [f"{LIVE}.faiss", "bench.sqlite3", "bench.sqlite3-wal", "bench.sqlite3-shm", "notes.txt", "embeddings"])
+
+
+def test_compaction_keeps_only_live_lines(tmp_path, monkeypatch):
+    import numpy as np
+
+    from embedding_store import EmbeddingStore, line_key
+
+    store = EmbeddingStore(str(tmp_path), "model")
+    lines = [f"line {i}" for i in range(10)]
+    vecs = np.arange(40, dtype=np.float32).reshape(10, 4)
+    store.add([line_key(l) for l in lines], vecs)
+    reader = EmbeddingStore(str(tmp_path), "model")   # another process's view
+    assert reader.lookup([line_key(lines[7])])[0][0].tolist() == vecs[7].tolist()
+
+    keep = {line_key(l) for l in lines[5:]}
+    assert store.compact(keep, dry_run=True)[0] == 5
+    dropped, freed = store.compact(keep)
+    assert (dropped, freed) == (5, 5 * (16 + 20))
+    assert len(store) == 5
+
+    found, missing = reader.lookup([line_key(l) for l in lines])
+    assert missing == [0, 1, 2, 3, 4]
+    assert [v.tolist() for v in found[5:]] == vecs[5:].tolist()
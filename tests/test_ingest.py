@@ -0,0 +1,26 @@
+from ingest import parse_messages, select_new_messages
+
+US = "%m/%d/%Y, %I:%M %p"
+
+
+def test_unstamped_line_after_watermark():
+    export = "\n".join([
+        "12/13/2023, 5:00 PM - Raykay: already in the bot",
+        "- Raykay: no stamp on this one",
+        "- Raykay: already in the bot",
+        "12/14/2023, 9:00 AM - Raykay: a newer message",
+    ])
+    messages = parse_messages(export, "Raykay")
+    new, newest, fmt = select_new_messages(messages, ["already in the bot"], "2023-12-13T17:00", US)
+    assert new == ["no stamp on this one", "a newer message"]
+    assert newest == "2023-12-14T09:00"
+    assert fmt == US
+
+
+def test_saved_format_settles_ambiguous_export():
+    old = "\n".join(f"1/{d}/2023, 5:2{d} PM - A: hello msg{d}" for d in range(1, 6))
+    lines = [text for _, text in parse_messages(old, "A")]
+    messages = parse_messages(old + "\n12/13/2023, 5:00 PM - A: fresh one", "A")
+    new, newest, fmt = select_new_messages(messages, lines)
+    assert new == ["fresh one"]
+    assert (newest, fmt) == ("2023-12-13T17:00", US)
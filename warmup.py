@@ -0,0 +1,51 @@
+import importlib
+import threading
+import time
+
+# =========================================================
+# 🔥 Background warm-up
+# =========================================================
+# Modules that are slow to import but not needed for the login page.
+WARMUP_MODULES = ("faiss", "sentence_transformers", "google.genai", "firebase_admin")
+
+_started = False
+_lock = threading.Lock()
+_report = {}
+
+
+def _warm(tasks):
+    t0 = time.perf_counter()
+    for name in WARMUP_MODULES:
+        t = time.perf_counter()
+        try:
+            importlib.import_module(name)
+            _report[name] = round(time.perf_counter() - t, 3)
+        except Exception as e:
+            _report[name] = f"error: {e}"
+    for name, fn in tasks:
+        t = time.perf_counter()
+        try:
+            fn()
+            _report[name] = round(time.perf_counter() - t, 3)
+        except Exception as e:
+            _report[name] = f"error: {e}"
+    _report["total"] = round(time.perf_counter() - t0, 3)
+
+
+def start_warmup(tasks=()) -> bool:
+    """
+    Import heavy modules (and run extra (name, callable) tasks) on a daemon
+    thread, once per process. Returns True if this call started it.
+    """
+    global _started
+    with _lock:
+        if _started:
+            return False
+        _started = True
+    threading.Thread(target=_warm, args=(list(tasks),), name="chatdouble-warmup", daemon=True).start()
+    return True
+
+
+def warmup_report() -> dict:
+    """Seconds spent per warm-up step (filled in as the thread progresses)."""
+    return dict(_report)